@@ -3,14 +3,20 @@
 # All rights reserved.
 # Use of this source code is governed by a BSD 3-Clause License
 # that can be found in the LICENSE file.
+import atexit
 from logging.config import dictConfig
 import os
 
 import connexion
 
 from swagger_server import encoder
+from swagger_server.business_logic.delivery import push_engine
+from swagger_server.business_logic.outbox import dispatcher
+from swagger_server.business_logic.retention import Compactor
+from swagger_server.business_logic.retry import RetryScheduler
 from swagger_server import db
 from swagger_server import jwt_encode
+from swagger_server.metrics import MetricsServer
 from swagger_server.errors import register_error_handlers
 from logging.config import dictConfig
 
@@ -37,8 +43,16 @@ def main() -> None:
     _init_logging()
 
     db.create(drop=False)
+    Compactor().start()
+    RetryScheduler().start()
+    dispatcher.start()
+    MetricsServer().start()
+    # let pushes that are under way finish before exiting
+    atexit.register(push_engine.shutdown)
+    atexit.register(jwt_encode.signing_pool.shutdown)
 
     make_keys()
+    jwt_encode.key_manager.start()
 
     app = connexion.App(__name__, specification_dir='./swagger/')
     app.app.json_encoder = encoder.JSONEncoder
@@ -61,7 +75,7 @@ def make_keys() -> None:
     """
     # load or create the JWKSet
     try:
-        jwks = jwt_encode.load_jwks()
+        jwks = jwt_encode.read_jwks()
     except FileNotFoundError:
         jwks = jwt_encode.make_jwks([])
 
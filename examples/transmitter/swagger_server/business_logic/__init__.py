@@ -10,19 +10,24 @@ from typing import List, Optional, Tuple, Union, Dict
 from swagger_server.events import (
     Events, SecurityEvent, VerificationEvent
 )
+from swagger_server.business_logic import outbox
 from swagger_server.business_logic.const import TRANSMITTER_ISSUER
 from swagger_server.business_logic.stream import Stream
+from swagger_server.db import QueuedSET
 from swagger_server.business_logic.generate_event import (
     generate_security_event
 )
 from swagger_server.errors import (
-    EmailSubjectNotFound, LongPollingNotSupported, TransmitterError
+    EmailSubjectNotFound, InvalidPollCursor, LongPollingNotSupported,
+    TransmitterError
 )
 from swagger_server.models import (
    Email, Status, StreamConfiguration, StreamStatus,
    Subject, TransmitterConfiguration, EventType
 )
-from swagger_server.utils import get_simple_subject
+from swagger_server.utils import (
+    decode_cursor, encode_cursor, get_simple_subject
+)
 
 log = logging.getLogger(__name__)
 
@@ -90,8 +95,7 @@ def update_status(status: Status,
     stream = Stream.load(client_id)
 
     if not subject:
-        stream.status = status
-        stream.save()
+        stream.update_status(status)
         return StreamStatus(
             status=status,
         )
@@ -138,24 +142,37 @@ def _well_known_ssf_configuration_get(
 def poll_request(max_events: Optional[int],
                  return_immediately: Optional[bool],
                  acks: Optional[List[str]],
-                 client_id: str) -> Tuple[List[SecurityEvent], bool]:
+                 client_id: str,
+                 cursor: Optional[str] = None
+                 ) -> Tuple[List[QueuedSET], bool, Optional[str]]:
+    """Ack and fetch SETs. Returns the queued SETs, whether more are
+    available and, if so, a cursor to get the next page with
+    """
     stream = Stream.load(client_id)
 
     if return_immediately is not None and not return_immediately:
         raise LongPollingNotSupported()
 
+    after = 0
+    if cursor is not None:
+        after = decode_cursor(cursor)
+        if after is None:
+            raise InvalidPollCursor()
+
     if acks:
         acks = set(acks)
         stream.ack_SETs(acks)
 
-    queue_length = stream.count_SETs()
-
-    if max_events is None:
-        max_events = queue_length
+    page, more_available = stream.get_SET_page(max_events, after)
 
-    more_available = queue_length > max_events
+    next_cursor = None
+    if more_available and page:
+        next_cursor = encode_cursor(page[-1].seq)
+    elif more_available:
+        # an ack-only request doesn't move the cursor
+        next_cursor = cursor
 
-    return stream.get_SETs(max_events), more_available
+    return page, more_available, next_cursor
 
 
 def register(audience: Union[str, List[str]]) -> Dict[str, str]:
@@ -164,11 +181,19 @@ def register(audience: Union[str, List[str]]) -> Dict[str, str]:
     return {'token': client_id}
 
 
-def trigger_event(event_type: EventType, subject: Subject) -> None:
+def trigger_event(event_type: EventType, subject: Subject) -> str:
+    """Create an event and put it in the outbox, to be broadcast in the
+    background. Returns the event's id
+    """
     security_event = generate_security_event(event_type, subject)
     if security_event is None:
         msg = f"invalid event_type:{event_type} (only CAEP and RISC supported)"
         raise TransmitterError(code=500, message=msg)
 
-    # and broadcast it
-    Stream.broadcast_SET(security_event)
+    # broadcasts route on the subject's email, so turn away anything that
+    # couldn't be broadcast now rather than once it has been accepted
+    if not get_simple_subject(subject, Email):
+        raise EmailSubjectNotFound(subject)
+
+    outbox.add(security_event)
+    return security_event.jti
@@ -0,0 +1,241 @@
+# Copyright (c) 2021 Cisco Systems, Inc. and its affiliates
+# All rights reserved.
+# Use of this source code is governed by a BSD 3-Clause License
+# that can be found in the LICENSE file.
+
+"""
+Tracks how each receiver is doing, so that pushes to a receiver that is down
+don't each wait out a timeout before failing.
+
+Each receiver origin gets a circuit breaker. While it is closed, pushes go
+ahead as normal. When too many recent pushes have failed or been slow, it
+opens, and SETs for that receiver are left queued without being pushed.
+After a while it goes half-open and lets a single push through as a probe:
+if that succeeds the breaker closes again, and if not it opens for another
+spell.
+"""
+
+from enum import Enum
+import logging
+import os
+import threading
+import time
+from typing import Callable, Dict, List, Optional
+
+from swagger_server.business_logic.sessions import origin
+from swagger_server import metrics
+
+
+breakers_open = metrics.gauge(
+    "push_breakers_open",
+    "Receivers whose circuit breaker is open or half-open"
+)
+breaker_trips = metrics.counter(
+    "push_breaker_trips_total", "Times a receiver's circuit breaker opened"
+)
+short_circuits = metrics.counter(
+    "push_short_circuits_total",
+    "SETs left queued rather than pushed, because their receiver's circuit "
+    "breaker was open"
+)
+
+
+class BreakerState(Enum):
+    closed = "closed"
+    open = "open"
+    half_open = "half_open"
+
+
+class Window:
+    """Push outcomes over the last `seconds` seconds, kept in a fixed number
+    of buckets so that busy receivers don't cost more memory
+    """
+
+    BUCKETS = 10
+
+    def __init__(self, seconds: float) -> None:
+        self.bucket_seconds = seconds / self.BUCKETS
+        # [bucket number, pushes, failures, slow successful pushes,
+        #  total latency]
+        self._buckets: List[list] = []
+
+    def _trim(self, now: float) -> int:
+        bucket = int(now // self.bucket_seconds)
+        self._buckets = [b for b in self._buckets
+                         if b[0] > bucket - self.BUCKETS]
+        return bucket
+
+    def record(self, now: float, ok: bool, slow: bool,
+               latency: float) -> None:
+        bucket = self._trim(now)
+        if not self._buckets or self._buckets[-1][0] != bucket:
+            self._buckets.append([bucket, 0, 0, 0, 0.0])
+        current = self._buckets[-1]
+        current[1] += 1
+        current[2] += not ok
+        current[3] += ok and slow
+        current[4] += latency
+
+    def totals(self, now: float) -> Dict[str, float]:
+        self._trim(now)
+        pushes = sum(b[1] for b in self._buckets)
+        return {
+            "pushes": pushes,
+            "failures": sum(b[2] for b in self._buckets),
+            "slow": sum(b[3] for b in self._buckets),
+            "mean_latency": (
+                sum(b[4] for b in self._buckets) / pushes if pushes else 0.0
+            ),
+        }
+
+    def clear(self) -> None:
+        self._buckets = []
+
+
+class CircuitBreaker:
+    """The health of one receiver. See the module docstring"""
+
+    def __init__(self, endpoint: str,
+                 window: Optional[float] = None,
+                 min_pushes: Optional[int] = None,
+                 error_rate: Optional[float] = None,
+                 slow_push: Optional[float] = None,
+                 open_for: Optional[float] = None,
+                 clock: Callable[[], float] = time.monotonic) -> None:
+        self.endpoint = endpoint
+        self.min_pushes = min_pushes or int(
+            os.environ.get("PUSH_BREAKER_MIN_PUSHES", 5)
+        )
+        self.error_rate = error_rate or float(
+            os.environ.get("PUSH_BREAKER_ERROR_RATE", 0.5)
+        )
+        self.slow_push = slow_push or float(
+            os.environ.get("PUSH_BREAKER_SLOW_PUSH", 5)
+        )
+        self.open_for = open_for or float(
+            os.environ.get("PUSH_BREAKER_OPEN_SECONDS", 30)
+        )
+        self.clock = clock
+
+        self._lock = threading.Lock()
+        self._window = Window(window or float(
+            os.environ.get("PUSH_BREAKER_WINDOW", 60)
+        ))
+        self._state = BreakerState.closed
+        self._opened_at = 0.0
+        # when the half-open probe under way started, if there is one
+        self._probe_started: Optional[float] = None
+
+    @property
+    def state(self) -> BreakerState:
+        with self._lock:
+            return self._current_state(self.clock())
+
+    def _current_state(self, now: float) -> BreakerState:
+        # must hold the lock
+        if self._state == BreakerState.open and \
+                now - self._opened_at >= self.open_for:
+            self._state = BreakerState.half_open
+            self._probe_started = None
+        return self._state
+
+    def available(self) -> bool:
+        """Whether it is worth handing this receiver a push. Unlike allow,
+        this doesn't use up the half-open probe
+        """
+        return self.state != BreakerState.open
+
+    def allow(self) -> bool:
+        """Whether to go ahead with a push now. While half-open, only one
+        push at a time is let through, to probe whether the receiver is back.
+        A probe that never reports back is given up on after open_for
+        """
+        now = self.clock()
+        with self._lock:
+            state = self._current_state(now)
+            if state == BreakerState.closed:
+                return True
+            if state == BreakerState.half_open and (
+                self._probe_started is None or
+                now - self._probe_started >= self.open_for
+            ):
+                self._probe_started = now
+                return True
+        short_circuits.inc()
+        return False
+
+    def record(self, ok: bool, latency: float) -> None:
+        """Record how an allowed push went"""
+        now = self.clock()
+        slow = latency >= self.slow_push
+        with self._lock:
+            state = self._current_state(now)
+            if state == BreakerState.half_open:
+                if ok and not slow:
+                    self._close()
+                else:
+                    self._open(now)
+                return
+
+            self._window.record(now, ok, slow, latency)
+            if state == BreakerState.closed and not (ok and not slow):
+                totals = self._window.totals(now)
+                bad = (totals["failures"] + totals["slow"]) / totals["pushes"]
+                if totals["pushes"] >= self.min_pushes and \
+                        bad >= self.error_rate:
+                    self._open(now)
+
+    def _open(self, now: float) -> None:
+        # must hold the lock
+        if self._state == BreakerState.closed:
+            logging.warning(f"Circuit breaker for {self.endpoint} opened")
+            breaker_trips.inc()
+            breakers_open.inc()
+        self._state = BreakerState.open
+        self._opened_at = now
+        self._probe_started = None
+
+    def _close(self) -> None:
+        # must hold the lock
+        logging.info(f"Circuit breaker for {self.endpoint} closed")
+        breakers_open.dec()
+        self._state = BreakerState.closed
+        self._probe_started = None
+        self._window.clear()
+
+    def health(self) -> Dict[str, object]:
+        now = self.clock()
+        with self._lock:
+            state = self._current_state(now)
+            totals = self._window.totals(now)
+        return {"state": state.value, **totals}
+
+
+class BreakerRegistry:
+    """The circuit breaker for each receiver origin"""
+
+    def __init__(self,
+                 make_breaker: Callable[[str], CircuitBreaker] = CircuitBreaker
+                 ) -> None:
+        self.make_breaker = make_breaker
+        self._lock = threading.Lock()
+        self._breakers: Dict[str, CircuitBreaker] = {}
+
+    def get(self, url: str) -> CircuitBreaker:
+        key = origin(url)
+        with self._lock:
+            breaker = self._breakers.get(key)
+            if breaker is None:
+                breaker = self._breakers[key] = self.make_breaker(key)
+            return breaker
+
+    def health(self) -> Dict[str, Dict[str, object]]:
+        """How every receiver pushed to so far is doing"""
+        with self._lock:
+            breakers = list(self._breakers.values())
+        return {b.endpoint: b.health() for b in breakers}
+
+    def clear(self) -> None:
+        with self._lock:
+            self._breakers.clear()
+        breakers_open.set(0)
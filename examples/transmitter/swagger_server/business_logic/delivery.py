@@ -0,0 +1,457 @@
+# Copyright (c) 2021 Cisco Systems, Inc. and its affiliates
+# All rights reserved.
+# Use of this source code is governed by a BSD 3-Clause License
+# that can be found in the LICENSE file.
+
+"""
+Pushes SETs to receivers in the background, so that the request that
+triggered them doesn't wait on receivers' HTTP round trips.
+
+A SET is queued in the database before it is handed to the engine, so that
+it is durable once the triggering request returns. A successful push
+acknowledges it; a failed one leaves it queued, to be retried later with
+exponential backoff (see retry.py).
+
+SETs about the same subject in the same stream are pushed one at a time, in
+the order they were handed over, so that a receiver sees them in the order
+they were generated. SETs about different subjects are pushed in parallel.
+"""
+
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import os
+import random
+import threading
+import time
+from typing import (
+    Callable, Deque, Dict, Hashable, NamedTuple, Optional, Tuple
+)
+
+from requests.exceptions import HTTPError, RequestException, Timeout as \
+    RequestTimeout
+
+from swagger_server.business_logic import retention
+from swagger_server.business_logic import ratelimit
+from swagger_server.business_logic.breaker import (
+    BreakerRegistry, BreakerState
+)
+from swagger_server.business_logic.ratelimit import RateLimiterRegistry
+from swagger_server.business_logic.sessions import SessionPool, origin
+import swagger_server.db as db
+from swagger_server.events import SecurityEvent
+from swagger_server import jwt_encode
+from swagger_server import metrics
+
+
+Timeout = Tuple[float, float]
+
+# shared by every push, so that pushes to the same receiver reuse connections
+session_pool = SessionPool()
+# how each receiver is doing, shared for the same reason
+breakers = BreakerRegistry()
+# how fast each receiver can be pushed to
+limiters = RateLimiterRegistry()
+
+push_attempts = metrics.counter(
+    "push_attempts_total", "SETs pushed to receivers, successful or not"
+)
+push_failures = metrics.counter(
+    "push_failures_total", "SETs that receivers didn't accept"
+)
+push_abandoned = metrics.counter(
+    "push_abandoned_total",
+    "SETs that won't be pushed again, having failed too many times"
+)
+# per receiver host, which keeps the number of series down to the number of
+# receivers rather than streams
+push_latency = metrics.family(
+    metrics.Histogram, "push_duration_seconds",
+    "How long pushes took, by receiver", ("endpoint",)
+)
+push_results = metrics.family(
+    metrics.Counter, "push_results_total",
+    "Pushes by receiver and how they went: success, failure or timeout",
+    ("endpoint", "result")
+)
+push_retry_attempts = metrics.family(
+    metrics.Counter, "push_retry_attempts_total",
+    "Pushes of SETs that had failed before, by receiver", ("endpoint",)
+)
+
+# how a breaker's state is exported: the further from closed, the higher
+BREAKER_STATE_VALUES = {
+    BreakerState.closed.value: 0,
+    BreakerState.half_open.value: 1,
+    BreakerState.open.value: 2,
+}
+
+
+def _breaker_health() -> Dict[str, Dict[str, float]]:
+    return {
+        endpoint: {
+            "state": BREAKER_STATE_VALUES[str(health["state"])],
+            "error_rate": (
+                float(health["failures"]) / float(health["pushes"])
+                if health["pushes"] else 0.0
+            ),
+            "mean_latency": float(health["mean_latency"]),
+        }
+        for endpoint, health in breakers.health().items()
+    }
+
+
+def _breaker_stat(stat: str) -> Callable[[], Dict[str, float]]:
+    def collect() -> Dict[str, float]:
+        return {
+            endpoint: health[stat]
+            for endpoint, health in _breaker_health().items()
+        }
+    return collect
+
+
+metrics.collected(
+    "push_breaker_state",
+    "Each receiver's circuit breaker: 0 closed, 1 half-open, 2 open",
+    "endpoint", _breaker_stat("state")
+)
+metrics.collected(
+    "push_breaker_error_rate",
+    "The share of recent pushes to each receiver that failed",
+    "endpoint", _breaker_stat("error_rate")
+)
+metrics.collected(
+    "push_breaker_mean_latency_seconds",
+    "How long recent pushes to each receiver took on average",
+    "endpoint", _breaker_stat("mean_latency")
+)
+
+
+def _blocked_for() -> Dict[str, float]:
+    return {
+        endpoint: float(health["blocked_for"])  # type: ignore
+        for endpoint, health in limiters.health().items()
+    }
+
+
+metrics.collected(
+    "push_rate_blocked_seconds",
+    "How much longer each receiver asked, with Retry-After, not to be "
+    "pushed to",
+    "endpoint", _blocked_for
+)
+
+
+def lease_until(now: Optional[float] = None) -> int:
+    """Until when a SET being pushed is left alone by the retry scheduler.
+    This needs to be longer than a push can take
+    """
+    now = now if now is not None else time.time()
+    return int(now) + int(os.environ.get("PUSH_RETRY_LEASE", 60))
+
+
+def next_attempt_at(attempts: int,
+                    now: Optional[float] = None) -> Optional[int]:
+    """When to retry a push that has failed attempts times: exponential
+    backoff, capped, with jitter so that retries for a receiver that was
+    down don't all arrive at once when it comes back. None if it has failed
+    too many times already
+    """
+    max_attempts = int(os.environ.get("PUSH_RETRY_MAX_ATTEMPTS", 0))
+    if max_attempts and attempts >= max_attempts:
+        return None
+
+    base = float(os.environ.get("PUSH_RETRY_BASE_DELAY", 5))
+    cap = float(os.environ.get("PUSH_RETRY_MAX_DELAY", 3600))
+    delay = min(cap, base * 2 ** (attempts - 1))
+    delay = delay / 2 + random.uniform(0, delay / 2)
+
+    now = now if now is not None else time.time()
+    return int(now + delay)
+
+
+class PushJob(NamedTuple):
+    """Everything needed to push one SET, so the worker doesn't need to load
+    the stream
+    """
+    client_id: str
+    endpoint_url: str
+    authorization_header: Optional[str]
+    SET: SecurityEvent
+    jws: Optional[str] = None
+    # how many times pushing this SET has failed before
+    attempts: int = 0
+    # the email address of the subject the SET is about, if any
+    subject: Optional[str] = None
+
+    @property
+    def endpoint(self) -> str:
+        """Concurrency limits apply per receiver host, not per URL"""
+        return origin(self.endpoint_url)
+
+    @property
+    def ordering_key(self) -> Optional[Hashable]:
+        """Jobs with the same key are pushed in order. SETs that aren't about
+        a subject, like verification events, can go in any order
+        """
+        if self.subject is None:
+            return None
+        return (self.client_id, self.subject)
+
+
+def receiver_is_down(err: RequestException) -> bool:
+    """Whether a failed push says something about the receiver's health,
+    rather than about the push. A 4xx means the receiver is up
+    """
+    if isinstance(err, HTTPError) and err.response is not None:
+        status = err.response.status_code
+        return status >= 500 or status == 429
+    return True
+
+
+def deliver(job: PushJob, timeout: Timeout, ack: bool = True) -> bool:
+    """Push a SET, acknowledging it if the receiver accepts it and
+    scheduling a retry if not. If the receiver's circuit breaker won't let
+    the push through, the SET is left queued, to be retried once its lease
+    is up. If its rate limit won't let it through soon, the SET is left
+    queued until it will, without counting as a failed attempt.
+
+    With ack=False an accepted SET is left for the caller to acknowledge,
+    so that many can be acknowledged in one go
+    """
+    limiter = limiters.get(job.endpoint_url)
+    wait = limiter.reserve()
+    if wait > limiter.max_wait:
+        db.reschedule_SET(job.client_id, job.SET.jti, job.attempts,
+                          int(time.time() + wait) + 1)
+        return False
+    if wait > 0:
+        time.sleep(wait)
+
+    breaker = breakers.get(job.endpoint_url)
+    if not breaker.allow():
+        return False
+
+    headers = {
+        "Content-Type": "application/secevent+jwt",
+        "Accept": "application/json"
+    }
+    if job.authorization_header:
+        headers["Authorization"] = job.authorization_header
+
+    jws = job.jws or jwt_encode.encode_set(job.SET)
+    endpoint = job.endpoint
+    push_attempts.inc()
+    if job.attempts:
+        push_retry_attempts.labels(endpoint).inc()
+    started = time.monotonic()
+    try:
+        response = session_pool.post(
+            job.endpoint_url,
+            data=jws,
+            headers=headers,
+            timeout=timeout
+        )
+        response.raise_for_status()
+    except RequestException as err:
+        latency = time.monotonic() - started
+        ok = not receiver_is_down(err)
+        wait_for = ratelimit.retry_after(getattr(err, "response", None))
+        breaker.record(ok, latency)
+        limiter.record(ok, latency, wait_for)
+        push_latency.labels(endpoint).observe(latency)
+        result = "timeout" if isinstance(err, RequestTimeout) else "failure"
+        push_results.labels(endpoint, result).inc()
+        push_failures.inc()
+        attempts = job.attempts + 1
+        retry_at = next_attempt_at(attempts)
+        if retry_at is not None and wait_for is not None:
+            retry_at = max(retry_at, int(time.time() + wait_for))
+        if retry_at is None:
+            push_abandoned.inc()
+            logging.error(
+                f"Error pushing SET {job.SET.jti} to {job.endpoint_url}: "
+                f"{err}. Giving up after {attempts} attempts."
+            )
+        else:
+            logging.error(
+                f"Error pushing SET {job.SET.jti} to {job.endpoint_url}: "
+                f"{err}. Retrying in {retry_at - int(time.time())}s."
+            )
+        db.reschedule_SET(job.client_id, job.SET.jti, attempts, retry_at)
+        return False
+
+    latency = time.monotonic() - started
+    breaker.record(True, latency)
+    limiter.record(True, latency)
+    push_latency.labels(endpoint).observe(latency)
+    push_results.labels(endpoint, "success").inc()
+    if ack:
+        db.delete_SETs(job.client_id, [job.SET.jti])
+        retention.record_acks("push", [job.SET.iat])
+    return True
+
+
+class DeliveryEngine:
+    """A bounded pool of worker threads that push SETs.
+
+    No more than per_endpoint pushes to the same receiver run at once. Jobs
+    beyond that wait in line for their endpoint without taking up a worker,
+    so a slow receiver only holds up its own SETs.
+
+    Only one job per ordering key is pushed at a time; the rest wait in line
+    for their key. If a push fails, the jobs waiting behind it are turned
+    away rather than let overtake it, and stay queued to be retried.
+    """
+
+    def __init__(self,
+                 workers: Optional[int] = None,
+                 per_endpoint: Optional[int] = None,
+                 max_pending: Optional[int] = None,
+                 timeout: Optional[Timeout] = None,
+                 deliver: Callable[[PushJob, Timeout], bool] = deliver
+                 ) -> None:
+        self.workers = workers or int(os.environ.get("PUSH_WORKERS", 16))
+        self.per_endpoint = per_endpoint or int(
+            os.environ.get("PUSH_MAX_PER_ENDPOINT", 4)
+        )
+        self.max_pending = max_pending or int(
+            os.environ.get("PUSH_MAX_PENDING", 10000)
+        )
+        self.timeout = timeout or (
+            float(os.environ.get("PUSH_CONNECT_TIMEOUT", 5)),
+            float(os.environ.get("PUSH_READ_TIMEOUT", 10)),
+        )
+        self.deliver = deliver
+
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._lock = threading.Lock()
+        self._idle = threading.Condition(self._lock)
+        self._active: Dict[str, int] = defaultdict(int)
+        self._waiting: Dict[str, Deque[PushJob]] = defaultdict(deque)
+        # the jobs waiting behind the one being pushed, for each ordering key
+        # with a job under way
+        self._ordered: Dict[Hashable, Deque[PushJob]] = {}
+        self._pending = 0
+        self._closed = False
+
+    def submit(self, job: PushJob) -> bool:
+        """Hand a job to the workers. If the engine is shutting down or has
+        too much to do already, the job is turned away and its SET stays
+        queued, to be retried once its lease is up
+        """
+        with self._lock:
+            if self._closed or self._pending >= self.max_pending:
+                logging.warning(
+                    f"Not pushing SET {job.SET.jti} to {job.endpoint_url} "
+                    f"now, leaving it queued instead."
+                )
+                return False
+
+            self._pending += 1
+            key = job.ordering_key
+            if key is not None:
+                if key in self._ordered:
+                    self._ordered[key].append(job)
+                    return True
+                self._ordered[key] = deque()
+            self._admit(job)
+            return True
+
+    def _admit(self, job: PushJob) -> None:
+        # must hold the lock
+        endpoint = job.endpoint
+        if self._active[endpoint] < self.per_endpoint:
+            self._active[endpoint] += 1
+            self._start(job)
+        else:
+            self._waiting[endpoint].append(job)
+
+    def _start(self, job: PushJob) -> None:
+        # must hold the lock
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(
+                max_workers=self.workers, thread_name_prefix="push"
+            )
+        self._executor.submit(self._run, job)
+
+    def _run(self, job: PushJob) -> None:
+        pushed = False
+        try:
+            pushed = self.deliver(job, self.timeout)
+        except Exception:
+            logging.exception(f"Error pushing SET {job.SET.jti}")
+        finally:
+            with self._lock:
+                self._pending -= 1
+                gave_up = self._closed and self._executor is None
+                endpoint = job.endpoint
+                waiting = self._waiting.get(endpoint)
+                if waiting and gave_up:
+                    # shutdown gave up waiting; these stay queued
+                    self._pending -= len(waiting)
+                    waiting.clear()
+                if waiting:
+                    # hand this job's slot straight to the next in line
+                    self._start(waiting.popleft())
+                else:
+                    self._waiting.pop(endpoint, None)
+                    self._active[endpoint] -= 1
+                    if not self._active[endpoint]:
+                        del self._active[endpoint]
+                self._next_in_order(job, pushed and not gave_up)
+                if not self._pending:
+                    self._idle.notify_all()
+
+    def _next_in_order(self, job: PushJob, pushed: bool) -> None:
+        # must hold the lock
+        key = job.ordering_key
+        if key is None:
+            return
+        later = self._ordered[key]
+        if later and not pushed:
+            # these stay queued, and are retried once their lease is up,
+            # rather than pushed ahead of the SET that just failed
+            logging.warning(
+                f"Not pushing {len(later)} later SETs about the same subject "
+                f"as SET {job.SET.jti} to {job.endpoint_url} now, leaving "
+                f"them queued instead."
+            )
+            self._pending -= len(later)
+            later.clear()
+        if later:
+            self._admit(later.popleft())
+        else:
+            del self._ordered[key]
+
+    @property
+    def spare_capacity(self) -> int:
+        """How many more jobs can be taken right now"""
+        return max(0, self.max_pending - self._pending)
+
+    def drain(self, timeout: Optional[float] = None) -> bool:
+        """Wait for every job handed over so far to finish. Returns False if
+        the timeout ran out first
+        """
+        with self._lock:
+            return self._idle.wait_for(lambda: not self._pending, timeout)
+
+    def shutdown(self, timeout: Optional[float] = None) -> None:
+        """Stop taking jobs and give the ones already taken a chance to
+        finish. Any that don't finish in time are still queued
+        """
+        with self._lock:
+            self._closed = True
+        if timeout is None:
+            timeout = float(os.environ.get("PUSH_DRAIN_TIMEOUT", 30))
+        if not self.drain(timeout):
+            logging.warning("Gave up waiting for pushes to finish")
+
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=False)
+        session_pool.close()
+
+
+push_engine = DeliveryEngine()
@@ -0,0 +1,178 @@
+# Copyright (c) 2021 Cisco Systems, Inc. and its affiliates
+# All rights reserved.
+# Use of this source code is governed by a BSD 3-Clause License
+# that can be found in the LICENSE file.
+
+"""
+Broadcasts triggered events in the background.
+
+Triggering an event only writes it to the outbox, in one small transaction,
+so the request doesn't wait on however many streams follow the subject. The
+dispatcher then claims events from the outbox and broadcasts them, taking
+each out once it has been broadcast.
+
+An event is leased while it is being broadcast. If the process broadcasting
+it goes away first, the event is claimed again once the lease is up and
+broadcast again, skipping the streams that still have it queued, so every
+event is broadcast at least once.
+
+An event that fails to be broadcast is claimed again after a backoff, and
+after OUTBOX_MAX_ATTEMPTS failures it is set aside as failed, so that an
+event that can never be broadcast doesn't keep being claimed.
+"""
+
+import logging
+import os
+import threading
+import time
+from typing import Optional
+
+from swagger_server.business_logic.stream import Stream
+import swagger_server.db as db
+from swagger_server.events import SecurityEvent
+from swagger_server import metrics
+
+
+outbox_events = metrics.counter(
+    "outbox_events_total", "Events written to the outbox"
+)
+dispatched_events = metrics.counter(
+    "outbox_dispatched_total", "Events broadcast from the outbox"
+)
+dispatch_failures = metrics.counter(
+    "outbox_dispatch_failures_total",
+    "Times broadcasting an event from the outbox failed, to be retried"
+)
+outbox_failed = metrics.counter(
+    "outbox_failed_total",
+    "Events given up on after failing to be broadcast too many times"
+)
+outbox_lag = metrics.gauge(
+    "outbox_lag_seconds",
+    "How long the first event of the last batch taken from the outbox had "
+    "been waiting"
+)
+
+
+def lease_until(now: Optional[float] = None) -> int:
+    """Until when an event being broadcast is left alone by other
+    dispatchers. This needs to be longer than a broadcast can take
+    """
+    now = now if now is not None else time.time()
+    return int(now) + int(os.environ.get("OUTBOX_LEASE", 60))
+
+
+def next_attempt_at(attempts: int, now: int) -> Optional[int]:
+    """When to claim an event that has failed to be broadcast attempts times
+    again: exponential backoff, capped. None if it has failed too many times
+    already
+    """
+    max_attempts = int(os.environ.get("OUTBOX_MAX_ATTEMPTS", 10))
+    if max_attempts and attempts >= max_attempts:
+        return None
+
+    base = float(os.environ.get("OUTBOX_RETRY_BASE_DELAY", 5))
+    cap = float(os.environ.get("OUTBOX_RETRY_MAX_DELAY", 300))
+    return now + int(min(cap, base * 2 ** (attempts - 1)))
+
+
+def add(SET: SecurityEvent) -> None:
+    """Write an event to the outbox, to be broadcast shortly"""
+    db.add_outbox_event(SET, int(time.time()))
+    outbox_events.inc()
+    dispatcher.wake()
+
+
+class Dispatcher:
+    """A background thread that broadcasts the events in the outbox.
+
+    It runs as soon as an event is added in this process, and every interval
+    seconds regardless, to pick up events added by other processes or left
+    behind by ones that went away. Events are broadcast one at a time, oldest
+    first, so that events about the same subject are queued in the order
+    they were triggered.
+    """
+
+    def __init__(self, interval: Optional[float] = None,
+                 batch_size: Optional[int] = None) -> None:
+        self.interval = interval if interval is not None else float(
+            os.environ.get("OUTBOX_INTERVAL", 1)
+        )
+        self.batch_size = batch_size or int(
+            os.environ.get("OUTBOX_BATCH_SIZE", 100)
+        )
+        self._stop = threading.Event()
+        self._wake = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def run_once(self, now: Optional[int] = None) -> int:
+        """Broadcast the events that are due by now, returning how many"""
+        now = now if now is not None else int(time.time())
+        claimed = db.claim_outbox_events(now, self.batch_size,
+                                         lease_until(now))
+        if not claimed:
+            outbox_lag.set(0)
+            return 0
+
+        dispatched = 0
+        for i, event in enumerate(claimed):
+            try:
+                SET = event.SET
+                if not i:
+                    outbox_lag.set(max(0, time.time() - SET.iat))
+                Stream.broadcast_SET(SET, redelivery=event.attempts > 1)
+            except Exception:
+                dispatch_failures.inc()
+                logging.exception(
+                    f"Error broadcasting event {event.event_id}, "
+                    f"attempt {event.attempts}"
+                )
+                retry_at = next_attempt_at(event.attempts, now)
+                if retry_at is None:
+                    outbox_failed.inc()
+                    logging.error(
+                        f"Giving up on event {event.event_id} after "
+                        f"{event.attempts} attempts"
+                    )
+                db.reschedule_outbox_event(event.event_id, retry_at)
+                continue
+            db.delete_outbox_event(event.event_id)
+            dispatched += 1
+
+        dispatched_events.inc(dispatched)
+        return dispatched
+
+    def wake(self) -> None:
+        """Run straight away, rather than at the next interval"""
+        self._wake.set()
+
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            if self._stop.is_set():
+                return
+            try:
+                while self.run_once() == self.batch_size:
+                    # there may be more waiting
+                    pass
+            except Exception:
+                logging.exception("Error dispatching the outbox")
+
+    def start(self) -> None:
+        if self.interval <= 0 or self._thread is not None:
+            return
+        self._thread = threading.Thread(
+            target=self._run, name="outbox", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+
+dispatcher = Dispatcher()
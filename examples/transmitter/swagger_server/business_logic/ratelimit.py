@@ -0,0 +1,255 @@
+# Copyright (c) 2021 Cisco Systems, Inc. and its affiliates
+# All rights reserved.
+# Use of this source code is governed by a BSD 3-Clause License
+# that can be found in the LICENSE file.
+
+"""
+Paces pushes to each receiver to what it can take.
+
+Each receiver origin gets a rate limiter. A receiver that keeps up is pushed
+to as fast as the workers go. Once it pushes back, with a 429 or 5xx, a
+failed connection or a slow response, its rate is cut to a fraction of what
+it was being sent, and pushes are spaced out to fit. Every push that goes
+well then raises the rate a little, until it is back where it was and the
+limit is lifted: additive increase, multiplicative decrease.
+
+A Retry-After header holds back every push to the receiver until then.
+"""
+
+from datetime import timezone
+from email.utils import parsedate_to_datetime
+import logging
+import os
+import threading
+import time
+from typing import Callable, Dict, Optional
+
+from requests import Response
+
+from swagger_server.business_logic.sessions import origin
+from swagger_server import metrics
+
+
+rate_cuts = metrics.counter(
+    "push_rate_cuts_total",
+    "Times a receiver's push rate was cut because it pushed back"
+)
+throttled = metrics.counter(
+    "push_throttled_total",
+    "SETs left queued rather than pushed, because their receiver's rate "
+    "limit wouldn't let them through soon enough"
+)
+rate_limits = metrics.family(
+    metrics.Gauge, "push_rate_limit",
+    "Pushes per second allowed to each receiver, 0 if it isn't limited",
+    ("endpoint",)
+)
+
+
+def retry_after(response: Optional[Response],
+                now: Optional[float] = None) -> Optional[float]:
+    """How many seconds the response's Retry-After header asks to wait,
+    given either as seconds or as an HTTP date. None if it has none, or one
+    that doesn't parse
+    """
+    if response is None:
+        return None
+    value = response.headers.get("Retry-After")
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+    try:
+        when = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if when.tzinfo is None:
+        when = when.replace(tzinfo=timezone.utc)
+    now = now if now is not None else time.time()
+    return max(0.0, when.timestamp() - now)
+
+
+class RateLimiter:
+    """The pace of pushes to one receiver. See the module docstring"""
+
+    def __init__(self, endpoint: str,
+                 max_rate: Optional[float] = None,
+                 min_rate: Optional[float] = None,
+                 increase: Optional[float] = None,
+                 decrease: Optional[float] = None,
+                 slow_push: Optional[float] = None,
+                 max_retry_after: Optional[float] = None,
+                 max_wait: Optional[float] = None,
+                 clock: Callable[[], float] = time.monotonic) -> None:
+        self.endpoint = endpoint
+        # 0 for no ceiling, other than what the receiver can take
+        self.max_rate = max_rate if max_rate is not None else float(
+            os.environ.get("PUSH_RATE_MAX", 0)
+        )
+        self.min_rate = min_rate or float(
+            os.environ.get("PUSH_RATE_MIN", 1)
+        )
+        self.increase = increase or float(
+            os.environ.get("PUSH_RATE_INCREASE", 10)
+        )
+        self.decrease = decrease or float(
+            os.environ.get("PUSH_RATE_DECREASE", 0.5)
+        )
+        self.slow_push = slow_push or float(
+            os.environ.get("PUSH_RATE_SLOW_PUSH", 2)
+        )
+        self.max_retry_after = max_retry_after or float(
+            os.environ.get("PUSH_RATE_MAX_RETRY_AFTER", 3600)
+        )
+        # how long a worker may wait for a push's turn, rather than leave
+        # the SET queued for later
+        self.max_wait = max_wait if max_wait is not None else float(
+            os.environ.get("PUSH_RATE_MAX_WAIT", 1)
+        )
+        self.clock = clock
+
+        self._lock = threading.Lock()
+        # pushes per second, or None while unlimited
+        self._rate: Optional[float] = self.max_rate or None
+        # the rate at which the limit is lifted again
+        self._ceiling = self.max_rate
+        # when the next push may go, while limited
+        self._next_at = 0.0
+        self._blocked_until = 0.0
+        self._last_cut = float("-inf")
+        # pushes sent this second and last, to know what rate to cut from
+        self._second = 0
+        self._sent = [0, 0]
+        self._gauge = rate_limits.labels(endpoint)
+        self._gauge.set(self._rate or 0)
+
+    @property
+    def rate(self) -> Optional[float]:
+        return self._rate
+
+    def reserve(self) -> float:
+        """How many seconds until a push may go. If that is no more than
+        max_wait, the slot is taken and the caller must wait that long and
+        then push; otherwise nothing is taken and the caller shouldn't push
+        """
+        now = self.clock()
+        with self._lock:
+            start = max(now, self._blocked_until)
+            if self._rate is not None:
+                start = max(start, self._next_at)
+            wait = start - now
+            if wait > self.max_wait:
+                throttled.inc()
+                return wait
+
+            if self._rate is not None:
+                self._next_at = start + 1 / self._rate
+            else:
+                self._count_sent(now)
+            return wait
+
+    def _count_sent(self, now: float) -> None:
+        # must hold the lock
+        second = int(now)
+        if second != self._second:
+            self._sent = [self._sent[1] if second == self._second + 1 else 0,
+                          0]
+            self._second = second
+        self._sent[1] += 1
+
+    def _sent_rate(self, now: float) -> float:
+        # must hold the lock. Pushes a second, over the last whole second or
+        # the one under way, whichever had more
+        second = int(now)
+        if second == self._second:
+            return float(max(self._sent))
+        if second == self._second + 1:
+            return float(self._sent[1])
+        return 0.0
+
+    def record(self, ok: bool, latency: float,
+               wait: Optional[float] = None) -> None:
+        """Record how a push went. ok is whether the receiver took it in its
+        stride; wait is how long it asked to be left alone for, if it did
+        """
+        now = self.clock()
+        with self._lock:
+            if wait is not None:
+                self._blocked_until = max(
+                    self._blocked_until,
+                    now + min(wait, self.max_retry_after)
+                )
+            if not ok or latency >= self.slow_push or wait is not None:
+                self._cut(now)
+            elif self._rate is not None:
+                # a push every 1 / rate seconds, so this adds `increase`
+                # for every second of pushes that go well
+                self._rate += self.increase / self._rate
+                if self._rate >= self._ceiling:
+                    self._lift()
+                else:
+                    self._gauge.set(self._rate)
+
+    def _cut(self, now: float) -> None:
+        # must hold the lock. Pushes under way when the receiver started
+        # struggling all come back at about the same time, so only cut once
+        # a second rather than once for each of them
+        if now - self._last_cut < 1:
+            return
+        self._last_cut = now
+
+        if self._rate is None:
+            self._rate = max(self.min_rate, self._sent_rate(now))
+            self._ceiling = self._rate
+            self._next_at = now
+        self._rate = max(self.min_rate, self._rate * self.decrease)
+        self._gauge.set(self._rate)
+        rate_cuts.inc()
+        logging.warning(
+            f"Pushing to {self.endpoint} at no more than {self._rate:.1f} "
+            f"SETs a second"
+        )
+
+    def _lift(self) -> None:
+        # must hold the lock
+        self._rate = self.max_rate or None
+        self._gauge.set(self._rate or 0)
+        logging.info(f"Lifted the push rate limit for {self.endpoint}")
+
+    def health(self) -> Dict[str, object]:
+        now = self.clock()
+        with self._lock:
+            return {
+                "rate": self._rate,
+                "blocked_for": max(0.0, self._blocked_until - now),
+            }
+
+
+class RateLimiterRegistry:
+    """The rate limiter for each receiver origin"""
+
+    def __init__(self,
+                 make_limiter: Callable[[str], RateLimiter] = RateLimiter
+                 ) -> None:
+        self.make_limiter = make_limiter
+        self._lock = threading.Lock()
+        self._limiters: Dict[str, RateLimiter] = {}
+
+    def get(self, url: str) -> RateLimiter:
+        key = origin(url)
+        with self._lock:
+            limiter = self._limiters.get(key)
+            if limiter is None:
+                limiter = self._limiters[key] = self.make_limiter(key)
+            return limiter
+
+    def health(self) -> Dict[str, Dict[str, object]]:
+        """How every receiver pushed to so far is being paced"""
+        with self._lock:
+            limiters = list(self._limiters.values())
+        return {limiter.endpoint: limiter.health() for limiter in limiters}
+
+    def clear(self) -> None:
+        with self._lock:
+            self._limiters.clear()
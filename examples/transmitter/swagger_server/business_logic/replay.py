@@ -0,0 +1,166 @@
+# Copyright (c) 2021 Cisco Systems, Inc. and its affiliates
+# All rights reserved.
+# Use of this source code is governed by a BSD 3-Clause License
+# that can be found in the LICENSE file.
+
+"""
+Sends on the SETs that were held while a stream or subject was paused, once
+it is enabled again.
+
+Polled streams need nothing more than the SETs being released: the receiver
+polls them in order. For push streams the backlog is pushed here, a batch at
+a time. Within a batch, each subject's SETs are pushed one after another, in
+the order they were queued, while different subjects are pushed at the same
+time. The SETs receivers accept are acknowledged a batch at a time, too.
+
+SETs about a subject that are triggered during a replay aren't pushed
+straight away (see behind_earlier_SETs in stream.py). They wait for the
+subject's backlog, and the retry scheduler pushes them once it is through.
+"""
+
+from __future__ import annotations
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+import json
+import logging
+import os
+import threading
+import time
+from typing import TYPE_CHECKING, Callable, Dict, List, Optional, Set
+
+from swagger_server.business_logic import delivery, retention
+from swagger_server.business_logic.delivery import PushJob, Timeout
+import swagger_server.db as db
+from swagger_server.db import DueSET
+from swagger_server.events import SecurityEvent
+from swagger_server import metrics
+
+if TYPE_CHECKING:
+    from swagger_server.business_logic.stream import Stream
+
+
+held_SETs = metrics.counter(
+    "sets_held_total", "SETs held for paused streams or subjects"
+)
+released_SETs = metrics.counter(
+    "sets_released_total",
+    "Held SETs released once their stream or subject was enabled again"
+)
+replayed_SETs = metrics.counter(
+    "push_replayed_total", "Released SETs pushed to receivers"
+)
+
+
+def lease_until(now: Optional[float] = None) -> int:
+    """Until when a released backlog belongs to the replay pushing it. If
+    the replay hasn't got through it by then, e.g. because the process went
+    away, the retry scheduler pushes what is left
+    """
+    now = now if now is not None else time.time()
+    return int(now) + int(os.environ.get("PUSH_REPLAY_LEASE", 600))
+
+
+def _job_SET(due: DueSET) -> SecurityEvent:
+    # with a signed JWS to push, the SET itself is only needed for its jti,
+    # so don't pay for validating it. That's most of the work otherwise
+    if due.jws is None:
+        return due.SET
+    return SecurityEvent.construct(**json.loads(due.event))
+
+
+class Replayer:
+    """Pushes released backlogs, concurrency subjects at a time.
+
+    If a push fails, the rest of that subject's backlog is left for the retry
+    scheduler rather than being pushed ahead of it.
+    """
+
+    def __init__(self, concurrency: Optional[int] = None,
+                 batch_size: Optional[int] = None,
+                 deliver: Callable[[PushJob, Timeout], bool] =
+                 partial(delivery.deliver, ack=False)
+                 ) -> None:
+        self.concurrency = concurrency or int(os.environ.get(
+            "PUSH_REPLAY_CONCURRENCY",
+            os.environ.get("PUSH_MAX_PER_ENDPOINT", 4)
+        ))
+        self.batch_size = batch_size or int(
+            os.environ.get("PUSH_REPLAY_BATCH_SIZE", 500)
+        )
+        self.deliver = deliver
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._lock = threading.Lock()
+
+    def start(self, stream: Stream, released_at: int) -> threading.Thread:
+        """Replay a release in the background"""
+        thread = threading.Thread(
+            target=self.run, args=(stream, released_at),
+            name=f"replay-{stream.client_id}", daemon=True
+        )
+        thread.start()
+        return thread
+
+    def run(self, stream: Stream, released_at: int) -> int:
+        """Push every SET of the release, returning how many were accepted"""
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self.concurrency, thread_name_prefix="replay"
+                )
+            executor = self._executor
+
+        stalled: Set[Optional[str]] = set()
+        replayed = 0
+        while True:
+            batch = db.claim_released_SETs(
+                stream.client_id, released_at, self.batch_size,
+                delivery.lease_until()
+            )
+            if not batch:
+                break
+
+            lanes: Dict[Optional[str], List[DueSET]] = defaultdict(list)
+            for due in batch:
+                if due.subject not in stalled:
+                    lanes[due.subject].append(due)
+
+            pushing = {
+                subject: executor.submit(self._push_lane, stream, lane)
+                for subject, lane in lanes.items()
+            }
+            acked: List[str] = []
+            for subject, future in pushing.items():
+                pushed = future.result()
+                acked.extend(pushed)
+                if len(pushed) < len(lanes[subject]):
+                    stalled.add(subject)
+
+            if acked:
+                retention.record_acks(
+                    "push", db.ack_SETs(stream.client_id, acked)
+                )
+            replayed += len(acked)
+
+        replayed_SETs.inc(replayed)
+        return replayed
+
+    def _push_lane(self, stream: Stream, lane: List[DueSET]) -> List[str]:
+        """Push one subject's SETs in order, stopping at the first that
+        fails. Returns the jtis of those that were pushed
+        """
+        pushed: List[str] = []
+        for due in lane:
+            job = stream.push_job(_job_SET(due), due.jws, due.attempts,
+                                  due.subject)
+            try:
+                if not self.deliver(job, delivery.push_engine.timeout):
+                    break
+            except Exception:
+                logging.exception(f"Error replaying SET {due.jti}")
+                break
+            pushed.append(due.jti)
+        return pushed
+
+
+replayer = Replayer()
@@ -0,0 +1,196 @@
+# Copyright (c) 2021 Cisco Systems, Inc. and its affiliates
+# All rights reserved.
+# Use of this source code is governed by a BSD 3-Clause License
+# that can be found in the LICENSE file.
+
+"""
+How long SETs are kept, and how many, when a receiver doesn't poll for them.
+"""
+
+from __future__ import annotations
+import logging
+import os
+import threading
+import time
+from typing import Any, Dict, Iterable, NamedTuple, Optional
+
+import swagger_server.db as db
+from swagger_server.db import EnqueueResult, QueueFullPolicy
+from swagger_server import metrics
+
+
+expired_SETs = metrics.counter(
+    "sets_expired_total", "SETs deleted because they were too old"
+)
+dropped_SETs = metrics.counter(
+    "sets_dropped_total", "SETs deleted to make room in a full queue"
+)
+rejected_SETs = metrics.counter(
+    "sets_rejected_total", "SETs not queued because the queue was full"
+)
+superseded_SETs = metrics.counter(
+    "sets_superseded_total",
+    "SETs deleted because a newer SET about the same subject made them "
+    "obsolete"
+)
+ack_age = metrics.family(
+    metrics.Histogram, "set_ack_age_seconds",
+    "How long SETs waited, from being issued to being acknowledged, by "
+    "delivery method", ("delivery",), buckets=metrics.AGE_BUCKETS
+)
+
+
+def _queue_depths() -> Dict[str, int]:
+    """How many SETs are queued across every stream, and in the deepest
+    queue. Streams are known by their bearer tokens, which the metrics must
+    not give away, so no stream is named
+    """
+    depths = db.queue_depths().values()
+    return dict(all=sum(depths), deepest=max(depths, default=0))
+
+
+# counting every queue on every SET would cost more than it is worth, so
+# the depths are only read when scraped
+metrics.collected(
+    "set_queue_depth", "SETs queued, in every stream and in the deepest one",
+    "queues", _queue_depths
+)
+
+
+def _env_int(name: str) -> Optional[int]:
+    value = int(os.environ.get(name, 0))
+    return value if value > 0 else None
+
+
+class RetentionPolicy(NamedTuple):
+    """Limits on a stream's queue. A limit of None means there isn't one"""
+    # seconds a SET is kept after it is queued
+    max_age: Optional[int] = None
+    # how many SETs the queue can hold
+    max_depth: Optional[int] = None
+    # what to do with a new SET once the queue is full
+    on_full: Optional[QueueFullPolicy] = None
+
+    @classmethod
+    def from_env(cls) -> RetentionPolicy:
+        """The policy for every stream that doesn't have its own"""
+        return cls(
+            max_age=_env_int("SET_MAX_AGE"),
+            max_depth=_env_int("SET_MAX_QUEUE_DEPTH"),
+            on_full=QueueFullPolicy(
+                os.environ.get("SET_QUEUE_FULL_POLICY", "drop_oldest")
+            )
+        )
+
+    @classmethod
+    def from_data(cls, data: Dict[str, Any]) -> RetentionPolicy:
+        on_full = data.get("on_full")
+        return cls(
+            max_age=data.get("max_age"),
+            max_depth=data.get("max_depth"),
+            on_full=QueueFullPolicy(on_full) if on_full else None
+        )
+
+    def to_data(self) -> Dict[str, Any]:
+        return dict(
+            max_age=self.max_age,
+            max_depth=self.max_depth,
+            on_full=self.on_full.value if self.on_full else None
+        )
+
+    def override(self, other: Optional[RetentionPolicy]) -> RetentionPolicy:
+        """This policy, with any limits that other sets taking precedence"""
+        if other is None:
+            return self
+        return RetentionPolicy(
+            max_age=other.max_age or self.max_age,
+            max_depth=other.max_depth or self.max_depth,
+            on_full=other.on_full or self.on_full
+        )
+
+    def expires_at(self, now: Optional[float] = None) -> Optional[int]:
+        """When a SET queued now should expire"""
+        if self.max_age is None:
+            return None
+        return int(now if now is not None else time.time()) + self.max_age
+
+
+def record(result: EnqueueResult) -> None:
+    """Count the SETs that didn't fit in their queues, and those newer SETs
+    made obsolete
+    """
+    if result.dropped:
+        dropped_SETs.inc(result.dropped)
+    if result.rejected:
+        rejected_SETs.inc(len(result.rejected))
+    if result.superseded:
+        superseded_SETs.inc(result.superseded)
+
+
+def record_acks(delivery: str, issued_at: Iterable[int],
+                now: Optional[float] = None) -> None:
+    """Record how long the SETs issued at issued_at waited to be
+    acknowledged, either by being polled or pushed
+    """
+    now = now if now is not None else time.time()
+    histogram = ack_age.labels(delivery)
+    for iat in issued_at:
+        histogram.observe(max(0, now - iat))
+
+
+class Compactor:
+    """A background thread that deletes expired SETs and gives their space
+    back to the filesystem.
+
+    SETs are deleted in batches of batch_size, each in its own short
+    transaction, so that receivers polling and acknowledging SETs are only
+    ever held up for the length of one batch.
+    """
+
+    def __init__(self, interval: Optional[float] = None,
+                 batch_size: Optional[int] = None) -> None:
+        self.interval = interval if interval is not None else float(
+            os.environ.get("SET_COMPACTION_INTERVAL", 60)
+        )
+        self.batch_size = batch_size or int(
+            os.environ.get("SET_COMPACTION_BATCH_SIZE", 500)
+        )
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def run_once(self, now: Optional[int] = None) -> int:
+        """Delete every SET that has expired by now, returning how many"""
+        now = now if now is not None else int(time.time())
+        total = 0
+        while not self._stop.is_set():
+            expired = db.expire_SETs(now, self.batch_size)
+            expired_SETs.inc(expired)
+            total += expired
+            if expired < self.batch_size:
+                break
+
+        db.compact()
+        if total:
+            logging.info(f"Expired {total} SETs")
+        return total
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval):
+            try:
+                self.run_once()
+            except Exception:
+                logging.exception("Error compacting the SET queue")
+
+    def start(self) -> None:
+        if self.interval <= 0 or self._thread is not None:
+            return
+        self._thread = threading.Thread(
+            target=self._run, name="set-compactor", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
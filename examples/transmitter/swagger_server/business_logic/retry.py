@@ -0,0 +1,117 @@
+# Copyright (c) 2021 Cisco Systems, Inc. and its affiliates
+# All rights reserved.
+# Use of this source code is governed by a BSD 3-Clause License
+# that can be found in the LICENSE file.
+
+"""
+Retries pushes that failed, or that were never finished because the process
+pushing them went away.
+"""
+
+import logging
+import os
+import threading
+import time
+from typing import Dict, Optional
+
+from swagger_server.business_logic import delivery
+from swagger_server.business_logic.stream import Stream
+import swagger_server.db as db
+from swagger_server.errors import StreamDoesNotExist
+from swagger_server.models import Status
+from swagger_server import metrics
+
+
+retried_SETs = metrics.counter(
+    "push_retries_total", "SETs handed back to the delivery engine to retry"
+)
+retry_lag = metrics.gauge(
+    "push_retry_lag_seconds",
+    "How overdue the most overdue retry was when it was last picked up"
+)
+
+
+class RetryScheduler:
+    """A background thread that hands SETs whose next push attempt is due
+    back to the delivery engine.
+
+    Each run claims at most batch_size SETs, and no more than the engine has
+    room for, through an index on next_attempt_at. However large the backlog
+    gets, a run costs one small indexed query and a bounded amount of work.
+    """
+
+    def __init__(self, interval: Optional[float] = None,
+                 batch_size: Optional[int] = None) -> None:
+        self.interval = interval if interval is not None else float(
+            os.environ.get("PUSH_RETRY_INTERVAL", 1)
+        )
+        self.batch_size = batch_size or int(
+            os.environ.get("PUSH_RETRY_BATCH_SIZE", 100)
+        )
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def run_once(self, now: Optional[int] = None) -> int:
+        """Retry the SETs that are due by now, returning how many"""
+        now = now if now is not None else int(time.time())
+        limit = min(self.batch_size, delivery.push_engine.spare_capacity)
+        if not limit:
+            return 0
+
+        due = db.claim_due_SETs(now, limit, delivery.lease_until(now))
+        if not due:
+            retry_lag.set(0)
+            return 0
+        retry_lag.set(now - min(d.next_attempt_at for d in due))
+
+        streams: Dict[str, Optional[Stream]] = {}
+        retried = 0
+        for claimed in due:
+            if claimed.client_id not in streams:
+                try:
+                    streams[claimed.client_id] = Stream.load(claimed.client_id)
+                except StreamDoesNotExist:
+                    streams[claimed.client_id] = None
+
+            stream = streams[claimed.client_id]
+            if stream is not None and stream.status == Status.paused:
+                # held, to be replayed with the stream's other held SETs
+                # once it is enabled. If it has been enabled since this
+                # process last loaded it, it is left leased instead, and
+                # retried once the lease is up
+                db.hold_SET(claimed.client_id, claimed.jti)
+                continue
+            if stream is None or not stream.is_push() or \
+                    stream.status == Status.disabled:
+                # the stream has gone, switched to polling or been disabled
+                db.reschedule_SET(claimed.client_id, claimed.jti,
+                                  claimed.attempts, None)
+                continue
+
+            if stream.push(claimed.SET, claimed.jws, claimed.attempts,
+                           claimed.subject):
+                retried += 1
+
+        retried_SETs.inc(retried)
+        return retried
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval):
+            try:
+                self.run_once()
+            except Exception:
+                logging.exception("Error retrying pushes")
+
+    def start(self) -> None:
+        if self.interval <= 0 or self._thread is not None:
+            return
+        self._thread = threading.Thread(
+            target=self._run, name="push-retries", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
@@ -0,0 +1,101 @@
+# Copyright (c) 2021 Cisco Systems, Inc. and its affiliates
+# All rights reserved.
+# Use of this source code is governed by a BSD 3-Clause License
+# that can be found in the LICENSE file.
+
+"""
+Keep-alive HTTP connections to receivers, so that pushing a SET doesn't cost
+a fresh TCP connection and TLS handshake every time.
+"""
+
+import os
+import threading
+import time
+from typing import Callable, Dict, Optional, Tuple
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+
+def origin(url: str) -> str:
+    """scheme://host:port, the unit connections can be shared within"""
+    parts = urlsplit(url)
+    return f"{parts.scheme}://{parts.netloc}".lower()
+
+
+class SessionPool:
+    """A requests.Session per receiver origin, each with its own pool of up
+    to pool_size keep-alive connections. Streams that push to the same
+    receiver host share its connections.
+
+    A session that hasn't been used for idle_timeout seconds is closed, so
+    receivers that have gone quiet don't hold on to sockets. An idle_timeout
+    of 0 turns keep-alive off: every push gets a new connection.
+    """
+
+    def __init__(self, pool_size: Optional[int] = None,
+                 idle_timeout: Optional[float] = None,
+                 clock: Callable[[], float] = time.monotonic) -> None:
+        self.pool_size = pool_size or int(os.environ.get(
+            "PUSH_POOL_SIZE", os.environ.get("PUSH_MAX_PER_ENDPOINT", 4)
+        ))
+        self.idle_timeout = idle_timeout if idle_timeout is not None else \
+            float(os.environ.get("PUSH_KEEPALIVE_TIMEOUT", 60))
+        self.clock = clock
+
+        self._lock = threading.Lock()
+        # origin -> (last used, session)
+        self._sessions: Dict[str, Tuple[float, requests.Session]] = {}
+        self._next_sweep = 0.0
+
+    @property
+    def keepalive(self) -> bool:
+        return self.idle_timeout > 0
+
+    def _new_session(self) -> requests.Session:
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        if not self.keepalive:
+            session.headers["Connection"] = "close"
+        return session
+
+    def post(self, url: str, **kwargs) -> requests.Response:
+        """POST using the shared session for the URL's origin"""
+        if not self.keepalive:
+            with self._new_session() as session:
+                return session.post(url, **kwargs)
+        return self.session(url).post(url, **kwargs)
+
+    def session(self, url: str) -> requests.Session:
+        key = origin(url)
+        now = self.clock()
+        with self._lock:
+            self._evict_idle(now)
+            entry = self._sessions.get(key)
+            session = entry[1] if entry else self._new_session()
+            self._sessions[key] = (now, session)
+            return session
+
+    def _evict_idle(self, now: float) -> None:
+        # must hold the lock. Sweeping at most once a second keeps this
+        # off the hot path
+        if now < self._next_sweep:
+            return
+        self._next_sweep = now + 1
+
+        for key, (last_used, session) in list(self._sessions.items()):
+            if now - last_used > self.idle_timeout:
+                del self._sessions[key]
+                session.close()
+
+    def __len__(self) -> int:
+        return len(self._sessions)
+
+    def close(self) -> None:
+        with self._lock:
+            sessions, self._sessions = self._sessions, {}
+        for _, session in sessions.values():
+            session.close()
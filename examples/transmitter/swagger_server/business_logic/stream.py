@@ -4,28 +4,40 @@
 # that can be found in the LICENSE file.
 
 from __future__ import annotations
-from typing import Dict, List, Union, Any, Optional
+from typing import (
+    Callable, Dict, List, Set, Tuple, Union, Any, Optional
+)
+import copy
 import json
 import logging
-
-import requests
-from requests.exceptions import RequestException
+import os
+import time
 
 from swagger_server.business_logic.const import (
     MIN_VERIFICATION_INTERVAL, POLL_ENDPOINT, TRANSMITTER_ISSUER
 )
+from swagger_server.business_logic import (
+    breaker, delivery, replay, retention
+)
+from swagger_server.business_logic.delivery import PushJob
+from swagger_server.business_logic.retention import RetentionPolicy
 from swagger_server.events import (
     SecurityEvent, SUPPORTED_EVENTS
 )
+from swagger_server.cache import TTLCache
 import swagger_server.db as db
+from swagger_server.db import PendingSET, QueuedSET
 from swagger_server import jwt_encode
+from swagger_server import metrics
 from swagger_server.models import (
     Email, PollDeliveryMethod, PushDeliveryMethod,
     StreamConfiguration, Status, Subject
 )
-from swagger_server.errors import EmailSubjectNotFound, SubjectNotInStream
+from swagger_server.errors import (
+    EmailSubjectNotFound, QueueFull, StreamDoesNotExist
+)
 
-from swagger_server.utils import get_simple_subject
+from swagger_server.utils import env_flag, get_simple_subject
 
 DEFAULT_CONFIG = StreamConfiguration(
     iss=TRANSMITTER_ISSUER,
@@ -37,6 +49,117 @@ DEFAULT_CONFIG = StreamConfiguration(
     delivery=PollDeliveryMethod(endpoint_url=POLL_ENDPOINT)
 )
 
+
+def sign_on_enqueue() -> bool:
+    """Should SETs be signed once when they are queued, rather than every
+    time they are polled?
+    """
+    return env_flag("SIGN_ON_ENQUEUE")
+
+
+def sign_pending(pending: List[PendingSET]) -> List[PendingSET]:
+    """Sign the SETs that aren't signed yet in one batch, which is spread
+    over the signing pool if it is large enough.
+
+    Streams with the same iss and aud share one copy of a broadcast SET (see
+    process_SET), so each copy is signed once and its JWS given to all of
+    them
+    """
+    groups: Dict[int, List[int]] = {}
+    SETs: List[SecurityEvent] = []
+    for i, queued in enumerate(pending):
+        if queued.jws is None:
+            group = groups.setdefault(id(queued.SET), [])
+            if not group:
+                SETs.append(queued.SET)
+            group.append(i)
+    if not groups:
+        return pending
+    signed = list(pending)
+    jwss = jwt_encode.encode_sets(SETs)
+    for group, jws in zip(groups.values(), jwss):
+        for i in group:
+            signed[i] = signed[i]._replace(jws=jws)
+    return signed
+
+
+def behind_earlier_SETs(queued: List[PendingSET]) -> Set[Tuple[str, str]]:
+    """The (client_id, jti) of the queued SETs that mustn't be pushed yet,
+    because an earlier SET about the same subject is still to be pushed,
+    being retried, held or being replayed. They are left to the retry
+    scheduler, which pushes them once the earlier ones are done. The delivery
+    engine keeps order among the pushes it has in hand, but not with SETs
+    waiting in the database
+    """
+    about_subjects = [
+        (pending.client_id, pending.SET.jti)
+        for pending in queued if pending.subject is not None
+    ]
+    if not about_subjects:
+        return set()
+    return set(db.defer_SETs(about_subjects, int(time.time())))
+
+
+def audience_key(iss: Optional[str],
+                 aud: Union[str, List[str], None]) -> Tuple[Any, ...]:
+    """What the copies of a SET for different streams differ by"""
+    if isinstance(aud, list):
+        return (iss, tuple(aud))
+    return (iss, aud)
+
+
+# Loaded streams, keyed by client_id. Every write to a stream in this process
+# invalidates its entry; the TTL bounds how stale an entry can get when
+# another process writes to the stream instead.
+stream_cache: TTLCache[str, Stream] = TTLCache(
+    maxsize=int(os.environ.get("STREAM_CACHE_SIZE", 1024)),
+    ttl=float(os.environ.get("STREAM_CACHE_TTL", 30)),
+)
+
+# client_ids (i.e. bearer tokens) that have no stream. Kept apart from
+# stream_cache so that a flood of bad tokens can't evict the good ones.
+unknown_stream_cache: TTLCache[str, bool] = TTLCache(
+    maxsize=int(os.environ.get("UNKNOWN_STREAM_CACHE_SIZE", 4096)),
+    ttl=float(os.environ.get("UNKNOWN_STREAM_CACHE_TTL", 5)),
+)
+
+stream_caches: Dict[str, TTLCache[str, Any]] = {
+    "stream": stream_cache,
+    "unknown_stream": unknown_stream_cache,
+}
+
+
+def _cache_stat(stat: str) -> Callable[[], Dict[str, float]]:
+    def collect() -> Dict[str, float]:
+        return {
+            name: cache.stats()[stat] for name, cache in stream_caches.items()
+        }
+    return collect
+
+
+metrics.collected(
+    "stream_cache_size", "Entries in each stream cache", "cache",
+    _cache_stat("size")
+)
+metrics.collected(
+    "stream_cache_hits_total", "Lookups each stream cache answered",
+    "cache", _cache_stat("hits"), metrics.Counter
+)
+metrics.collected(
+    "stream_cache_misses_total", "Lookups each stream cache couldn't answer",
+    "cache", _cache_stat("misses"), metrics.Counter
+)
+metrics.collected(
+    "stream_cache_evictions_total",
+    "Entries each stream cache dropped to make room",
+    "cache", _cache_stat("evictions"), metrics.Counter
+)
+metrics.collected(
+    "stream_cache_expirations_total",
+    "Entries each stream cache dropped once their TTL was up",
+    "cache", _cache_stat("expirations"), metrics.Counter
+)
+
 READ_ONLY_CONFIG_FIELDS = {
     'iss',
     'aud',
@@ -55,6 +178,8 @@ class Stream:
         self.client_id = client_id
         self.config = DEFAULT_CONFIG.copy(update={'aud': aud})
         self.status = status
+        # overrides the retention policy from the environment
+        self.retention: Optional[RetentionPolicy] = None
 
         if save:
             self.save()
@@ -65,11 +190,46 @@ class Stream:
             config=self.config.dict(),
             status=self.status.value
         )
-        db.save_stream(self.client_id, json.dumps(stream_data))
+        if self.retention is not None:
+            stream_data["retention"] = self.retention.to_data()
+        db.save_stream(self.client_id, json.dumps(stream_data), self.status)
+        stream_cache.invalidate(self.client_id)
+        unknown_stream_cache.invalidate(self.client_id)
 
     @classmethod
     def load(cls, client_id: str) -> Stream:
-        stream_data = db.load_stream(client_id)
+        """Load a stream, raising StreamDoesNotExist if there isn't one.
+        Both outcomes are cached
+        """
+        cached = stream_cache.get(client_id)
+        if cached is not None:
+            return cached.copy()
+
+        if unknown_stream_cache.get(client_id):
+            raise StreamDoesNotExist()
+
+        epoch = stream_cache.epoch()
+        unknown_epoch = unknown_stream_cache.epoch()
+        try:
+            stream = cls.from_data(db.load_stream(client_id))
+        except StreamDoesNotExist:
+            unknown_stream_cache.put(client_id, True, unknown_epoch)
+            raise
+
+        stream_cache.put(client_id, stream.copy(), epoch)
+        return stream
+
+    def copy(self) -> Stream:
+        """Make a copy that can be changed without affecting this stream.
+        Configs are never changed in place, so a shallow copy is enough
+        """
+        new_stream = copy.copy(self)
+        new_stream.config = self.config.copy()
+        return new_stream
+
+    @classmethod
+    def from_data(cls, stream_data: Dict[str, Any]) -> Stream:
+        """Build a stream from the data saved in the database"""
         new_stream = cls(
             client_id=stream_data["client_id"],
             aud=stream_data["config"]["aud"],
@@ -80,6 +240,10 @@ class Stream:
             StreamConfiguration(**stream_data["config"]),
             save=False
         )
+        if stream_data.get("retention"):
+            new_stream.retention = RetentionPolicy.from_data(
+                stream_data["retention"]
+            )
         return new_stream
 
     def delete(self) -> None:
@@ -89,6 +253,7 @@ class Stream:
         """
         db.delete_SETs(self.client_id)
         db.delete_subjects(self.client_id)
+        stream_cache.invalidate(self.client_id)
 
         # revert the stream to the default config
         audience = self.config.aud
@@ -118,8 +283,44 @@ class Stream:
     def get_subject_status(self, email_address: str) -> Status:
         return db.get_subject_status(self.client_id, email_address)
 
+    def update_status(self, status: Status) -> None:
+        """Set the stream's status. SETs held while it was paused are sent
+        on once it is enabled, and dropped if it is disabled
+        """
+        self.status = status
+        self.save()
+        if status == Status.enabled:
+            self.release_held_SETs()
+        elif status == Status.disabled:
+            db.drop_held_SETs(self.client_id)
+
     def set_subject_status(self, email_address: str, status: Status) -> None:
+        """Set a subject's status. As with the stream's status, SETs held
+        about the subject are sent on or dropped accordingly
+        """
         db.set_subject_status(self.client_id, email_address, status)
+        if status == Status.enabled and self.status == Status.enabled:
+            self.release_held_SETs(email_address)
+        elif status == Status.disabled:
+            db.drop_held_SETs(self.client_id, email_address)
+
+    def release_held_SETs(self, email_address: Optional[str] = None) -> int:
+        """Send on the SETs held about a subject, or about every subject
+        that isn't paused itself. Polled streams just see them in their next
+        poll; push streams have them replayed in the background
+        """
+        if not self.is_push():
+            released = db.release_SETs(self.client_id, email_address)
+        else:
+            released_at = replay.lease_until()
+            released = db.release_SETs(
+                self.client_id, email_address, released_at
+            )
+            if released:
+                replay.replayer.start(self, released_at)
+
+        replay.released_SETs.inc(released)
+        return released
 
     def add_subject(self, email_address: str) -> None:
         db.add_subject(self.client_id, email_address)
@@ -127,69 +328,175 @@ class Stream:
     def remove_subject(self, email_address: str) -> None:
         db.remove_subject(self.client_id, email_address)
 
-    def process_SET(self, SET: SecurityEvent) -> None:
-        """Either push the SET or add it to the queue"""
+    def process_SET(
+            self, SET: SecurityEvent,
+            pending: Optional[List[PendingSET]] = None,
+            email_address: Optional[str] = None,
+            held: bool = False,
+            copies: Optional[Dict[Tuple[Any, ...], SecurityEvent]] = None
+    ) -> None:
+        """Add the SET to the queue and, for push streams, hand it to the
+        delivery engine. If a pending list is passed in, the SET is appended
+        to it instead, unsigned, so the caller can sign them all in one go
+        with sign_pending and write them in one go with db.add_sets, then
+        push the ones for push streams.
+
+        email_address is the subject the SET is about, if any. The SET is
+        held rather than sent if the subject is paused (held) or the stream
+        is paused.
+
+        copies holds the copies of the SET made for other streams, keyed by
+        audience_key. A stream with the same iss and aud as one of them uses
+        that copy rather than making its own, so sign_pending signs it once
+        for all of them. Copies must not be changed once made
+        """
         # make sure the SET is appropriate for this stream
-        SET = SET.copy(deep=True)
-        SET.iss = self.config.iss
-        SET.aud = self.config.aud
+        key = audience_key(self.config.iss, self.config.aud)
+        stream_SET = copies.get(key) if copies is not None else None
+        if stream_SET is None:
+            stream_SET = SET.copy(deep=True)
+            stream_SET.iss = self.config.iss
+            stream_SET.aud = self.config.aud
+            if copies is not None:
+                copies[key] = stream_SET
+        SET = stream_SET
+
+        held = held or self.status == Status.paused
+        if pending is not None:
+            pending.append(
+                self.pending_SET(SET, None, email_address, held, sign=False)
+            )
+            return
 
-        # push or add to queue
-        if isinstance(self.config.delivery, PushDeliveryMethod):
-            self.push(SET)
-        else:
-            self.queue_SET(SET)
+        queued = self.queue_SET(SET, None, email_address, held)
+        if self.is_push() and not held and not behind_earlier_SETs([queued]):
+            self.push(queued.SET, queued.jws, subject=email_address)
 
-    def push(self, SET: SecurityEvent, save_on_error=True) -> bool:
-        """Push a SET to the push endpoint. If error pushing and save_on_error
-        is True, send SET to queue to be pushed by scheduled job
+    def is_push(self) -> bool:
+        return isinstance(self.config.delivery, PushDeliveryMethod)
+
+    def push(self, SET: SecurityEvent, jws: Optional[str] = None,
+             attempts: int = 0, subject: Optional[str] = None) -> bool:
+        """Hand a SET that is already queued to the delivery engine, which
+        acknowledges it once the push endpoint accepts it. Returns False if
+        the engine turned it away, or the receiver is known to be down, in
+        which case it stays queued.
+
+        subject is the email address the SET is about, if any. SETs about
+        the same subject are pushed in the order they are handed over
         """
+        if not delivery.breakers.get(
+                self.config.delivery.endpoint_url).available():
+            breaker.short_circuits.inc()
+            return False
 
-        headers = {
-            "Content-Type": "application/secevent+jwt",
-            "Accept": "application/json"
-        }
+        return delivery.push_engine.submit(
+            self.push_job(SET, jws, attempts, subject)
+        )
 
-        if self.config.delivery.authorization_header:
-            headers["Authorization"] = \
-                self.config.delivery.authorization_header
+    def push_job(self, SET: SecurityEvent, jws: Optional[str] = None,
+                 attempts: int = 0,
+                 subject: Optional[str] = None) -> PushJob:
+        return PushJob(
+            client_id=self.client_id,
+            endpoint_url=self.config.delivery.endpoint_url,
+            authorization_header=self.config.delivery.authorization_header,
+            SET=SET,
+            jws=jws,
+            attempts=attempts,
+            subject=subject
+        )
 
-        try:
-            response = requests.post(
-                self.config.delivery.endpoint_url,
-                data=jwt_encode.encode_set(SET),
-                headers=headers
-            )
+    def set_retention(self, policy: Optional[RetentionPolicy]) -> None:
+        """Override the retention policy from the environment for this
+        stream. Only SETs queued from now on are affected
+        """
+        self.retention = policy
+        self.save()
 
-            response.raise_for_status()
-            return True
-        except RequestException as err:
-            logging.error(
-                f"Error pushing SET {SET.jti} to "
-                f"{self.config.delivery.endpoint_url}: {err}."
-                f"Queuing SET to be picked up by scheduled job instead."
-            )
-            if save_on_error:
-                self.queue_SET(SET)
+    def retention_policy(self) -> RetentionPolicy:
+        return RetentionPolicy.from_env().override(self.retention)
 
-            return False
+    def pending_SET(self, SET: SecurityEvent,
+                    jws: Optional[str] = None,
+                    email_address: Optional[str] = None,
+                    held: bool = False, sign: bool = True) -> PendingSET:
+        """Get a SET ready to be queued, signing it now if configured to,
+        unless the caller is to sign it along with others (sign=False)
+        """
+        if jws is None and sign and sign_on_enqueue():
+            jws = jwt_encode.encode_set(SET)
+
+        policy = self.retention_policy()
+        return PendingSET(
+            self.client_id, SET, jws,
+            expires_at=policy.expires_at(),
+            max_depth=policy.max_depth,
+            on_full=policy.on_full or db.QueueFullPolicy.drop_oldest,
+            # if this process goes away before the push is done, the retry
+            # scheduler picks the SET up once the lease is up
+            next_attempt_at=(
+                delivery.lease_until()
+                if self.is_push() and not held else None
+            ),
+            subject=email_address,
+            held=held,
+            # newer SETs about the subject may make older ones obsolete
+            event_type=(
+                SET.events.event_type() if email_address is not None else None
+            ),
+            supersedes=(
+                SET.events.supersedes() if email_address is not None else ()
+            ),
+            subject_key=(
+                SET.events.subject_key() if email_address is not None
+                else None
+            )
+        )
 
-    def queue_SET(self, SET: SecurityEvent) -> None:
-        db.add_set(self.client_id, SET)
+    def queue_SET(self, SET: SecurityEvent,
+                  jws: Optional[str] = None,
+                  email_address: Optional[str] = None,
+                  held: bool = False) -> PendingSET:
+        """Add a SET to the queue, raising QueueFull if it won't fit"""
+        queued = self.pending_SET(SET, jws, email_address, held)
+        result = db.add_sets([queued])
+        retention.record(result)
+        if result.rejected:
+            raise QueueFull()
+        replay.held_SETs.inc(held)
+        return queued
 
     def get_SETs(self,
                  max_events: Optional[int] = None) -> List[SecurityEvent]:
-        return db.get_SETs(self.client_id, max_events)
+        return [
+            queued.SET for queued in db.get_SETs(self.client_id, max_events)
+        ]
+
+    def get_SET_page(self, max_events: Optional[int] = None,
+                     after: int = 0) -> Tuple[List[QueuedSET], bool]:
+        """Get the next page of SETs after the sequence number `after`, and
+        whether there are more SETs waiting after this page
+        """
+        if max_events is None:
+            return db.get_SETs(self.client_id, after=after), False
+
+        # ask for one extra SET to find out if there are any more
+        page = db.get_SETs(self.client_id, max_events + 1, after)
+        return page[:max_events], len(page) > max_events
 
     def count_SETs(self) -> int:
         return db.count_SETs(self.client_id)
 
     def ack_SETs(self, jtis: List[str]) -> None:
-        db.delete_SETs(self.client_id, jtis)
+        retention.record_acks("poll", db.ack_SETs(self.client_id, jtis))
 
     @staticmethod
-    def broadcast_SET(SET: SecurityEvent) -> None:
-        """Send an event to every stream"""
+    def broadcast_SET(SET: SecurityEvent, redelivery: bool = False) -> None:
+        """Send an event to every stream. If it may have been broadcast
+        before (redelivery), streams that still have it queued are left
+        alone, so they don't end up with it twice
+        """
         # these cannot be verification events
         if SET.events.verification is not None:
             raise ValueError("Cannot broadcast Verification Events")
@@ -204,20 +511,59 @@ class Stream:
         if not simple_subj:
             raise EmailSubjectNotFound(subject)
 
-        # broadcast to each stream
-        for client_id in db.get_stream_ids():
-            _stream = Stream.load(client_id)
-
-            # only transmit if the stream and subject are both enabled
-            if _stream.status != Status.enabled:
-                continue
-
-            try:
-                subject_status = _stream.get_subject_status(simple_subj.email)
-            except SubjectNotInStream:
-                subject_status = Status.disabled
-
-            if subject_status != Status.enabled:
-                continue
+        # broadcast to each stream where the stream and subject are both
+        # enabled, and hold it for those where either is paused. The
+        # database does the filtering for us.
+        pending: List[PendingSET] = []
+        push_streams: Dict[str, Stream] = {}
+        # one copy of the SET, and so one signature, for each iss and aud
+        copies: Dict[Tuple[Any, ...], SecurityEvent] = {}
+        for stream_data, subject_status in \
+                db.get_subject_subscriptions(simple_subj.email):
+            # built from the row rather than taken from stream_cache, which
+            # can be behind a change another process made
+            _stream = Stream.from_data(stream_data)
+            _stream.process_SET(SET, pending, simple_subj.email,
+                                subject_status == Status.paused, copies)
+            if _stream.is_push():
+                push_streams[_stream.client_id] = _stream
+
+        if sign_on_enqueue():
+            pending = sign_pending(pending)
+
+        # queue up the SETs for every stream in one transaction
+        result = db.add_sets(pending, skip_duplicates=redelivery)
+        retention.record(result)
+        replay.held_SETs.inc(
+            sum(queued.held for queued in pending) -
+            sum(rejected.held for rejected in result.rejected) -
+            sum(duplicate.held for duplicate in result.duplicates)
+        )
+        for rejected in result.rejected:
+            logging.warning(
+                f"Queue for stream {rejected.client_id} is full. "
+                f"Dropping SET {rejected.SET.jti}."
+            )
 
-            _stream.process_SET(SET)
+        # then push the ones that made it into a push stream's queue
+        # (SETs that were already queued are being pushed already)
+        skipped_ids = {
+            skipped.client_id
+            for skipped in result.rejected + result.duplicates
+        }
+        to_push = [
+            queued for queued in pending
+            if queued.client_id in push_streams and not queued.held and
+            queued.client_id not in skipped_ids
+        ]
+        deferred = behind_earlier_SETs(to_push)
+        to_push = [
+            queued for queued in to_push
+            if (queued.client_id, queued.SET.jti) not in deferred
+        ]
+        # signed here in one batch, rather than one at a time by the push
+        # workers
+        for queued in sign_pending(to_push):
+            push_streams[queued.client_id].push(
+                queued.SET, queued.jws, subject=queued.subject
+            )
@@ -12,16 +12,18 @@ from typing import Dict, Any
 
 from werkzeug.exceptions import Unauthorized
 
-from swagger_server import db
-from swagger_server.errors import StreamDoesNotExist
+from swagger_server.business_logic.stream import Stream
 
 
 def check_BearerAuth(token: str) -> Dict[str, Any]:
     """Get the client ID from the dict of known tokens. Raise an error if
-    token is unknown
+    token is unknown.
+
+    Loading the stream caches it, along with unknown tokens, so the business
+    logic's own Stream.load for this request is a cache hit and at most one
+    database read is made per request.
     """
-    if not db.stream_exists(token):
-        raise StreamDoesNotExist()
+    Stream.load(token)
 
     return {
         'client_id': token,
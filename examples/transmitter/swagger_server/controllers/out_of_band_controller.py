@@ -6,10 +6,11 @@
 from typing import Dict, Any, Tuple, Union, List
 
 import connexion
-from connexion import NoContent
 
 from swagger_server import business_logic
-from swagger_server.models import RegisterParameters, TriggerEventParameters
+from swagger_server.models import (
+    RegisterParameters, TriggerEventParameters, TriggerEventResponse
+)
 
 
 def register() -> Tuple[Dict[str, str], int]:
@@ -26,6 +27,6 @@ def register() -> Tuple[Dict[str, str], int]:
 def trigger_event() -> Tuple[Any, int]:
     body = TriggerEventParameters.parse_obj(connexion.request.get_json())
 
-    business_logic.trigger_event(event_type=body.event_type,
-                                 subject=body.subject)
-    return NoContent, 200
+    event_id = business_logic.trigger_event(event_type=body.event_type,
+                                            subject=body.subject)
+    return TriggerEventResponse(event_id=event_id), 202
@@ -8,8 +8,10 @@ from typing import Dict, Any, Optional, Tuple, Union
 
 import connexion
 from connexion import NoContent
+from flask import Response
 
 from swagger_server import business_logic
+from swagger_server import documents
 from swagger_server.models import AddSubjectParameters  # noqa: E501
 from swagger_server.models import RemoveSubjectParameters  # noqa: E501
 from swagger_server.models import StreamConfiguration  # noqa: E501
@@ -17,7 +19,6 @@ from swagger_server.models import Subject  # noqa: E501
 from swagger_server.models import UpdateStreamStatus  # noqa: E501
 from swagger_server.models import VerificationParameters  # noqa: E501
 from swagger_server.models import StreamStatus
-from swagger_server.models import TransmitterConfiguration
 
 
 log = logging.getLogger(__name__)
@@ -129,24 +130,22 @@ def verification_request(token_info: Dict[str, str]) -> Tuple[Any, int]:  # noqa
     return NoContent, 204
 
 
-def _well_known_ssf_configuration_get() -> Tuple[TransmitterConfiguration, int]:  # noqa: E501
+def _well_known_ssf_configuration_get() -> Response:  # noqa: E501
     """Transmitter Configuration Request (without path)
 
     Return Transmitter Configuration information. # noqa: E501
     """
-    config = business_logic._well_known_ssf_configuration_get(
-        connexion.request.url_root
-    )
+    config = documents.configuration_document(connexion.request.url_root)
 
-    return config, 200
+    return documents.respond(config, documents.configuration_max_age())
 
 
-def _well_known_ssf_configuration_issuer_get(issuer: str) -> Tuple[TransmitterConfiguration, int]:  # noqa: E501
+def _well_known_ssf_configuration_issuer_get(issuer: str) -> Response:  # noqa: E501
     """Transmitter Configuration Request (with path)
 
     Return Transmitter Configuration information (with support for specifying an issuer). # noqa: E501
     """
-    config = business_logic._well_known_ssf_configuration_get(
-        connexion.request.url_root, issuer=issuer
+    config = documents.configuration_document(
+        connexion.request.url_root, issuer
     )
-    return config, 200
+    return documents.respond(config, documents.configuration_max_age())
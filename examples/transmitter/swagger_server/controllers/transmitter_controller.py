@@ -5,8 +5,10 @@
 from typing import Dict, List, Any, Tuple, Union
 
 import connexion
+from flask import Response
 
 from swagger_server import business_logic
+from swagger_server import documents
 from swagger_server import jwt_encode
 from swagger_server.models import PollParameters
 
@@ -17,24 +19,37 @@ def poll_events(token_info: Dict[str, str]) -> Tuple[Dict[str, Any], int]:
     client_id = token_info['client_id']
     body = PollParameters.parse_obj(connexion.request.get_json())
 
-    events, more_available = business_logic.poll_request(
-        body.maxEvents, body.returnImmediately, body.acks, client_id
+    queued_SETs, more_available, cursor = business_logic.poll_request(
+        body.maxEvents, body.returnImmediately, body.acks, client_id,
+        cursor=body.cursor
     )
 
+    # SETs that were signed when they were queued are returned as-is,
+    # without parsing or signing them again. The rest are signed in one
+    # batch, which is spread over the signing pool if it is large enough
+    unsigned = [queued for queued in queued_SETs if queued.jws is None]
+    signed = dict(zip(
+        (queued.jti for queued in unsigned),
+        jwt_encode.encode_sets([queued.SET for queued in unsigned])
+    ))
     set_events = {
         'sets': {
-            event.jti: jwt_encode.encode_set(event) for event in events
+            queued.jti: queued.jws or signed[queued.jti]
+            for queued in queued_SETs
         },
         'moreAvailable': more_available
     }
+    if cursor is not None:
+        set_events['cursor'] = cursor
 
     return set_events, 200
 
 
-def jwks_json() -> Tuple[Dict[str, Any], int]:
+def jwks_json() -> Response:
     """
     :return: JSON Web Key Set for our Event Transmitter
     """
-    # Export the JWKS _without_ the private keys used to encode the SETs
-    jwks = jwt_encode.load_jwks().export(private_keys=False, as_dict=True)
-    return jwks, 200
+    # Export the JWKS _without_ the private keys used to encode the SETs.
+    # It is serialized once for each load of the keys
+    return documents.respond(documents.jwks_document(),
+                             documents.jwks_max_age())
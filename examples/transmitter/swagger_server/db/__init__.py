@@ -0,0 +1,264 @@
+# Copyright (c) 2021 Cisco Systems, Inc. and its affiliates
+# All rights reserved.
+# Use of this source code is governed by a BSD 3-Clause License
+# that can be found in the LICENSE file.
+
+"""
+Persistence for the transmitter. The storage engine is picked once, at
+startup, by `create` (see `DB_BACKEND` in the README); the functions in this
+module hand everything off to it.
+"""
+
+import os
+import threading
+from typing import Any, Dict, List, Optional, Tuple
+
+from swagger_server.db.base import (
+    DueSET, DuplicateSET, EnqueueResult, OutboxEvent, PendingSET, QueuedSET,
+    QueueFullPolicy, StorageBackend
+)
+from swagger_server.db.memory import MemoryBackend
+from swagger_server.db.sharded import ShardedSQLiteBackend
+from swagger_server.db.sqlite import SQLiteBackend
+from swagger_server.events import SecurityEvent
+from swagger_server.models import Status
+
+
+_backend: Optional[StorageBackend] = None
+_backend_lock = threading.Lock()
+
+
+def make_backend() -> StorageBackend:
+    """Make the storage engine chosen by the environment"""
+    name = os.environ.get("DB_BACKEND", "sqlite").lower()
+    if name == "sqlite":
+        n_shards = int(os.environ.get("DB_SHARDS", 1))
+        if n_shards > 1:
+            return ShardedSQLiteBackend(os.environ["DB_PATH"], n_shards)
+        return SQLiteBackend(os.environ["DB_PATH"])
+    elif name == "memory":
+        return MemoryBackend()
+    else:
+        raise ValueError(f"Unknown DB_BACKEND: {name}")
+
+
+def get_backend() -> StorageBackend:
+    """The storage engine in use, making it first if need be"""
+    global _backend
+    if _backend is None:
+        with _backend_lock:
+            if _backend is None:
+                _backend = make_backend()
+    return _backend
+
+
+def create(drop: bool = False) -> None:
+    """Pick the storage engine from the environment and set it up"""
+    global _backend
+    with _backend_lock:
+        if _backend is not None:
+            _backend.close()
+        _backend = make_backend()
+    _backend.create(drop)
+
+
+def close() -> None:
+    """Release the storage engine's resources, e.g. at shutdown"""
+    global _backend
+    with _backend_lock:
+        if _backend is not None:
+            _backend.close()
+        _backend = None
+
+
+def stream_exists(client_id: str) -> bool:
+    """Get a client_id info based on a token"""
+    return get_backend().stream_exists(client_id)
+
+
+def save_stream(client_id: str, stream_data: str, status: Status) -> None:
+    """Saves a stream (minus subjects and events) to the db"""
+    get_backend().save_stream(client_id, stream_data, status)
+
+
+def load_stream(client_id: str) -> Dict[str, Any]:
+    """Load the data needed to create a stream from the database"""
+    return get_backend().load_stream(client_id)
+
+
+def get_stream_ids() -> List[str]:
+    """Load the client id for all streams"""
+    return get_backend().get_stream_ids()
+
+
+def get_subject_subscriptions(
+        email: str
+) -> List[Tuple[Dict[str, Any], Status]]:
+    """Load the data for every stream following this subject, with the
+    subject's status in it, leaving out disabled streams and subjects
+    """
+    return get_backend().get_subject_subscriptions(email)
+
+
+def add_subject(client_id: str, email: str) -> None:
+    """Add a subject to a stream"""
+    get_backend().add_subject(client_id, email)
+
+
+def set_subject_status(client_id: str, email: str, status: Status) -> None:
+    """Set a subject's status"""
+    get_backend().set_subject_status(client_id, email, status)
+
+
+def get_subject_status(client_id: str, email: str) -> Status:
+    """Get a subject's status"""
+    return get_backend().get_subject_status(client_id, email)
+
+
+def remove_subject(client_id: str, email: str) -> None:
+    """Remove a subject from a stream"""
+    get_backend().remove_subject(client_id, email)
+
+
+def delete_subjects(client_id: str) -> None:
+    """Delete all subjects for a stream"""
+    get_backend().delete_subjects(client_id)
+
+
+def add_set(client_id: str, SET: SecurityEvent,
+            jws: Optional[str] = None) -> EnqueueResult:
+    """Add a SET to the stream"""
+    return add_sets([PendingSET(client_id, SET, jws)])
+
+
+def add_sets(SETs: List[PendingSET],
+             skip_duplicates: bool = False) -> EnqueueResult:
+    """Add many SETs, for any number of streams, in a single transaction.
+    With skip_duplicates, SETs a stream already has are left out rather than
+    raising DuplicateSET
+    """
+    if not SETs:
+        return EnqueueResult()
+    return get_backend().add_sets(SETs, skip_duplicates)
+
+
+def delete_SETs(client_id: str, jtis: Optional[List[str]] = None) -> None:
+    """Delete SETs from the stream, based on their jtis"""
+    get_backend().delete_SETs(client_id, jtis)
+
+
+def ack_SETs(client_id: str, jtis: List[str]) -> List[int]:
+    """Delete SETs the receiver has acknowledged, returning the iat of each
+    one that was still queued
+    """
+    return get_backend().ack_SETs(client_id, jtis)
+
+
+def count_SETs(client_id: str) -> int:
+    """How many SETs are in the stream?"""
+    return get_backend().count_SETs(client_id)
+
+
+def queue_depths() -> Dict[str, int]:
+    """How many SETs each stream has queued, leaving out empty queues"""
+    return get_backend().queue_depths()
+
+
+def claim_due_SETs(now: int, limit: int, lease_until: int) -> List[DueSET]:
+    """Take up to limit SETs that are due to be pushed again, leasing them
+    until lease_until
+    """
+    return get_backend().claim_due_SETs(now, limit, lease_until)
+
+
+def reschedule_SET(client_id: str, jti: str, attempts: int,
+                   next_attempt_at: Optional[int]) -> None:
+    """Record a failed push attempt, and when to try again"""
+    get_backend().reschedule_SET(client_id, jti, attempts, next_attempt_at)
+
+
+def release_SETs(client_id: str, subject: Optional[str] = None,
+                 next_attempt_at: Optional[int] = None) -> int:
+    """Stop holding a stream's SETs about subject, or all of them bar those
+    about paused subjects, pushing them from next_attempt_at if set
+    """
+    return get_backend().release_SETs(client_id, subject, next_attempt_at)
+
+
+def claim_released_SETs(client_id: str, next_attempt_at: int, limit: int,
+                        lease_until: int) -> List[DueSET]:
+    """Take up to limit SETs, in queue order, that release_SETs released for
+    next_attempt_at, leasing them until lease_until
+    """
+    return get_backend().claim_released_SETs(
+        client_id, next_attempt_at, limit, lease_until
+    )
+
+
+def hold_SET(client_id: str, jti: str) -> bool:
+    """Hold a SET that was to be pushed, if its stream is still paused"""
+    return get_backend().hold_SET(client_id, jti)
+
+
+def defer_SETs(SETs: List[Tuple[str, str]],
+               next_attempt_at: int) -> List[Tuple[str, str]]:
+    """Leave the (client_id, jti) SETs that an earlier SET about the same
+    subject is still ahead of to the retry scheduler, from next_attempt_at.
+    Returns the ones it was left to
+    """
+    return get_backend().defer_SETs(SETs, next_attempt_at)
+
+
+def drop_held_SETs(client_id: str, subject: Optional[str] = None) -> int:
+    """Delete the SETs a stream holds about subject, or all it holds"""
+    return get_backend().drop_held_SETs(client_id, subject)
+
+
+def expire_SETs(now: int, limit: int) -> int:
+    """Delete up to limit SETs that expired at or before now"""
+    return get_backend().expire_SETs(now, limit)
+
+
+def compact() -> None:
+    """Give back some of the space freed up by deleted SETs"""
+    get_backend().compact()
+
+
+def get_SETs(client_id: str,
+             max_events: Optional[int] = None,
+             after: int = 0) -> List[QueuedSET]:
+    """Get up to max_events SETs from the stream, in the order they were
+    queued, starting after the sequence number `after`
+    """
+    return get_backend().get_SETs(client_id, max_events, after)
+
+
+def add_outbox_event(SET: SecurityEvent, now: int) -> None:
+    """Put an event in the outbox, to be broadcast from now on"""
+    get_backend().add_outbox_event(SET, now)
+
+
+def claim_outbox_events(now: int, limit: int,
+                        lease_until: int) -> List[OutboxEvent]:
+    """Take up to limit events from the outbox, leasing them until
+    lease_until
+    """
+    return get_backend().claim_outbox_events(now, limit, lease_until)
+
+
+def delete_outbox_event(event_id: str) -> None:
+    """Take an event that has been broadcast out of the outbox"""
+    get_backend().delete_outbox_event(event_id)
+
+
+def reschedule_outbox_event(event_id: str,
+                            next_attempt_at: Optional[int]) -> None:
+    """Claim an event that couldn't be broadcast again from next_attempt_at,
+    or if that is None give up on it
+    """
+    get_backend().reschedule_outbox_event(event_id, next_attempt_at)
+
+
+def get_failed_outbox_events() -> List[OutboxEvent]:
+    """The events that were given up on, to look into or trigger again"""
+    return get_backend().get_failed_outbox_events()
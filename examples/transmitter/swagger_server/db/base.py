@@ -0,0 +1,309 @@
+# Copyright (c) 2021 Cisco Systems, Inc. and its affiliates
+# All rights reserved.
+# Use of this source code is governed by a BSD 3-Clause License
+# that can be found in the LICENSE file.
+
+from enum import Enum
+import json
+from typing import Any, Dict, List, NamedTuple, Optional, Protocol, Tuple
+
+from swagger_server.events import SecurityEvent
+from swagger_server.models import Status
+
+
+class DuplicateSET(ValueError):
+    """A stream already has a SET with this jti"""
+    def __init__(self, client_id: str, jti: str) -> None:
+        super().__init__(f"Stream {client_id} already has a SET {jti}")
+        self.client_id = client_id
+        self.jti = jti
+
+
+class QueueFullPolicy(Enum):
+    """What to do with a new SET when a stream's queue is already as deep
+    as it is allowed to get
+    """
+    drop_oldest = 'drop_oldest'
+    reject = 'reject'
+
+
+class PendingSET(NamedTuple):
+    """A SET about to be added to a stream's queue. If it has already been
+    signed, the compact JWS is stored alongside it.
+
+    If expires_at (a unix timestamp) is set, the SET may be deleted once
+    that time has passed. If max_depth is set, the stream's queue is kept
+    to that many SETs, according to on_full. If next_attempt_at is set, the
+    SET is to be pushed, and should be (re)tried from that time on.
+
+    subject is the email of the subject the SET is about, if it has one. A
+    held SET is kept for a paused stream or subject: it isn't polled or
+    pushed until release_SETs lets it go.
+
+    event_type is the URI of the SET's event, and subject_key the whole
+    subject it is about, e.g. the session as well as the user. Once the SET
+    is in, any SETs already queued for the stream with the same subject_key
+    and an event type in supersedes are deleted, as the new SET makes them
+    obsolete. A held SET only supersedes other held SETs.
+    """
+    client_id: str
+    SET: SecurityEvent
+    jws: Optional[str] = None
+    expires_at: Optional[int] = None
+    max_depth: Optional[int] = None
+    on_full: QueueFullPolicy = QueueFullPolicy.drop_oldest
+    next_attempt_at: Optional[int] = None
+    subject: Optional[str] = None
+    held: bool = False
+    event_type: Optional[str] = None
+    supersedes: Tuple[str, ...] = ()
+    subject_key: Optional[str] = None
+
+
+class EnqueueResult(NamedTuple):
+    """What happened to SETs that didn't fit in their streams' queues"""
+    # older SETs deleted to make room
+    dropped: int = 0
+    # new SETs that were not queued
+    rejected: Tuple[PendingSET, ...] = ()
+    # SETs that were already queued, when asked to skip those
+    duplicates: Tuple[PendingSET, ...] = ()
+    # older SETs deleted as the new ones made them obsolete
+    superseded: int = 0
+
+
+class QueuedSET(NamedTuple):
+    """A SET waiting in a stream's queue, along with its place in line"""
+    seq: int
+    jti: str
+    event: str
+    jws: Optional[str]
+
+    @property
+    def SET(self) -> SecurityEvent:
+        """Parse the SET. When a signed JWS is available, polling can skip
+        this altogether
+        """
+        return SecurityEvent.parse_obj(json.loads(self.event))
+
+
+class DueSET(NamedTuple):
+    """A SET whose push is due to be (re)tried"""
+    client_id: str
+    seq: int
+    jti: str
+    event: str
+    jws: Optional[str]
+    # how many times pushing it has failed so far
+    attempts: int
+    # when it was due
+    next_attempt_at: int
+    # the email of the subject it is about, if it has one
+    subject: Optional[str] = None
+
+    @property
+    def SET(self) -> SecurityEvent:
+        return SecurityEvent.parse_obj(json.loads(self.event))
+
+
+class OutboxEvent(NamedTuple):
+    """An event waiting in the outbox to be fanned out to streams"""
+    # the jti of the SETs it is sent out as
+    event_id: str
+    event: str
+    # how many times it has been claimed, this time included
+    attempts: int
+
+    @property
+    def SET(self) -> SecurityEvent:
+        return SecurityEvent.parse_obj(json.loads(self.event))
+
+
+class StorageBackend(Protocol):
+    """Everything the transmitter persists: streams, their subjects and the
+    queue of SETs waiting to be polled or pushed.
+
+    Every engine must pass the conformance tests in test/test_db.py.
+
+    Along with the queues, there is an outbox of events to be broadcast, so
+    that an event can be accepted in one small write and fanned out later.
+    """
+
+    def create(self, drop: bool = False) -> None:
+        """Set up the storage, wiping out anything there first if drop"""
+
+    def close(self) -> None:
+        """Release any resources, e.g. at shutdown or between tests"""
+
+    # streams
+
+    def stream_exists(self, client_id: str) -> bool:
+        ...
+
+    def save_stream(self, client_id: str, stream_data: str,
+                    status: Status) -> None:
+        """Save a stream (minus subjects and events)"""
+
+    def load_stream(self, client_id: str) -> Dict[str, Any]:
+        """Load the data needed to create a stream. Raises
+        StreamDoesNotExist if there is no such stream
+        """
+
+    def get_stream_ids(self) -> List[str]:
+        ...
+
+    def get_subject_subscriptions(
+            self, email: str
+    ) -> List[Tuple[Dict[str, Any], Status]]:
+        """Load the data for every stream following this subject, along
+        with the subject's status in it, where neither the stream nor the
+        subject is disabled. This should cost as much as the streams
+        following the subject, not as much as all streams
+        """
+
+    # subjects
+
+    def add_subject(self, client_id: str, email: str) -> None:
+        """Add an enabled subject to a stream"""
+
+    def set_subject_status(self, client_id: str, email: str,
+                           status: Status) -> None:
+        """Raises SubjectNotInStream if the stream has no such subject"""
+
+    def get_subject_status(self, client_id: str, email: str) -> Status:
+        """Raises SubjectNotInStream if the stream has no such subject"""
+
+    def remove_subject(self, client_id: str, email: str) -> None:
+        ...
+
+    def delete_subjects(self, client_id: str) -> None:
+        ...
+
+    # the SET queue
+
+    def add_sets(self, SETs: List[PendingSET],
+                 skip_duplicates: bool = False) -> EnqueueResult:
+        """Add many SETs, for any number of streams. The SETs for any one
+        stream are all or nothing; an engine that spreads streams over
+        several stores may commit each store separately. Raises DuplicateSET
+        if a stream already has a SET with the same jti, unless
+        skip_duplicates, in which case those SETs are left out and returned
+        as duplicates.
+
+        Each SET is given a sequence number that is higher than any other
+        that has been handed out to its stream, even ones that are gone.
+
+        A queue that is at its max_depth either rejects the new SET, or has
+        its oldest SETs dropped once the new one is in. SETs the new ones
+        supersede are deleted before any are dropped, apart from those whose
+        next_attempt_at is still to come, which may be being pushed.
+        """
+
+    def delete_SETs(self, client_id: str,
+                    jtis: Optional[List[str]] = None) -> None:
+        """Delete the SETs with these jtis, or every SET if jtis is None"""
+
+    def ack_SETs(self, client_id: str, jtis: List[str]) -> List[int]:
+        """Delete the SETs with these jtis, as the receiver has them,
+        returning the iat of each one that was still queued
+        """
+
+    def count_SETs(self, client_id: str) -> int:
+        ...
+
+    def queue_depths(self) -> Dict[str, int]:
+        """How many SETs every stream with any has queued"""
+
+    def claim_due_SETs(self, now: int, limit: int,
+                       lease_until: int) -> List[DueSET]:
+        """Take up to limit SETs, from any stream, whose next push attempt
+        is due by now, most overdue first. Each is leased by pushing its
+        next attempt back to lease_until, so that no one else claims it
+        again in the meantime.
+
+        A SET isn't claimed while an earlier SET about the same subject in
+        the same stream is still to be pushed, or held, so that retries
+        never push SETs about a subject out of order
+        """
+
+    def reschedule_SET(self, client_id: str, jti: str, attempts: int,
+                       next_attempt_at: Optional[int]) -> None:
+        """Record a failed push attempt, and when to try again. A
+        next_attempt_at of None stops the SET from being retried
+        """
+
+    def release_SETs(self, client_id: str, subject: Optional[str],
+                     next_attempt_at: Optional[int]) -> int:
+        """Stop holding a stream's SETs about subject, or if subject is None
+        every SET it holds apart from those about subjects that are still
+        paused. Released SETs are pushed from next_attempt_at, if it is set.
+        Returns how many were released
+        """
+
+    def hold_SET(self, client_id: str, jti: str) -> bool:
+        """Hold a SET that was to be pushed, as long as its stream is still
+        paused, so that it is released with the rest once the stream is
+        enabled. Returns whether it was held
+        """
+
+    def defer_SETs(self, SETs: List[Tuple[str, str]],
+                   next_attempt_at: int) -> List[Tuple[str, str]]:
+        """Of the (client_id, jti) SETs about to be pushed, reschedule for
+        next_attempt_at those whose stream has an earlier SET about the same
+        subject still to be pushed or held, so that the retry scheduler
+        pushes them in order once it is. Returns the ones rescheduled
+        """
+
+    def claim_released_SETs(self, client_id: str, next_attempt_at: int,
+                            limit: int, lease_until: int) -> List[DueSET]:
+        """Like claim_due_SETs, but only takes the stream's SETs that were
+        released for next_attempt_at, and in the order they were queued
+        """
+
+    def drop_held_SETs(self, client_id: str, subject: Optional[str]) -> int:
+        """Delete the SETs a stream holds about subject, or every SET it
+        holds if subject is None. Returns how many were deleted
+        """
+
+    def expire_SETs(self, now: int, limit: int) -> int:
+        """Delete up to limit SETs, from any stream, that expired at or
+        before now. Returns how many were deleted
+        """
+
+    def compact(self) -> None:
+        """Give back a bounded amount of space freed up by deleted SETs,
+        without holding a write lock for long
+        """
+
+    def get_SETs(self, client_id: str, max_events: Optional[int] = None,
+                 after: int = 0) -> List[QueuedSET]:
+        """Get up to max_events SETs in sequence order, starting after the
+        sequence number `after`. Held SETs are left out
+        """
+
+    # the outbox
+
+    def add_outbox_event(self, SET: SecurityEvent, now: int) -> None:
+        """Put an event in the outbox, to be claimed from now on. Its
+        event_id is the SET's jti
+        """
+
+    def claim_outbox_events(self, now: int, limit: int,
+                            lease_until: int) -> List[OutboxEvent]:
+        """Take up to limit events that are due by now, oldest first,
+        leasing each until lease_until like claim_due_SETs. An event that is
+        still in the outbox once its lease is up is claimed again
+        """
+
+    def delete_outbox_event(self, event_id: str) -> None:
+        """Take an event out of the outbox, once it has been fanned out"""
+
+    def reschedule_outbox_event(self, event_id: str,
+                                next_attempt_at: Optional[int]) -> None:
+        """Record a failed attempt to fan an event out, and when to try
+        again. A next_attempt_at of None moves it to the failed events,
+        where it is no longer claimed
+        """
+
+    def get_failed_outbox_events(self) -> List[OutboxEvent]:
+        """The events that were given up on, oldest first"""
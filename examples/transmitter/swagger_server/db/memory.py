@@ -0,0 +1,557 @@
+# Copyright (c) 2021 Cisco Systems, Inc. and its affiliates
+# All rights reserved.
+# Use of this source code is governed by a BSD 3-Clause License
+# that can be found in the LICENSE file.
+
+from collections import defaultdict, deque
+import heapq
+import itertools
+import json
+import threading
+import time
+from typing import Any, Deque, Dict, List, Optional, Set, Tuple
+
+from swagger_server.db.base import (
+    DueSET, DuplicateSET, EnqueueResult, OutboxEvent, PendingSET, QueuedSET,
+    QueueFullPolicy
+)
+from swagger_server.encoder import JSONEncoder
+from swagger_server.errors import StreamDoesNotExist, SubjectNotInStream
+from swagger_server.events import SecurityEvent
+from swagger_server.models import Status
+
+
+class MemoryBackend:
+    """Keeps everything in dicts and deques. Nothing survives a restart and
+    nothing is shared between processes, so this is only suitable for
+    ephemeral, single process deployments and for fast test runs.
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.RLock()
+        self._seq = itertools.count(1)
+        self.create(drop=True)
+
+    def create(self, drop: bool = False) -> None:
+        if not drop:
+            return
+
+        with self._lock:
+            # client_id -> (stream_data, status)
+            self._streams: Dict[str, Tuple[str, Status]] = {}
+            # client_id -> email -> status
+            self._subjects: Dict[str, Dict[str, Status]] = defaultdict(dict)
+            # email -> client_ids following it, for routing broadcasts
+            self._followers: Dict[str, Set[str]] = defaultdict(set)
+            # client_id -> SETs in sequence order. Acked SETs are dropped
+            # from _jtis right away, and from the deque lazily
+            self._queues: Dict[str, Deque[QueuedSET]] = defaultdict(deque)
+            # client_id -> jti -> seq of the SETs still in the queue
+            self._jtis: Dict[str, Dict[str, int]] = defaultdict(dict)
+            # client_id -> jti -> expires_at of the SETs that expire
+            self._expiry: Dict[str, Dict[str, int]] = defaultdict(dict)
+            # client_id -> jti -> (attempts, next_attempt_at, SET) of the
+            # SETs waiting to be pushed
+            self._retries: Dict[str, Dict[str, Tuple[int, int, QueuedSET]]] \
+                = defaultdict(dict)
+            # (next_attempt_at, seq, client_id, jti) of the SETs waiting to
+            # be pushed, so the due ones are found without sorting them
+            # all. Entries left behind by a SET being rescheduled or
+            # deleted are skipped over lazily
+            self._due: List[Tuple[int, int, str, str]] = []
+            # client_id -> jti -> email of the SETs about a subject
+            self._subject_of: Dict[str, Dict[str, str]] = defaultdict(dict)
+            # client_id -> jtis of the SETs being held
+            self._held: Dict[str, Set[str]] = defaultdict(set)
+            # client_id -> email -> jti -> seq of the SETs about a subject
+            # still to be pushed, or held, which must go in order
+            self._unpushed: Dict[str, Dict[str, Dict[str, int]]] = \
+                defaultdict(lambda: defaultdict(dict))
+            # client_id -> jti -> (subject key, event type) of the SETs about
+            # a subject, and client_id -> (subject key, event type) -> jtis,
+            # to find the SETs a new one supersedes
+            self._event_type: Dict[str, Dict[str, Tuple[str, str]]] = \
+                defaultdict(dict)
+            self._by_subject: Dict[str, Dict[Tuple[str, str], Set[str]]] = \
+                defaultdict(lambda: defaultdict(set))
+            # event_id -> (event, attempts, next_attempt_at, order added)
+            self._outbox: Dict[str, Tuple[str, int, int, int]] = {}
+            # event_id -> (event, attempts) of the events given up on, in
+            # the order they were given up on
+            self._outbox_failed: Dict[str, Tuple[str, int]] = {}
+
+    def close(self) -> None:
+        pass
+
+    def stream_exists(self, client_id: str) -> bool:
+        return client_id in self._streams
+
+    def save_stream(self, client_id: str, stream_data: str,
+                    status: Status) -> None:
+        with self._lock:
+            self._streams[client_id] = (stream_data, status)
+
+    def load_stream(self, client_id: str) -> Dict[str, Any]:
+        try:
+            stream_data, _ = self._streams[client_id]
+        except KeyError:
+            raise StreamDoesNotExist()
+        return json.loads(stream_data)
+
+    def get_stream_ids(self) -> List[str]:
+        with self._lock:
+            return list(self._streams)
+
+    def get_subject_subscriptions(
+            self, email: str
+    ) -> List[Tuple[Dict[str, Any], Status]]:
+        live = (Status.enabled, Status.paused)
+        with self._lock:
+            followers = [
+                (self._streams[client_id], self._subjects[client_id][email])
+                for client_id in self._followers.get(email, ())
+            ]
+        return [
+            (json.loads(stream_data), subject_status)
+            for (stream_data, status), subject_status in followers
+            if status in live and subject_status in live
+        ]
+
+    def add_subject(self, client_id: str, email: str) -> None:
+        with self._lock:
+            if email in self._subjects[client_id]:
+                raise ValueError(f"{email} is already in stream {client_id}")
+            self._subjects[client_id][email] = Status.enabled
+            self._followers[email].add(client_id)
+
+    def set_subject_status(self, client_id: str, email: str,
+                           status: Status) -> None:
+        with self._lock:
+            if email not in self._subjects[client_id]:
+                raise SubjectNotInStream(email)
+            self._subjects[client_id][email] = status
+
+    def get_subject_status(self, client_id: str, email: str) -> Status:
+        try:
+            return self._subjects[client_id][email]
+        except KeyError:
+            raise SubjectNotInStream(email)
+
+    def remove_subject(self, client_id: str, email: str) -> None:
+        with self._lock:
+            self._subjects[client_id].pop(email, None)
+            self._followers[email].discard(client_id)
+
+    def delete_subjects(self, client_id: str) -> None:
+        with self._lock:
+            for email in self._subjects.pop(client_id, {}):
+                self._followers[email].discard(client_id)
+
+    def add_sets(self, SETs: List[PendingSET],
+                 skip_duplicates: bool = False) -> EnqueueResult:
+        encoder = JSONEncoder()
+        with self._lock:
+            # check everything up front so that this is all or nothing
+            new = []
+            duplicates = []
+            seen = set()
+            for pending in SETs:
+                key = (pending.client_id, pending.SET.jti)
+                if key in seen or pending.SET.jti in self._jtis[key[0]]:
+                    if not skip_duplicates:
+                        raise DuplicateSET(*key)
+                    duplicates.append(pending)
+                else:
+                    new.append(pending)
+                seen.add(key)
+
+            rejected = []
+            superseded = 0
+            max_depths: Dict[str, int] = {}
+            for pending in new:
+                live = self._jtis[pending.client_id]
+                if pending.max_depth is not None:
+                    if pending.on_full == QueueFullPolicy.reject:
+                        if len(live) >= pending.max_depth:
+                            rejected.append(pending)
+                            continue
+                    else:
+                        max_depths[pending.client_id] = pending.max_depth
+
+                queued = QueuedSET(
+                    seq=next(self._seq),
+                    jti=pending.SET.jti,
+                    event=encoder.encode(pending.SET),
+                    jws=pending.jws
+                )
+                self._queues[pending.client_id].append(queued)
+                live[queued.jti] = queued.seq
+                if pending.expires_at is not None:
+                    self._expiry[pending.client_id][queued.jti] = \
+                        pending.expires_at
+                if pending.subject is not None:
+                    self._subject_of[pending.client_id][queued.jti] = \
+                        pending.subject
+                if pending.next_attempt_at is not None:
+                    self._schedule(pending.client_id, queued.jti, 0,
+                                   pending.next_attempt_at, queued)
+                if pending.held:
+                    self._held[pending.client_id].add(queued.jti)
+                    self._track(pending.client_id, queued.jti)
+                if pending.subject_key is not None and \
+                        pending.event_type is not None:
+                    key = (pending.subject_key, pending.event_type)
+                    self._event_type[pending.client_id][queued.jti] = key
+                    self._by_subject[pending.client_id][key].add(queued.jti)
+                superseded += self._supersede(pending, queued.seq)
+
+            dropped = 0
+            for client_id, max_depth in max_depths.items():
+                dropped += self._drop_oldest(client_id, max_depth)
+
+        return EnqueueResult(dropped, tuple(rejected), tuple(duplicates),
+                             superseded)
+
+    def _supersede(self, pending: PendingSET, seq: int) -> int:
+        # must hold the lock
+        if pending.subject_key is None:
+            return 0
+        live = self._jtis[pending.client_id]
+        held = self._held[pending.client_id]
+        retries = self._retries[pending.client_id]
+        by_subject = self._by_subject[pending.client_id]
+        now = int(time.time())
+        obsolete = [
+            jti
+            for event_type in pending.supersedes
+            for jti in by_subject.get((pending.subject_key, event_type), ())
+            if live[jti] < seq and (jti in held or not pending.held)
+            # leased to a push that may be under way
+            and not (jti in retries and retries[jti][1] > now)
+        ]
+        for jti in obsolete:
+            del live[jti]
+            self._forget(pending.client_id, jti)
+        # the queue deque skips over them lazily, as with acked SETs
+        return len(obsolete)
+
+    def _drop_oldest(self, client_id: str, max_depth: int) -> int:
+        live = self._jtis[client_id]
+        queue = self._queues[client_id]
+        dropped = 0
+        while len(live) > max_depth:
+            oldest = queue.popleft()
+            if live.get(oldest.jti) == oldest.seq:
+                del live[oldest.jti]
+                self._forget(client_id, oldest.jti)
+                dropped += 1
+        return dropped
+
+    def delete_SETs(self, client_id: str,
+                    jtis: Optional[List[str]] = None) -> None:
+        with self._lock:
+            if not jtis:
+                for by_client in (self._queues, self._jtis, self._expiry,
+                                  self._retries, self._subject_of,
+                                  self._held, self._unpushed,
+                                  self._event_type, self._by_subject):
+                    by_client.pop(client_id, None)
+                return
+
+            live = self._jtis[client_id]
+            for jti in jtis:
+                live.pop(jti, None)
+                self._forget(client_id, jti)
+
+            # drop acked SETs from the front of the queue now; any others
+            # are skipped over and dropped as the front reaches them
+            queue = self._queues[client_id]
+            while queue and live.get(queue[0].jti) != queue[0].seq:
+                queue.popleft()
+
+    def ack_SETs(self, client_id: str, jtis: List[str]) -> List[int]:
+        with self._lock:
+            live = self._jtis.get(client_id, {})
+            acked = {jti for jti in jtis if jti in live}
+            issued_at = []
+            # receivers ack from the front of the queue, so this rarely
+            # looks far
+            for queued in self._queues.get(client_id, ()):
+                if len(issued_at) == len(acked):
+                    break
+                if queued.jti in acked and live[queued.jti] == queued.seq:
+                    issued_at.append(json.loads(queued.event)["iat"])
+            if acked:
+                self.delete_SETs(client_id, list(acked))
+            return issued_at
+
+    def _forget(self, client_id: str, jti: str) -> None:
+        # must hold the lock. Drops everything kept about a SET bar its
+        # place in the queue
+        self._expiry[client_id].pop(jti, None)
+        self._retries[client_id].pop(jti, None)
+        self._held[client_id].discard(jti)
+        self._track(client_id, jti)
+        self._subject_of[client_id].pop(jti, None)
+        key = self._event_type[client_id].pop(jti, None)
+        if key is not None:
+            by_subject = self._by_subject[client_id]
+            jtis = by_subject[key]
+            jtis.discard(jti)
+            if not jtis:
+                del by_subject[key]
+
+    def count_SETs(self, client_id: str) -> int:
+        return len(self._jtis.get(client_id, ()))
+
+    def queue_depths(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                client_id: len(jtis)
+                for client_id, jtis in self._jtis.items() if jtis
+            }
+
+    def claim_due_SETs(self, now: int, limit: int,
+                       lease_until: int) -> List[DueSET]:
+        with self._lock:
+            due: List[DueSET] = []
+            # SETs waiting on an earlier one about the same subject, and
+            # the leases of those claimed, which go back on the heap once
+            # this is done with it, so none is looked at twice
+            put_back = []
+            while self._due and self._due[0][0] <= now and len(due) < limit:
+                entry = heapq.heappop(self._due)
+                next_attempt_at, seq, client_id, jti = entry
+                retry = self._retries.get(client_id, {}).get(jti)
+                if retry is None or retry[1] != next_attempt_at or \
+                        retry[2].seq != seq:
+                    continue
+                subject = self._subject_of[client_id].get(jti)
+                if subject is not None and \
+                        self._first_about(client_id, subject) != seq:
+                    put_back.append(entry)
+                    continue
+                attempts, _, queued = retry
+                due.append(DueSET(client_id, seq, jti, queued.event,
+                                  queued.jws, attempts, next_attempt_at,
+                                  subject))
+                self._retries[client_id][jti] = \
+                    (attempts, lease_until, queued)
+                put_back.append((lease_until, seq, client_id, jti))
+            for entry in put_back:
+                heapq.heappush(self._due, entry)
+        return due
+
+    def _schedule(self, client_id: str, jti: str, attempts: int,
+                  next_attempt_at: int, queued: QueuedSET) -> None:
+        # must hold the lock
+        self._retries[client_id][jti] = (attempts, next_attempt_at, queued)
+        heapq.heappush(self._due,
+                       (next_attempt_at, queued.seq, client_id, jti))
+        self._track(client_id, jti)
+
+    def _track(self, client_id: str, jti: str) -> None:
+        # must hold the lock. Keeps _unpushed in step with a SET that has
+        # just been scheduled, held, released or forgotten
+        subject = self._subject_of[client_id].get(jti)
+        if subject is None:
+            return
+        unpushed = self._unpushed[client_id]
+        if jti in self._retries[client_id] or jti in self._held[client_id]:
+            unpushed[subject][jti] = self._jtis[client_id][jti]
+        elif subject in unpushed:
+            unpushed[subject].pop(jti, None)
+            if not unpushed[subject]:
+                del unpushed[subject]
+
+    def _first_about(self, client_id: str, subject: str) -> int:
+        # must hold the lock. The seq of the first SET still to be pushed,
+        # or held, about subject in the stream
+        return min(self._unpushed[client_id][subject].values())
+
+    def reschedule_SET(self, client_id: str, jti: str, attempts: int,
+                       next_attempt_at: Optional[int]) -> None:
+        with self._lock:
+            seq = self._jtis.get(client_id, {}).get(jti)
+            if seq is None:
+                return
+
+            retries = self._retries[client_id]
+            if next_attempt_at is None:
+                retries.pop(jti, None)
+                self._track(client_id, jti)
+                return
+
+            queued = next(
+                q for q in self._queues[client_id]
+                if q.jti == jti and q.seq == seq
+            )
+            self._schedule(client_id, jti, attempts, next_attempt_at, queued)
+
+    def release_SETs(self, client_id: str, subject: Optional[str],
+                     next_attempt_at: Optional[int]) -> int:
+        with self._lock:
+            subject_of = self._subject_of[client_id]
+            paused = {
+                email
+                for email, status in self._subjects[client_id].items()
+                if status == Status.paused
+            }
+            held = self._held[client_id]
+            released = [
+                jti for jti in held
+                if (subject_of.get(jti) == subject if subject is not None
+                    else subject_of.get(jti) not in paused)
+            ]
+            held.difference_update(released)
+
+            if next_attempt_at is not None and released:
+                live = self._jtis[client_id]
+                queued = {
+                    q.jti: q for q in self._queues[client_id]
+                    if live.get(q.jti) == q.seq
+                }
+                for jti in released:
+                    self._schedule(client_id, jti, 0, next_attempt_at,
+                                   queued[jti])
+            else:
+                for jti in released:
+                    self._track(client_id, jti)
+        return len(released)
+
+    def claim_released_SETs(self, client_id: str, next_attempt_at: int,
+                            limit: int, lease_until: int) -> List[DueSET]:
+        with self._lock:
+            retries = self._retries[client_id]
+            subject_of = self._subject_of[client_id]
+            due = sorted(
+                (
+                    DueSET(client_id, queued.seq, jti, queued.event,
+                           queued.jws, attempts, at, subject_of.get(jti))
+                    for jti, (attempts, at, queued) in retries.items()
+                    if at == next_attempt_at
+                ),
+                key=lambda due: due.seq
+            )[:limit]
+            for claimed in due:
+                attempts, _, queued = retries[claimed.jti]
+                self._schedule(client_id, claimed.jti, attempts, lease_until,
+                               queued)
+        return due
+
+    def hold_SET(self, client_id: str, jti: str) -> bool:
+        with self._lock:
+            stream = self._streams.get(client_id)
+            if stream is None or stream[1] != Status.paused or \
+                    jti not in self._jtis.get(client_id, {}):
+                return False
+            self._retries[client_id].pop(jti, None)
+            self._held[client_id].add(jti)
+            self._track(client_id, jti)
+        return True
+
+    def defer_SETs(self, SETs: List[Tuple[str, str]],
+                   next_attempt_at: int) -> List[Tuple[str, str]]:
+        with self._lock:
+            deferred = []
+            for client_id, jti in SETs:
+                retries = self._retries[client_id]
+                subject = self._subject_of[client_id].get(jti)
+                if jti not in retries or subject is None:
+                    continue
+                attempts, _, queued = retries[jti]
+                if self._first_about(client_id, subject) < queued.seq:
+                    self._schedule(client_id, jti, attempts, next_attempt_at,
+                                   queued)
+                    deferred.append((client_id, jti))
+        return deferred
+
+    def drop_held_SETs(self, client_id: str, subject: Optional[str]) -> int:
+        with self._lock:
+            subject_of = self._subject_of[client_id]
+            dropped = [
+                jti for jti in self._held[client_id]
+                if subject is None or subject_of.get(jti) == subject
+            ]
+            if dropped:
+                self.delete_SETs(client_id, dropped)
+        return len(dropped)
+
+    def expire_SETs(self, now: int, limit: int) -> int:
+        with self._lock:
+            expired = [
+                (client_id, jti)
+                for client_id, expiry in self._expiry.items()
+                for jti, expires_at in expiry.items()
+                if expires_at <= now
+            ][:limit]
+            for client_id, jti in expired:
+                self.delete_SETs(client_id, [jti])
+        return len(expired)
+
+    def compact(self) -> None:
+        pass
+
+    def get_SETs(self, client_id: str, max_events: Optional[int] = None,
+                 after: int = 0) -> List[QueuedSET]:
+        if max_events is not None and max_events <= 0:
+            return []
+
+        with self._lock:
+            live = self._jtis.get(client_id, {})
+            held = self._held.get(client_id, ())
+            queued = (
+                q for q in self._queues.get(client_id, ())
+                if q.seq > after and live.get(q.jti) == q.seq
+                and q.jti not in held
+            )
+            return list(itertools.islice(queued, max_events))
+
+    def add_outbox_event(self, SET: SecurityEvent, now: int) -> None:
+        event = JSONEncoder().encode(SET)
+        with self._lock:
+            self._outbox[SET.jti] = (event, 0, now, next(self._seq))
+
+    def claim_outbox_events(self, now: int, limit: int,
+                            lease_until: int) -> List[OutboxEvent]:
+        with self._lock:
+            due = sorted(
+                (
+                    (next_attempt_at, order, event_id)
+                    for event_id, (_, _, next_attempt_at, order)
+                    in self._outbox.items()
+                    if next_attempt_at <= now
+                )
+            )[:limit]
+            claimed = []
+            for _, order, event_id in due:
+                event, attempts, _, _ = self._outbox[event_id]
+                self._outbox[event_id] = \
+                    (event, attempts + 1, lease_until, order)
+                claimed.append(OutboxEvent(event_id, event, attempts + 1))
+        return claimed
+
+    def delete_outbox_event(self, event_id: str) -> None:
+        with self._lock:
+            self._outbox.pop(event_id, None)
+
+    def reschedule_outbox_event(self, event_id: str,
+                                next_attempt_at: Optional[int]) -> None:
+        with self._lock:
+            if event_id not in self._outbox:
+                return
+            event, attempts, _, order = self._outbox[event_id]
+            if next_attempt_at is None:
+                del self._outbox[event_id]
+                self._outbox_failed[event_id] = (event, attempts)
+            else:
+                self._outbox[event_id] = \
+                    (event, attempts, next_attempt_at, order)
+
+    def get_failed_outbox_events(self) -> List[OutboxEvent]:
+        with self._lock:
+            return [
+                OutboxEvent(event_id, event, attempts)
+                for event_id, (event, attempts)
+                in self._outbox_failed.items()
+            ]
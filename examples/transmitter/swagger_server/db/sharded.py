@@ -0,0 +1,236 @@
+# Copyright (c) 2021 Cisco Systems, Inc. and its affiliates
+# All rights reserved.
+# Use of this source code is governed by a BSD 3-Clause License
+# that can be found in the LICENSE file.
+
+from collections import defaultdict
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+import zlib
+
+from swagger_server.db.base import (
+    DueSET, EnqueueResult, OutboxEvent, PendingSET, QueuedSET
+)
+from swagger_server.db.sqlite import SQLiteBackend
+from swagger_server.events import SecurityEvent
+from swagger_server.models import Status
+
+
+def shard_paths(db_path: str, n_shards: int) -> List[str]:
+    """Where each shard lives, e.g. cta.db -> cta.0.db, cta.1.db, ..."""
+    path = Path(db_path)
+    return [
+        str(path.with_name(f"{path.stem}.{i}{path.suffix}"))
+        for i in range(n_shards)
+    ]
+
+
+class ShardedSQLiteBackend:
+    """Spreads streams over several SQLite databases, hashing on client_id.
+
+    Each shard has its own file, write lock and connection pool, so writes
+    for streams on different shards don't wait on each other. A stream's
+    subjects and SETs always live in the same shard as the stream.
+
+    The outbox lives in the first shard, so that events are claimed in the
+    order they were added. Writing to it is one small insert per event, so
+    it doesn't need spreading out.
+
+    The number of shards can't be changed once there is data in them, as
+    streams would be looked for in the wrong shard.
+    """
+
+    def __init__(self, db_path: str, n_shards: int) -> None:
+        if n_shards < 1:
+            raise ValueError(f"Need at least one shard, not {n_shards}")
+        self.shards = [
+            SQLiteBackend(path) for path in shard_paths(db_path, n_shards)
+        ]
+        self._claim_from = 0
+
+    def shard_index(self, client_id: str) -> int:
+        # crc32 rather than hash(), which differs from process to process
+        return zlib.crc32(client_id.encode("utf-8")) % len(self.shards)
+
+    def shard_for(self, client_id: str) -> SQLiteBackend:
+        return self.shards[self.shard_index(client_id)]
+
+    def create(self, drop: bool = False) -> None:
+        for shard in self.shards:
+            shard.create(drop)
+
+    def close(self) -> None:
+        for shard in self.shards:
+            shard.close()
+
+    def stream_exists(self, client_id: str) -> bool:
+        return self.shard_for(client_id).stream_exists(client_id)
+
+    def save_stream(self, client_id: str, stream_data: str,
+                    status: Status) -> None:
+        self.shard_for(client_id).save_stream(client_id, stream_data, status)
+
+    def load_stream(self, client_id: str) -> Dict[str, Any]:
+        return self.shard_for(client_id).load_stream(client_id)
+
+    def get_stream_ids(self) -> List[str]:
+        return [
+            client_id
+            for shard in self.shards
+            for client_id in shard.get_stream_ids()
+        ]
+
+    def get_subject_subscriptions(
+            self, email: str
+    ) -> List[Tuple[Dict[str, Any], Status]]:
+        # every shard has the same index, so this is one indexed lookup per
+        # shard rather than a scan
+        return [
+            subscription
+            for shard in self.shards
+            for subscription in shard.get_subject_subscriptions(email)
+        ]
+
+    def add_subject(self, client_id: str, email: str) -> None:
+        self.shard_for(client_id).add_subject(client_id, email)
+
+    def set_subject_status(self, client_id: str, email: str,
+                           status: Status) -> None:
+        self.shard_for(client_id).set_subject_status(client_id, email, status)
+
+    def get_subject_status(self, client_id: str, email: str) -> Status:
+        return self.shard_for(client_id).get_subject_status(client_id, email)
+
+    def remove_subject(self, client_id: str, email: str) -> None:
+        self.shard_for(client_id).remove_subject(client_id, email)
+
+    def delete_subjects(self, client_id: str) -> None:
+        self.shard_for(client_id).delete_subjects(client_id)
+
+    def add_sets(self, SETs: List[PendingSET],
+                 skip_duplicates: bool = False) -> EnqueueResult:
+        """Group the SETs by shard and commit each shard on its own. Each
+        shard is all or nothing, but if one shard fails the shards before it
+        stay committed
+        """
+        by_shard: Dict[int, List[PendingSET]] = defaultdict(list)
+        for pending in SETs:
+            by_shard[self.shard_index(pending.client_id)].append(pending)
+
+        dropped = superseded = 0
+        rejected: List[PendingSET] = []
+        duplicates: List[PendingSET] = []
+        for index, pending_SETs in sorted(by_shard.items()):
+            result = self.shards[index].add_sets(pending_SETs,
+                                                 skip_duplicates)
+            dropped += result.dropped
+            rejected.extend(result.rejected)
+            duplicates.extend(result.duplicates)
+            superseded += result.superseded
+        return EnqueueResult(dropped, tuple(rejected), tuple(duplicates),
+                             superseded)
+
+    def delete_SETs(self, client_id: str,
+                    jtis: Optional[List[str]] = None) -> None:
+        self.shard_for(client_id).delete_SETs(client_id, jtis)
+
+    def ack_SETs(self, client_id: str, jtis: List[str]) -> List[int]:
+        return self.shard_for(client_id).ack_SETs(client_id, jtis)
+
+    def count_SETs(self, client_id: str) -> int:
+        return self.shard_for(client_id).count_SETs(client_id)
+
+    def queue_depths(self) -> Dict[str, int]:
+        depths: Dict[str, int] = {}
+        for shard in self.shards:
+            depths.update(shard.queue_depths())
+        return depths
+
+    def claim_due_SETs(self, now: int, limit: int,
+                       lease_until: int) -> List[DueSET]:
+        # take what's due from each shard in turn, starting from a
+        # different shard every time so that a backlog in one shard can't
+        # starve the others. Each shard's SETs are taken most overdue first
+        start = self._claim_from
+        self._claim_from = (start + 1) % len(self.shards)
+
+        claimed: List[DueSET] = []
+        for shard in self.shards[start:] + self.shards[:start]:
+            if len(claimed) >= limit:
+                break
+            claimed.extend(
+                shard.claim_due_SETs(now, limit - len(claimed), lease_until)
+            )
+        return claimed
+
+    def reschedule_SET(self, client_id: str, jti: str, attempts: int,
+                       next_attempt_at: Optional[int]) -> None:
+        self.shard_for(client_id).reschedule_SET(
+            client_id, jti, attempts, next_attempt_at
+        )
+
+    def release_SETs(self, client_id: str, subject: Optional[str],
+                     next_attempt_at: Optional[int]) -> int:
+        return self.shard_for(client_id).release_SETs(
+            client_id, subject, next_attempt_at
+        )
+
+    def claim_released_SETs(self, client_id: str, next_attempt_at: int,
+                            limit: int, lease_until: int) -> List[DueSET]:
+        return self.shard_for(client_id).claim_released_SETs(
+            client_id, next_attempt_at, limit, lease_until
+        )
+
+    def hold_SET(self, client_id: str, jti: str) -> bool:
+        return self.shard_for(client_id).hold_SET(client_id, jti)
+
+    def defer_SETs(self, SETs: List[Tuple[str, str]],
+                   next_attempt_at: int) -> List[Tuple[str, str]]:
+        by_shard: Dict[int, List[Tuple[str, str]]] = defaultdict(list)
+        for client_id, jti in SETs:
+            by_shard[self.shard_index(client_id)].append((client_id, jti))
+        return [
+            deferred
+            for index, shard_SETs in by_shard.items()
+            for deferred in self.shards[index].defer_SETs(
+                shard_SETs, next_attempt_at
+            )
+        ]
+
+    def drop_held_SETs(self, client_id: str, subject: Optional[str]) -> int:
+        return self.shard_for(client_id).drop_held_SETs(client_id, subject)
+
+    def expire_SETs(self, now: int, limit: int) -> int:
+        expired = 0
+        for shard in self.shards:
+            if expired >= limit:
+                break
+            expired += shard.expire_SETs(now, limit - expired)
+        return expired
+
+    def compact(self) -> None:
+        for shard in self.shards:
+            shard.compact()
+
+    def get_SETs(self, client_id: str, max_events: Optional[int] = None,
+                 after: int = 0) -> List[QueuedSET]:
+        return self.shard_for(client_id).get_SETs(
+            client_id, max_events, after
+        )
+
+    def add_outbox_event(self, SET: SecurityEvent, now: int) -> None:
+        self.shards[0].add_outbox_event(SET, now)
+
+    def claim_outbox_events(self, now: int, limit: int,
+                            lease_until: int) -> List[OutboxEvent]:
+        return self.shards[0].claim_outbox_events(now, limit, lease_until)
+
+    def delete_outbox_event(self, event_id: str) -> None:
+        self.shards[0].delete_outbox_event(event_id)
+
+    def reschedule_outbox_event(self, event_id: str,
+                                next_attempt_at: Optional[int]) -> None:
+        self.shards[0].reschedule_outbox_event(event_id, next_attempt_at)
+
+    def get_failed_outbox_events(self) -> List[OutboxEvent]:
+        return self.shards[0].get_failed_outbox_events()
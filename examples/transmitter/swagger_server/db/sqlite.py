@@ -0,0 +1,1051 @@
+# Copyright (c) 2021 Cisco Systems, Inc. and its affiliates
+# All rights reserved.
+# Use of this source code is governed by a BSD 3-Clause License
+# that can be found in the LICENSE file.
+
+import contextlib
+import json
+import logging
+import os
+from pathlib import Path
+import queue
+import sqlite3
+import time
+from typing import (
+    Any, Callable, Dict, Iterator, List, Optional, Tuple, Union
+)
+
+from swagger_server.db.base import (
+    DueSET, DuplicateSET, EnqueueResult, OutboxEvent, PendingSET, QueuedSET,
+    QueueFullPolicy
+)
+from swagger_server.encoder import JSONEncoder
+from swagger_server.errors import StreamDoesNotExist, SubjectNotInStream
+from swagger_server.events import SecurityEvent
+from swagger_server.models import Status
+
+
+CREATE_STREAMS_SQL = """
+CREATE TABLE IF NOT EXISTS streams (
+    client_id TEXT PRIMARY KEY,
+    stream_data TEXT
+)
+"""
+
+CREATE_SUBJECTS_SQL = """
+CREATE TABLE IF NOT EXISTS subjects (
+    client_id TEXT,
+    email TEXT,
+    status TEXT,
+    FOREIGN KEY(client_id) REFERENCES streams(client_id),
+    PRIMARY KEY(client_id, email)
+)
+"""
+
+CREATE_SETS_SQL = """
+CREATE TABLE IF NOT EXISTS SETs (
+    client_id TEXT NOT NULL,
+    jti TEXT NOT NULL,
+    timestamp INTEGER NOT NULL,
+    event TEXT NOT NULL,
+    FOREIGN KEY(client_id) REFERENCES streams(client_id),
+    PRIMARY KEY(client_id, jti)
+)
+"""
+
+# SETs are ordered by an AUTOINCREMENT sequence number rather than their iat,
+# which only has a resolution of one second. Sequence numbers are never
+# reused, so they are monotonically increasing within every stream too.
+CREATE_SETS_WITH_SEQ_SQL = """
+CREATE TABLE IF NOT EXISTS SETs_with_seq (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    client_id TEXT NOT NULL,
+    jti TEXT NOT NULL,
+    timestamp INTEGER NOT NULL,
+    event TEXT NOT NULL,
+    FOREIGN KEY(client_id) REFERENCES streams(client_id),
+    UNIQUE(client_id, jti)
+)
+"""
+
+CREATE_SETS_BY_CLIENT_SEQ_SQL = """
+CREATE INDEX IF NOT EXISTS SETs_by_client_seq
+ON SETs(client_id, seq)
+"""
+
+CREATE_SETS_BY_EXPIRY_SQL = """
+CREATE INDEX IF NOT EXISTS SETs_by_expiry
+ON SETs(expires_at) WHERE expires_at IS NOT NULL
+"""
+
+CREATE_SETS_BY_NEXT_ATTEMPT_SQL = """
+CREATE INDEX IF NOT EXISTS SETs_by_next_attempt
+ON SETs(next_attempt_at) WHERE next_attempt_at IS NOT NULL
+"""
+
+CREATE_HELD_SETS_SQL = """
+CREATE INDEX IF NOT EXISTS held_SETs
+ON SETs(client_id, subject) WHERE held = 1
+"""
+
+CREATE_SETS_BY_SUBJECT_SQL = """
+CREATE INDEX IF NOT EXISTS SETs_by_subject
+ON SETs(client_id, subject, event_type) WHERE subject IS NOT NULL
+"""
+
+CREATE_OUTBOX_SQL = """
+CREATE TABLE IF NOT EXISTS outbox (
+    event_id TEXT PRIMARY KEY,
+    event TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt_at INTEGER NOT NULL
+)
+"""
+
+CREATE_OUTBOX_BY_NEXT_ATTEMPT_SQL = """
+CREATE INDEX IF NOT EXISTS outbox_by_next_attempt
+ON outbox(next_attempt_at)
+"""
+
+CREATE_OUTBOX_FAILED_SQL = """
+CREATE TABLE IF NOT EXISTS outbox_failed (
+    event_id TEXT PRIMARY KEY,
+    event TEXT NOT NULL,
+    attempts INTEGER NOT NULL
+)
+"""
+
+CREATE_SUBJECTS_BY_EMAIL_SQL = """
+CREATE INDEX IF NOT EXISTS subjects_by_email_status
+ON subjects(email, status)
+"""
+
+
+def _migrate_create_tables(conn: sqlite3.Connection) -> None:
+    conn.execute(CREATE_STREAMS_SQL)
+    conn.execute(CREATE_SUBJECTS_SQL)
+    conn.execute(CREATE_SETS_SQL)
+
+
+def _migrate_stream_status(conn: sqlite3.Connection) -> None:
+    """Pull the stream status out of stream_data so that broadcasts can
+    route on it without loading every stream
+    """
+    conn.execute("ALTER TABLE streams ADD COLUMN status TEXT")
+    rows = conn.execute("SELECT client_id, stream_data FROM streams")
+    conn.executemany(
+        "UPDATE streams SET status=? WHERE client_id=?",
+        [
+            (json.loads(row["stream_data"])["status"], row["client_id"])
+            for row in rows.fetchall()
+        ]
+    )
+    conn.execute(CREATE_SUBJECTS_BY_EMAIL_SQL)
+
+
+def _migrate_SET_seq(conn: sqlite3.Connection) -> None:
+    """Rebuild the SETs table with a sequence number, keeping the existing
+    SETs in the order they used to be polled in
+    """
+    conn.execute(CREATE_SETS_WITH_SEQ_SQL)
+    conn.execute("""
+        INSERT INTO SETs_with_seq (client_id, jti, timestamp, event)
+        SELECT client_id, jti, timestamp, event
+        FROM SETs
+        ORDER BY timestamp, rowid
+    """)
+    conn.execute("DROP TABLE SETs")
+    conn.execute("ALTER TABLE SETs_with_seq RENAME TO SETs")
+    conn.execute(CREATE_SETS_BY_CLIENT_SEQ_SQL)
+
+
+def _migrate_SET_jws(conn: sqlite3.Connection) -> None:
+    """Allow SETs to be signed once, when they are queued"""
+    conn.execute("ALTER TABLE SETs ADD COLUMN jws TEXT")
+
+
+def _migrate_SET_expiry(conn: sqlite3.Connection) -> None:
+    """Allow SETs to expire, and find the expired ones without a scan"""
+    conn.execute("ALTER TABLE SETs ADD COLUMN expires_at INTEGER")
+    conn.execute(CREATE_SETS_BY_EXPIRY_SQL)
+
+
+PUSH_DELIVERY_METHOD = \
+    'https://schemas.openid.net/secevent/risc/delivery-method/push'
+
+
+def _migrate_SET_retry(conn: sqlite3.Connection) -> None:
+    """Keep track of push attempts, so failed pushes can be retried. SETs
+    already queued for push streams are retried straight away
+    """
+    conn.execute(
+        "ALTER TABLE SETs ADD COLUMN attempts INTEGER NOT NULL DEFAULT 0"
+    )
+    conn.execute("ALTER TABLE SETs ADD COLUMN next_attempt_at INTEGER")
+    conn.execute(CREATE_SETS_BY_NEXT_ATTEMPT_SQL)
+
+    def is_push(stream_data: Dict[str, Any]) -> bool:
+        delivery = stream_data.get("config", {}).get("delivery") or {}
+        return delivery.get("method") == PUSH_DELIVERY_METHOD
+
+    rows = conn.execute("SELECT client_id, stream_data FROM streams")
+    push_streams = [
+        (row["client_id"],)
+        for row in rows.fetchall()
+        if is_push(json.loads(row["stream_data"]))
+    ]
+    conn.executemany(
+        "UPDATE SETs SET next_attempt_at=0 WHERE client_id=?", push_streams
+    )
+
+
+def _migrate_SET_hold(conn: sqlite3.Connection) -> None:
+    """Hold SETs for paused streams and subjects, rather than dropping them,
+    and note which subject each SET is about so that they can be released a
+    subject at a time
+    """
+    conn.execute("ALTER TABLE SETs ADD COLUMN subject TEXT")
+    conn.execute("ALTER TABLE SETs ADD COLUMN held INTEGER NOT NULL DEFAULT 0")
+    conn.execute(CREATE_HELD_SETS_SQL)
+
+
+def _migrate_outbox(conn: sqlite3.Connection) -> None:
+    """Accept events in one small write, and fan them out afterwards"""
+    conn.execute(CREATE_OUTBOX_SQL)
+    conn.execute(CREATE_OUTBOX_BY_NEXT_ATTEMPT_SQL)
+
+
+def _migrate_SET_subject_key(conn: sqlite3.Connection) -> None:
+    """Note the whole subject each SET is about, not just its email, so that
+    a SET only supersedes SETs about the very same subject, e.g. the same
+    session. SETs already queued are left without one, and are never
+    superseded
+    """
+    conn.execute("ALTER TABLE SETs ADD COLUMN subject_key TEXT")
+
+
+def _migrate_outbox_failed(conn: sqlite3.Connection) -> None:
+    """Set aside events that keep failing to be fanned out, rather than
+    claiming them forever
+    """
+    conn.execute(CREATE_OUTBOX_FAILED_SQL)
+
+
+def _migrate_SET_event_type(conn: sqlite3.Connection) -> None:
+    """Note each SET's event type, so that SETs a newer one about the same
+    subject makes obsolete can be found through an index. SETs already
+    queued are left without one, and are never superseded
+    """
+    conn.execute("ALTER TABLE SETs ADD COLUMN event_type TEXT")
+    conn.execute(CREATE_SETS_BY_SUBJECT_SQL)
+
+
+# Each migration moves the schema up by one version. SQLite's user_version
+# records how many have been applied, so existing databases are upgraded in
+# place and new databases simply run all of them.
+MIGRATIONS: List[Callable[[sqlite3.Connection], None]] = [
+    _migrate_create_tables,
+    _migrate_stream_status,
+    _migrate_SET_seq,
+    _migrate_SET_jws,
+    _migrate_SET_expiry,
+    _migrate_SET_retry,
+    _migrate_SET_hold,
+    _migrate_outbox,
+    _migrate_SET_event_type,
+    _migrate_outbox_failed,
+    _migrate_SET_subject_key,
+]
+
+
+SYNCHRONOUS_MODES = {"OFF", "NORMAL", "FULL", "EXTRA"}
+
+
+def _pragmas() -> Dict[str, Union[str, int]]:
+    """Read the tunable pragmas from the environment"""
+    synchronous = os.environ.get("DB_SYNCHRONOUS", "NORMAL").upper()
+    if synchronous not in SYNCHRONOUS_MODES:
+        raise ValueError(f"Invalid DB_SYNCHRONOUS value: {synchronous}")
+
+    return {
+        # space freed by deleted SETs can only be given back a bit at a time
+        # if this is set before anything is written to a new database, WAL
+        # mode included. Existing databases need a one-off VACUUM to switch
+        "auto_vacuum": "INCREMENTAL",
+        "journal_mode": "WAL",
+        "synchronous": synchronous,
+        "mmap_size": int(os.environ.get("DB_MMAP_SIZE", 64 * 1024 * 1024)),
+        # negative values are KiB rather than pages
+        "cache_size": int(os.environ.get("DB_CACHE_SIZE", -16 * 1024)),
+    }
+
+
+class ConnectionPool:
+    """A thread-safe pool of warm connections to a single SQLite database.
+
+    Connections are checked out for the duration of a `with` block and
+    returned afterwards, so the cost of opening the file, applying pragmas
+    and preparing statements is only paid once per pooled connection.
+    """
+
+    def __init__(self, db_path: str, size: Optional[int] = None) -> None:
+        self.db_path = db_path
+        self.size = size or int(os.environ.get("DB_POOL_SIZE", 8))
+        self.statement_cache_size = int(
+            os.environ.get("DB_STATEMENT_CACHE_SIZE", 256)
+        )
+        self.pragmas = _pragmas()
+        self._idle: "queue.LifoQueue[sqlite3.Connection]" = \
+            queue.LifoQueue(maxsize=self.size)
+
+    def _connect(self) -> sqlite3.Connection:
+        # connections are handed between threads, but only ever used by
+        # one thread at a time
+        conn = sqlite3.connect(
+            self.db_path,
+            check_same_thread=False,
+            cached_statements=self.statement_cache_size,
+        )
+        conn.row_factory = sqlite3.Row
+        for pragma, value in self.pragmas.items():
+            conn.execute(f"PRAGMA {pragma}={value}")
+        return conn
+
+    @contextlib.contextmanager
+    def connection(self) -> Iterator[sqlite3.Connection]:
+        """Check out a connection, returning it to the pool afterwards"""
+        try:
+            conn = self._idle.get_nowait()
+        except queue.Empty:
+            conn = self._connect()
+
+        try:
+            yield conn
+        finally:
+            self._release(conn)
+
+    def _release(self, conn: sqlite3.Connection) -> None:
+        # never hand out a connection with a half finished transaction
+        if conn.in_transaction:
+            conn.rollback()
+
+        try:
+            self._idle.put_nowait(conn)
+        except queue.Full:
+            conn.close()
+
+    def close(self) -> None:
+        """Close every idle connection in the pool"""
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                return
+
+
+class SQLiteBackend:
+    """Stores everything in a single SQLite database file"""
+
+    def __init__(self, db_path: str) -> None:
+        self.db_path = db_path
+        self.pool = ConnectionPool(db_path)
+
+    @contextlib.contextmanager
+    def connection(self) -> Iterator[sqlite3.Connection]:
+        """Yield a pooled connection that is returned once the block exits"""
+        with self.pool.connection() as conn:
+            yield conn
+
+    def create(self, drop: bool = False) -> None:
+        if drop:
+            logging.warning("Dropping database")
+            self.pool.close()
+
+            # WAL mode keeps a couple of sidecar files next to the database
+            for suffix in ("", "-wal", "-shm"):
+                Path(f"{self.db_path}{suffix}").unlink(missing_ok=True)
+
+        logging.info("Creating database")
+        with self.connection() as conn:
+            # take the write lock up front so that concurrent workers
+            # starting up don't both try to run the same migration
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                version = conn.execute("PRAGMA user_version").fetchone()[0]
+                for migration in MIGRATIONS[version:]:
+                    logging.info(f"Running migration {migration.__name__}")
+                    migration(conn)
+                conn.execute(f"PRAGMA user_version={len(MIGRATIONS)}")
+                conn.commit()
+            except BaseException:
+                conn.rollback()
+                raise
+
+    def close(self) -> None:
+        self.pool.close()
+
+    def stream_exists(self, client_id: str) -> bool:
+        """Get a client_id info based on a token"""
+        with self.connection() as conn:
+            row = conn.execute(
+                "SELECT * FROM streams WHERE client_id=?",
+                (client_id,)
+            ).fetchone()
+
+            return row is not None
+
+    def save_stream(self, client_id: str, stream_data: str,
+                    status: Status) -> None:
+        """Saves a stream (minus subjects and events) to the db"""
+        with self.connection() as conn:
+            # open a transaction and commit if successful
+            with conn:
+                conn.execute(
+                    """
+                    REPLACE INTO streams (client_id, stream_data, status)
+                    VALUES (?, ?, ?)
+                    """,
+                    (client_id, stream_data, status.value)
+                )
+
+    def load_stream(self, client_id: str) -> Dict[str, Any]:
+        """Load the data needed to create a stream from the database"""
+        with self.connection() as conn:
+            row = conn.execute(
+                "SELECT * FROM streams WHERE client_id=?",
+                (client_id,)
+            ).fetchone()
+
+            if row:
+                return json.loads(row["stream_data"])
+            else:
+                raise StreamDoesNotExist()
+
+    def get_stream_ids(self) -> List[str]:
+        """Load the client id for all streams"""
+        with self.connection() as conn:
+            rows = conn.execute("SELECT client_id from streams").fetchall()
+            return [row["client_id"] for row in rows]
+
+    def get_subject_subscriptions(
+            self, email: str
+    ) -> List[Tuple[Dict[str, Any], Status]]:
+        """Load the data for every stream following this subject, with the
+        subject's status in it, leaving out disabled streams and subjects.
+
+        This is driven by the subjects(email, status) index, so the cost
+        scales with the number of streams following the subject rather than
+        the total number of streams.
+        """
+        live = (Status.enabled.value, Status.paused.value)
+        with self.connection() as conn:
+            rows = conn.execute(
+                """
+                SELECT streams.stream_data, subjects.status
+                FROM subjects
+                JOIN streams ON streams.client_id = subjects.client_id
+                WHERE
+                    subjects.email = ? AND
+                    subjects.status IN (?, ?) AND
+                    streams.status IN (?, ?)
+                """,
+                (email, *live, *live)
+            ).fetchall()
+            return [
+                (json.loads(row["stream_data"]), Status(row["status"]))
+                for row in rows
+            ]
+
+    def add_subject(self, client_id: str, email: str) -> None:
+        """Add a subject to a stream"""
+        with self.connection() as conn:
+            with conn:
+                conn.execute(
+                    "INSERT INTO subjects VALUES (?, ?, ?)",
+                    (client_id, email, Status.enabled.value)
+                )
+
+    def set_subject_status(self, client_id: str, email: str,
+                           status: Status) -> None:
+        """Set a subject's status"""
+        with self.connection() as conn:
+            with conn:
+                cursor = conn.execute("""
+                    UPDATE subjects
+                    SET
+                        status = ?
+                    WHERE
+                        client_id = ? AND
+                        email = ?
+                    """, (status.value, client_id, email)
+                )
+            # total_changes is cumulative for pooled connections, so
+            # only look at this statement's changes
+            if cursor.rowcount != 1:
+                raise SubjectNotInStream(email)
+
+    def get_subject_status(self, client_id: str, email: str) -> Status:
+        """Get a subject's status"""
+        with self.connection() as conn:
+            row = conn.execute(
+                "SELECT * FROM subjects WHERE client_id=? AND email=?",
+                (client_id, email)
+            ).fetchone()
+
+            if row:
+                return Status(row["status"])
+            else:
+                raise SubjectNotInStream(email)
+
+    def remove_subject(self, client_id: str, email: str) -> None:
+        """Remove a subject from a stream"""
+        with self.connection() as conn:
+            with conn:
+                conn.execute(
+                    "DELETE FROM subjects WHERE client_id=? AND email=?",
+                    (client_id, email)
+                )
+
+    def delete_subjects(self, client_id: str) -> None:
+        """Delete all subjects for a stream"""
+        with self.connection() as conn:
+            with conn:
+                conn.execute(
+                    "DELETE FROM subjects WHERE client_id=?",
+                    (client_id,)
+                )
+
+    def add_sets(self, SETs: List[PendingSET],
+                 skip_duplicates: bool = False) -> EnqueueResult:
+        """Add many SETs, for any number of streams, in a single
+        transaction, keeping each stream's queue within its max_depth
+        """
+        if not SETs:
+            return EnqueueResult()
+
+        encoder = JSONEncoder()
+        duplicates: List[PendingSET] = []
+        with self.connection() as conn:
+            try:
+                with conn:
+                    if skip_duplicates:
+                        SETs, duplicates = self._split_duplicates(conn, SETs)
+                    accepted, rejected = self._check_depth(conn, SETs)
+                    conn.executemany(
+                        """
+                        INSERT INTO SETs (
+                            client_id, jti, timestamp, event, jws, expires_at,
+                            next_attempt_at, subject, held, event_type,
+                            subject_key
+                        )
+                        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                        """,
+                        [
+                            (
+                                pending.client_id,
+                                pending.SET.jti,
+                                pending.SET.iat,
+                                encoder.encode(pending.SET),
+                                pending.jws,
+                                pending.expires_at,
+                                pending.next_attempt_at,
+                                pending.subject,
+                                pending.held,
+                                pending.event_type,
+                                pending.subject_key
+                            )
+                            for pending in accepted
+                        ]
+                    )
+                    superseded = self._supersede(conn, accepted)
+                    dropped = self._drop_oldest(conn, accepted)
+            except sqlite3.IntegrityError as err:
+                duplicate = self._find_duplicate(conn, SETs)
+                if duplicate is None:
+                    raise
+                raise DuplicateSET(duplicate.client_id,
+                                   duplicate.SET.jti) from err
+
+        return EnqueueResult(dropped, tuple(rejected), tuple(duplicates),
+                             superseded)
+
+    @staticmethod
+    def _supersede(conn: sqlite3.Connection,
+                   SETs: List[PendingSET]) -> int:
+        """Delete the SETs the new ones make obsolete, going through the
+        SETs_by_subject index. SETs leased to a push that may be under way
+        are left alone
+        """
+        now = int(time.time())
+        superseded = 0
+        for pending in SETs:
+            if pending.subject_key is None or not pending.supersedes:
+                continue
+            qmarks = ",".join(["?"] * len(pending.supersedes))
+            cursor = conn.execute(
+                f"""
+                DELETE FROM SETs
+                WHERE client_id=? AND subject=?
+                AND event_type IN ({qmarks}) AND subject_key=?
+                AND (held=1 OR ?=0)
+                AND (next_attempt_at IS NULL OR next_attempt_at <= ?)
+                AND seq < (SELECT seq FROM SETs WHERE client_id=? AND jti=?)
+                """,
+                (
+                    pending.client_id, pending.subject, *pending.supersedes,
+                    pending.subject_key, pending.held, now,
+                    pending.client_id, pending.SET.jti
+                )
+            )
+            superseded += cursor.rowcount
+        return superseded
+
+    def _count(self, conn: sqlite3.Connection, client_id: str) -> int:
+        return conn.execute(
+            "SELECT COUNT(*) FROM SETs WHERE client_id=?", (client_id,)
+        ).fetchone()[0]
+
+    def _check_depth(
+            self, conn: sqlite3.Connection, SETs: List[PendingSET]
+    ) -> Tuple[List[PendingSET], List[PendingSET]]:
+        """Split the SETs into those that fit and those that full queues
+        reject. Queues without a max_depth aren't counted at all
+        """
+        accepted = []
+        rejected = []
+        depths: Dict[str, int] = {}
+        for pending in SETs:
+            if (pending.max_depth is None
+                    or pending.on_full != QueueFullPolicy.reject):
+                accepted.append(pending)
+                continue
+
+            client_id = pending.client_id
+            if client_id not in depths:
+                depths[client_id] = self._count(conn, client_id)
+            if depths[client_id] >= pending.max_depth:
+                rejected.append(pending)
+            else:
+                depths[client_id] += 1
+                accepted.append(pending)
+
+        return accepted, rejected
+
+    def _drop_oldest(self, conn: sqlite3.Connection,
+                     SETs: List[PendingSET]) -> int:
+        """Trim the queues that drop their oldest SETs back to max_depth"""
+        max_depths = {
+            pending.client_id: pending.max_depth
+            for pending in SETs
+            if pending.max_depth is not None
+            and pending.on_full == QueueFullPolicy.drop_oldest
+        }
+
+        dropped = 0
+        for client_id, max_depth in max_depths.items():
+            # everything up to and including the SET just past the newest
+            # max_depth goes. If the queue is short enough, the subquery is
+            # NULL and nothing matches
+            cursor = conn.execute(
+                """
+                DELETE FROM SETs
+                WHERE client_id=? AND seq <= (
+                    SELECT seq FROM SETs
+                    WHERE client_id=?
+                    ORDER BY seq DESC
+                    LIMIT 1 OFFSET ?
+                )
+                """,
+                (client_id, client_id, max_depth)
+            )
+            dropped += cursor.rowcount
+        return dropped
+
+    @staticmethod
+    def _split_duplicates(
+            conn: sqlite3.Connection, SETs: List[PendingSET]
+    ) -> Tuple[List[PendingSET], List[PendingSET]]:
+        """Split the SETs into new ones and those their streams already
+        have, or that come up twice
+        """
+        new = []
+        duplicates = []
+        seen = set()
+        for pending in SETs:
+            key = (pending.client_id, pending.SET.jti)
+            exists = conn.execute(
+                "SELECT 1 FROM SETs WHERE client_id=? AND jti=?", key
+            ).fetchone()
+            if key in seen or exists:
+                duplicates.append(pending)
+            else:
+                new.append(pending)
+            seen.add(key)
+        return new, duplicates
+
+    @classmethod
+    def _find_duplicate(cls, conn: sqlite3.Connection,
+                        SETs: List[PendingSET]) -> Optional[PendingSET]:
+        _, duplicates = cls._split_duplicates(conn, SETs)
+        return duplicates[0] if duplicates else None
+
+    def delete_SETs(self, client_id: str,
+                    jtis: Optional[List[str]] = None) -> None:
+        """Delete SETs from the stream, based on their jtis"""
+        sql = "DELETE FROM SETs WHERE client_id=?"
+        if jtis:
+            qmarks = ",".join(["?"] * len(jtis))
+            sql += f" AND jti IN ({qmarks})"
+
+        with self.connection() as conn:
+            with conn:
+                conn.execute(
+                    sql, (client_id, *jtis) if jtis else (client_id, )
+                )
+
+    def ack_SETs(self, client_id: str, jtis: List[str]) -> List[int]:
+        """Delete acknowledged SETs, reading their iat first in the same
+        transaction. Both are lookups on the primary key
+        """
+        if not jtis:
+            return []
+        qmarks = ",".join(["?"] * len(jtis))
+        where = f"WHERE client_id=? AND jti IN ({qmarks})"
+
+        with self.connection() as conn:
+            with conn:
+                rows = conn.execute(
+                    f"SELECT timestamp FROM SETs {where}", (client_id, *jtis)
+                ).fetchall()
+                if rows:
+                    conn.execute(f"DELETE FROM SETs {where}",
+                                 (client_id, *jtis))
+        return [row["timestamp"] for row in rows]
+
+    def count_SETs(self, client_id: str) -> int:
+        """How many SETs are in the stream?"""
+        with self.connection() as conn:
+            return conn.execute(
+                "SELECT COUNT(*) FROM SETs WHERE client_id = ?",
+                (client_id,)
+            ).fetchone()[0]
+
+    def queue_depths(self) -> Dict[str, int]:
+        """How many SETs each stream has queued. This walks the whole
+        SETs_by_client_seq index, so is only meant for the odd scrape
+        """
+        with self.connection() as conn:
+            rows = conn.execute(
+                "SELECT client_id, COUNT(*) AS depth FROM SETs "
+                "GROUP BY client_id"
+            ).fetchall()
+        return {row["client_id"]: row["depth"] for row in rows}
+
+    def claim_due_SETs(self, now: int, limit: int,
+                       lease_until: int) -> List[DueSET]:
+        """Take up to limit SETs that are due to be pushed again, using the
+        next_attempt_at index so that a large backlog costs no more than a
+        small one. SETs waiting on an earlier one about the same subject are
+        looked up through the subject index
+        """
+        with self.connection() as conn:
+            # take the write lock before reading, so that two processes
+            # can't claim the same SETs
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                rows = conn.execute(
+                    """
+                    SELECT
+                        client_id, seq, jti, event, jws, attempts,
+                        next_attempt_at, subject
+                    FROM SETs
+                    WHERE next_attempt_at IS NOT NULL AND next_attempt_at <= ?
+                    AND NOT EXISTS (
+                        SELECT 1 FROM SETs AS earlier
+                        INDEXED BY SETs_by_subject
+                        WHERE earlier.client_id = SETs.client_id
+                        AND earlier.subject = SETs.subject
+                        AND earlier.seq < SETs.seq
+                        AND (earlier.next_attempt_at IS NOT NULL
+                             OR earlier.held = 1)
+                    )
+                    ORDER BY next_attempt_at
+                    LIMIT ?
+                    """,
+                    (now, limit)
+                ).fetchall()
+                self._lease(conn, rows, lease_until)
+            except BaseException:
+                conn.rollback()
+                raise
+
+        return [DueSET(*row) for row in rows]
+
+    @staticmethod
+    def _lease(conn: sqlite3.Connection, rows: List[sqlite3.Row],
+               lease_until: int) -> None:
+        # finishes the transaction claiming the rows
+        conn.executemany(
+            "UPDATE SETs SET next_attempt_at=? WHERE seq=?",
+            [(lease_until, row["seq"]) for row in rows]
+        )
+        conn.commit()
+
+    def reschedule_SET(self, client_id: str, jti: str, attempts: int,
+                       next_attempt_at: Optional[int]) -> None:
+        with self.connection() as conn:
+            with conn:
+                conn.execute(
+                    """
+                    UPDATE SETs SET attempts=?, next_attempt_at=?
+                    WHERE client_id=? AND jti=?
+                    """,
+                    (attempts, next_attempt_at, client_id, jti)
+                )
+
+    def release_SETs(self, client_id: str, subject: Optional[str],
+                     next_attempt_at: Optional[int]) -> int:
+        """Stop holding SETs, through the held_SETs index"""
+        if subject is not None:
+            sql = """
+                UPDATE SETs SET held=0, next_attempt_at=?
+                WHERE client_id=? AND held=1 AND subject=?
+            """
+            params: Tuple[Any, ...] = (next_attempt_at, client_id, subject)
+        else:
+            sql = """
+                UPDATE SETs SET held=0, next_attempt_at=?
+                WHERE client_id=? AND held=1 AND (
+                    subject IS NULL OR subject NOT IN (
+                        SELECT email FROM subjects
+                        WHERE client_id=? AND status=?
+                    )
+                )
+            """
+            params = (next_attempt_at, client_id, client_id,
+                      Status.paused.value)
+
+        with self.connection() as conn:
+            with conn:
+                return conn.execute(sql, params).rowcount
+
+    def claim_released_SETs(self, client_id: str, next_attempt_at: int,
+                            limit: int, lease_until: int) -> List[DueSET]:
+        """Take the next limit SETs of a release, walking the stream's queue
+        in order. Going by the next_attempt_at index instead would mean
+        sorting the whole release for every batch
+        """
+        with self.connection() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                rows = conn.execute(
+                    """
+                    SELECT
+                        client_id, seq, jti, event, jws, attempts,
+                        next_attempt_at, subject
+                    FROM SETs INDEXED BY SETs_by_client_seq
+                    WHERE client_id=? AND next_attempt_at=?
+                    ORDER BY seq
+                    LIMIT ?
+                    """,
+                    (client_id, next_attempt_at, limit)
+                ).fetchall()
+                self._lease(conn, rows, lease_until)
+            except BaseException:
+                conn.rollback()
+                raise
+
+        return [DueSET(*row) for row in rows]
+
+    def hold_SET(self, client_id: str, jti: str) -> bool:
+        with self.connection() as conn:
+            with conn:
+                return conn.execute(
+                    """
+                    UPDATE SETs SET held=1, next_attempt_at=NULL
+                    WHERE client_id=? AND jti=? AND EXISTS (
+                        SELECT 1 FROM streams
+                        WHERE client_id=? AND status=?
+                    )
+                    """,
+                    (client_id, jti, client_id, Status.paused.value)
+                ).rowcount > 0
+
+    def defer_SETs(self, SETs: List[Tuple[str, str]],
+                   next_attempt_at: int) -> List[Tuple[str, str]]:
+        """Look for earlier SETs through the SETs_by_subject index, as
+        claim_due_SETs does
+        """
+        deferred = []
+        with self.connection() as conn:
+            with conn:
+                for client_id, jti in SETs:
+                    cursor = conn.execute(
+                        """
+                        UPDATE SETs SET next_attempt_at=?
+                        WHERE client_id=? AND jti=?
+                        AND next_attempt_at IS NOT NULL
+                        AND EXISTS (
+                            SELECT 1 FROM SETs AS earlier
+                            INDEXED BY SETs_by_subject
+                            WHERE earlier.client_id = SETs.client_id
+                            AND earlier.subject = SETs.subject
+                            AND earlier.seq < SETs.seq
+                            AND (earlier.next_attempt_at IS NOT NULL
+                                 OR earlier.held = 1)
+                        )
+                        """,
+                        (next_attempt_at, client_id, jti)
+                    )
+                    if cursor.rowcount:
+                        deferred.append((client_id, jti))
+        return deferred
+
+    def drop_held_SETs(self, client_id: str, subject: Optional[str]) -> int:
+        sql = "DELETE FROM SETs WHERE client_id=? AND held=1"
+        params: Tuple[str, ...] = (client_id,)
+        if subject is not None:
+            sql += " AND subject=?"
+            params += (subject,)
+
+        with self.connection() as conn:
+            with conn:
+                return conn.execute(sql, params).rowcount
+
+    def expire_SETs(self, now: int, limit: int) -> int:
+        """Delete up to limit expired SETs. Keeping each batch small keeps
+        the write lock short
+        """
+        with self.connection() as conn:
+            with conn:
+                cursor = conn.execute(
+                    """
+                    DELETE FROM SETs WHERE seq IN (
+                        SELECT seq FROM SETs
+                        WHERE expires_at IS NOT NULL AND expires_at <= ?
+                        LIMIT ?
+                    )
+                    """,
+                    (now, limit)
+                )
+                return cursor.rowcount
+
+    def compact(self) -> None:
+        """Give back some free pages and checkpoint the WAL, without waiting
+        on readers or writers
+        """
+        pages = int(os.environ.get("DB_VACUUM_PAGES", 1000))
+        with self.connection() as conn:
+            # the pragma frees a page per row stepped through
+            conn.execute(f"PRAGMA incremental_vacuum({pages})").fetchall()
+            conn.execute("PRAGMA wal_checkpoint(PASSIVE)").fetchall()
+
+    def get_SETs(self, client_id: str, max_events: Optional[int] = None,
+                 after: int = 0) -> List[QueuedSET]:
+        """Get up to max_events SETs from the stream, in the order they were
+        queued, starting after the sequence number `after`, skipping held
+        SETs.
+
+        This is a range scan on the (client_id, seq) index, so each page
+        costs the same no matter how deep the queue is, give or take any
+        held SETs it steps over.
+        """
+        if max_events is not None and max_events <= 0:
+            return []
+
+        # use a bound LIMIT so the prepared statement is reused across calls;
+        # a negative LIMIT means no limit in SQLite
+        sql = """
+            SELECT seq, jti, event, jws FROM SETs
+            WHERE client_id=? AND seq>? AND held=0
+            ORDER BY seq
+            LIMIT ?
+        """
+        limit = -1 if max_events is None else max_events
+
+        with self.connection() as conn:
+            results = conn.execute(sql, (client_id, after, limit)).fetchall()
+            return [
+                QueuedSET(r["seq"], r["jti"], r["event"], r["jws"])
+                for r in results
+            ]
+
+    def add_outbox_event(self, SET: SecurityEvent, now: int) -> None:
+        with self.connection() as conn:
+            with conn:
+                conn.execute(
+                    """
+                    INSERT INTO outbox (event_id, event, next_attempt_at)
+                    VALUES (?, ?, ?)
+                    """,
+                    (SET.jti, JSONEncoder().encode(SET), now)
+                )
+
+    def claim_outbox_events(self, now: int, limit: int,
+                            lease_until: int) -> List[OutboxEvent]:
+        with self.connection() as conn:
+            # as with claim_due_SETs, take the write lock before reading
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                rows = conn.execute(
+                    """
+                    SELECT event_id, event, attempts + 1 FROM outbox
+                    WHERE next_attempt_at <= ?
+                    ORDER BY next_attempt_at, rowid
+                    LIMIT ?
+                    """,
+                    (now, limit)
+                ).fetchall()
+                conn.executemany(
+                    """
+                    UPDATE outbox SET attempts=attempts + 1, next_attempt_at=?
+                    WHERE event_id=?
+                    """,
+                    [(lease_until, row["event_id"]) for row in rows]
+                )
+                conn.commit()
+            except BaseException:
+                conn.rollback()
+                raise
+
+        return [OutboxEvent(*row) for row in rows]
+
+    def delete_outbox_event(self, event_id: str) -> None:
+        with self.connection() as conn:
+            with conn:
+                conn.execute(
+                    "DELETE FROM outbox WHERE event_id=?", (event_id,)
+                )
+
+    def reschedule_outbox_event(self, event_id: str,
+                                next_attempt_at: Optional[int]) -> None:
+        with self.connection() as conn:
+            with conn:
+                if next_attempt_at is not None:
+                    conn.execute(
+                        "UPDATE outbox SET next_attempt_at=? WHERE event_id=?",
+                        (next_attempt_at, event_id)
+                    )
+                    return
+                conn.execute(
+                    """
+                    INSERT OR REPLACE INTO outbox_failed
+                    (event_id, event, attempts)
+                    SELECT event_id, event, attempts FROM outbox
+                    WHERE event_id=?
+                    """,
+                    (event_id,)
+                )
+                conn.execute(
+                    "DELETE FROM outbox WHERE event_id=?", (event_id,)
+                )
+
+    def get_failed_outbox_events(self) -> List[OutboxEvent]:
+        with self.connection() as conn:
+            rows = conn.execute(
+                """
+                SELECT event_id, event, attempts FROM outbox_failed
+                ORDER BY rowid
+                """
+            ).fetchall()
+        return [OutboxEvent(*row) for row in rows]
@@ -0,0 +1,83 @@
+# Copyright (c) 2021 Cisco Systems, Inc. and its affiliates
+# All rights reserved.
+# Use of this source code is governed by a BSD 3-Clause License
+# that can be found in the LICENSE file.
+
+"""
+Serves the responses receivers fetch often but that hardly ever change: the
+JWKS and the transmitter configuration.
+
+Each is serialized once, with a strong ETag, and served from memory after
+that. The JWKS is serialized again when the keys are reloaded; the
+configuration only depends on the issuer and the URL root it was asked for
+at, so it is kept for each of those. A request whose If-None-Match has the
+ETag gets a 304 with no body.
+"""
+
+from functools import lru_cache
+import hashlib
+import json
+import os
+from typing import Any, NamedTuple, Optional, Tuple
+
+from flask import Response, request
+
+from swagger_server import business_logic
+from swagger_server.encoder import JSONEncoder
+from swagger_server import jwt_encode
+
+
+class Document(NamedTuple):
+    """A serialized response body, and its ETag"""
+    body: bytes
+    etag: str
+
+
+def make_document(obj: Any) -> Document:
+    body = json.dumps(
+        obj, separators=(",", ":"), cls=JSONEncoder
+    ).encode()
+    return Document(body, hashlib.sha256(body).hexdigest())
+
+
+def respond(document: Document, max_age: int) -> Response:
+    """The response for the current request: the document, or a 304 if the
+    receiver already has it
+    """
+    response = Response(document.body, mimetype="application/json")
+    response.set_etag(document.etag)
+    response.cache_control.public = True
+    response.cache_control.max_age = max_age
+    return response.make_conditional(request)
+
+
+# the keys the JWKS document was made from
+_jwks: Optional[Tuple[jwt_encode.Keys, Document]] = None
+
+
+def jwks_document() -> Document:
+    """The public JWKS, made again when the keys are reloaded"""
+    global _jwks
+
+    keys = jwt_encode.key_manager.current()
+    cached = _jwks
+    if cached is None or cached[0] is not keys:
+        cached = _jwks = (keys, make_document(keys.public))
+    return cached[1]
+
+
+@lru_cache(maxsize=int(os.environ.get("CONFIGURATION_CACHE_SIZE", 256)))
+def configuration_document(url_root: str,
+                           issuer: Optional[str] = None) -> Document:
+    """The transmitter configuration, as seen at url_root"""
+    return make_document(
+        business_logic._well_known_ssf_configuration_get(url_root, issuer)
+    )
+
+
+def jwks_max_age() -> int:
+    return int(os.environ.get("JWKS_MAX_AGE", 300))
+
+
+def configuration_max_age() -> int:
+    return int(os.environ.get("CONFIGURATION_MAX_AGE", 3600))
@@ -28,6 +28,25 @@ class LongPollingNotSupported(TransmitterError):
         super().__init__(404, message)
 
 
+class InvalidPollCursor(TransmitterError):
+    def __init__(self) -> None:
+        message = (
+            'The poll cursor is not valid. Please use the cursor from the '
+            'previous poll response, or leave it out to start from the '
+            'oldest unacknowledged SET.'
+        )
+        super().__init__(400, message)
+
+
+class QueueFull(TransmitterError):
+    def __init__(self) -> None:
+        message = (
+            'This stream has too many unacknowledged SETs. Please poll and '
+            'acknowledge the SETs already queued, then try again.'
+        )
+        super().__init__(429, message)
+
+
 class EmailSubjectNotFound(TransmitterError):
     def __init__(self, subject: Subject) -> None:
         message = f'Email not found in subject: {subject.dict()}'
@@ -3,8 +3,9 @@
 # Use of this source code is governed by a BSD 3-Clause License
 # that can be found in the LICENSE file.
 from enum import Enum
+import json
 import time
-from typing import ClassVar, Dict, Optional
+from typing import ClassVar, Dict, Optional, Tuple
 import uuid
 
 from pydantic import AnyUrl, BaseModel, Field
@@ -62,6 +63,12 @@ class AccountDisabledReason(Enum):
 
 class Event(BaseModel):
     __uri__: ClassVar[AnyUrl]
+    # the event types that an event of this type makes obsolete, if they
+    # came before it and are about the very same subject, every member of
+    # it included (see Events.subject_key). The transmitter may
+    # then send this event without them, e.g. once a paused stream is
+    # enabled again
+    __supersedes__: ClassVar[Tuple[str, ...]] = ()
 
     class Config:
         underscore_attrs_are_private = True
@@ -82,16 +89,26 @@ class AccountCredentialChangeRequired(RISCEvent):
 
 class AccountPurged(RISCEvent):
     __uri__ = f"{RISC_BASE_URI}/account-purged"
+    __supersedes__ = (
+        f"{RISC_BASE_URI}/account-disabled",
+        f"{RISC_BASE_URI}/account-enabled",
+        f"{RISC_BASE_URI}/account-purged",
+    )
 
 
 class AccountDisabled(RISCEvent):
     __uri__ = f"{RISC_BASE_URI}/account-disabled"
+    __supersedes__ = (
+        f"{RISC_BASE_URI}/account-disabled",
+        f"{RISC_BASE_URI}/account-enabled",
+    )
     # optional and enum
     reason: Optional[AccountDisabledReason] = AccountDisabledReason.hijacking
 
 
 class AccountEnabled(RISCEvent):
     __uri__ = f"{RISC_BASE_URI}/account-enabled"
+    __supersedes__ = AccountDisabled.__supersedes__
 
 
 class IdentifierChanged(RISCEvent):
@@ -112,20 +129,32 @@ class CredentialCompromise(RISCEvent):
     reason_user: Optional[Dict[str, str]]
 
 
+OPT_STATES = (
+    f"{RISC_BASE_URI}/opt-in",
+    f"{RISC_BASE_URI}/opt-out-initiated",
+    f"{RISC_BASE_URI}/opt-out-cancelled",
+    f"{RISC_BASE_URI}/opt-out-effective",
+)
+
+
 class OptIn(RISCEvent):
     __uri__ = f"{RISC_BASE_URI}/opt-in"
+    __supersedes__ = OPT_STATES
 
 
 class OptOutInitiated(RISCEvent):
     __uri__ = f"{RISC_BASE_URI}/opt-out-initiated"
+    __supersedes__ = OPT_STATES[1:3]
 
 
 class OptOutCancelled(RISCEvent):
     __uri__ = f"{RISC_BASE_URI}/opt-out-cancelled"
+    __supersedes__ = OPT_STATES[1:3]
 
 
 class OptOutEffective(RISCEvent):
     __uri__ = f"{RISC_BASE_URI}/opt-out-effective"
+    __supersedes__ = OPT_STATES
 
 
 class RecoveryActivated(RISCEvent):
@@ -151,11 +180,17 @@ class CAEPEvent(Event):
 class SessionRevoked(CAEPEvent):
     # class variable shared by all instances
     __uri__ = f"{CAEP_BASE_URI}/session-revoked"
+    # a revocation of the very same subject, session included, is only
+    # needed once. Revocations of other sessions are kept
+    __supersedes__ = (__uri__,)
 
 
 class TokenClaimsChange(CAEPEvent):
     # class variable shared by all instances
     __uri__ = f"{CAEP_BASE_URI}/token-claims-change"
+    # each carries the current claims for its subject, token included, so
+    # only the latest about the very same subject matters
+    __supersedes__ = (__uri__,)
     claims: Dict[str, str] = {"trusted_network": "false"}
 
 
@@ -173,6 +208,7 @@ class CredentialChange(CAEPEvent):
 class AssuranceLevelChange(CAEPEvent):
     # class variable shared by all instances
     __uri__ = f"{CAEP_BASE_URI}/assurance-level-change"
+    __supersedes__ = (__uri__,)
     current_level: AssuranceLevel = AssuranceLevel.nist_aal2
     previous_level: AssuranceLevel = AssuranceLevel.nist_aal1
     change_direction: AssuranceDirection = AssuranceDirection.increase
@@ -181,6 +217,7 @@ class AssuranceLevelChange(CAEPEvent):
 class DeviceComplianceChange(CAEPEvent):
     # class variable shared by all instances
     __uri__ = f"{CAEP_BASE_URI}/device-compliance-change"
+    __supersedes__ = (__uri__,)
     current_status: DeviceStatus = DeviceStatus.compliant
     previous_status: DeviceStatus = DeviceStatus.not_compliant
 
@@ -230,6 +267,36 @@ class Events(BaseModel):
     recovery_information_changed: Optional[RecoveryInformationChanged] = Field(
         alias=RecoveryInformationChanged.__uri__)
 
+    def get_event(self) -> Optional[Event]:
+        """The first non-null event in this events object"""
+        for name in self.__fields__:
+            event = getattr(self, name)
+            if event is not None:
+                return event
+        return None
+
+    def event_type(self) -> Optional[str]:
+        event = self.get_event()
+        return event.__uri__ if event is not None else None
+
+    def supersedes(self) -> Tuple[str, ...]:
+        """The event types this event makes obsolete, see Event"""
+        event = self.get_event()
+        return event.__supersedes__ if event is not None else ()
+
+    def subject_key(self) -> Optional[str]:
+        """The whole subject, in a canonical form: SETs only supersede SETs
+        about the very same subject, not just the same user. None if the
+        event has no subject
+        """
+        subject = getattr(self.get_event(), "subject", None)
+        if subject is None:
+            return None
+        return json.dumps(
+            subject.dict(exclude_none=True),
+            sort_keys=True, separators=(",", ":")
+        )
+
     def get_subject(self) -> Subject:
         """
         Retrieves the subject from
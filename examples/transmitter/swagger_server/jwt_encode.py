@@ -3,16 +3,30 @@
 # Use of this source code is governed by a BSD 3-Clause License
 # that can be found in the LICENSE file.
 
-from functools import lru_cache
+from concurrent.futures import ProcessPoolExecutor
+import json
+import logging
+import multiprocessing
 import os
 from pathlib import Path
-from typing import Any, Dict, List, Mapping, Optional, Union
+import threading
+from typing import (
+    Any, Dict, List, Mapping, NamedTuple, Optional, Sequence, Tuple, Union
+)
 
 from jwcrypto.jwk import JWK, JWKSet
 import jwt
+from jwt.algorithms import get_default_algorithms
+from jwt.utils import base64url_encode
 
 from swagger_server.encoder import JSONEncoder
 from swagger_server.events import SecurityEvent
+from swagger_server import metrics
+
+
+# the member of the JWKS file naming the key to sign with. Receivers ignore
+# JWKS members they don't know (RFC 7517 section 5), but it isn't published
+ACTIVE_MEMBER = "active"
 
 
 def make_jwk(key_id: str) -> JWK:
@@ -53,44 +67,405 @@ def get_jwks_path() -> Path:
     return Path(os.environ["JWKS_PATH"])
 
 
-def save_jwks(jwks: JWKSet) -> None:
-    """Save a JSON Web Key Set to the appropriate file location"""
+def save_jwks(jwks: JWKSet, active: Optional[str] = None) -> None:
+    """Save a JSON Web Key Set to the appropriate file location. If active
+    is passed in, the JWKS names it as the key to sign with, in place of
+    JWK_KEY_ID.
+
+    The file is replaced in one go, so that processes watching it never
+    read one half written
+    """
     jwks_path = get_jwks_path()
     jwks_path.parent.mkdir(parents=True, exist_ok=True)
 
-    with open(jwks_path, "w") as fout:
-        fout.write(jwks.export(private_keys=True))
+    data = json.loads(jwks.export(private_keys=True))
+    if active is not None:
+        data[ACTIVE_MEMBER] = active
+    temp_path = jwks_path.with_name(f".{jwks_path.name}.{os.getpid()}")
+    with open(temp_path, "w") as fout:
+        fout.write(json.dumps(data))
+    os.replace(temp_path, jwks_path)
 
+    # so that what was just saved is what is signed with from now on
+    key_manager.reload()
 
-@lru_cache
-def load_jwks() -> JWKSet:
-    """Load a JSON Web Key Set from the expected file location"""
+
+def read_jwks() -> JWKSet:
+    """Read the JSON Web Key Set from the expected file location, as it is
+    now. Signing goes by load_jwks instead
+    """
     jwks_path = get_jwks_path()
     with open(jwks_path) as fin:
         return JWKSet.from_json(fin.read())
 
 
+def load_jwks() -> JWKSet:
+    """Get the JSON Web Key Set that is being signed with, loading it from
+    the expected file location if it hasn't been yet
+    """
+    return key_manager.current().jwks
+
+
+class Signer:
+    """Signs SETs with one JWK. The private key is loaded and the protected
+    header encoded once, up front, so that signing a SET costs no more than
+    encoding its payload and the signature itself.
+
+    The JWS it makes has the same header and claims as jwt.encode would
+    make.
+    """
+
+    def __init__(self, jwk: JWK) -> None:
+        self.jwk = jwk
+        self.kid = jwk.kid
+        self.alg = jwk.alg
+        self._algorithm = get_default_algorithms()[jwk.alg]
+        self._key = self._algorithm.prepare_key(jwk.get_op_key("sign"))
+        header = json.dumps(
+            # https://www.rfc-editor.org/rfc/rfc8417.html#section-2.3
+            # in the order the pinned PyJWT writes them
+            {"typ": "secevent+jwt", "alg": jwk.alg, "kid": jwk.kid},
+            separators=(",", ":")
+        )
+        self._header = base64url_encode(header.encode())
+
+    def sign(self, payload: Dict[str, Any]) -> str:
+        claims = json.dumps(payload, separators=(",", ":"), cls=JSONEncoder)
+        signing_input = self._header + b"." + base64url_encode(
+            claims.encode()
+        )
+        signature = self._algorithm.sign(signing_input, self._key)
+        return (signing_input + b"." + base64url_encode(signature)).decode()
+
+
+# what a JWKS file is told apart by: device, inode, mtime and size
+FileStat = Tuple[int, int, int, int]
+
+jwks_reloads = metrics.counter(
+    "jwks_reloads_total", "Times the JWKS file was loaded"
+)
+jwks_reload_failures = metrics.counter(
+    "jwks_reload_failures_total",
+    "Times a changed JWKS file couldn't be loaded, so the keys loaded "
+    "before were kept"
+)
+
+
+class Keys(NamedTuple):
+    """One load of the JWKS file: the keys in it, a signer for each one that
+    has its private key, and the key set to publish.
+
+    active is the key to sign with: the one the file names, or else
+    JWK_KEY_ID. Every other key is retiring. It is still published, so SETs
+    it signed can still be verified, until it is taken out of the file
+    """
+    path: Path
+    stat: FileStat
+    jwks: JWKSet
+    active: str
+    signers: Dict[str, Signer]
+    public: Dict[str, Any]
+
+    @property
+    def signer(self) -> Signer:
+        signer = self.signers.get(self.active)
+        if signer is None:
+            raise KeyError(f"There is no JWK {self.active} in the JWKS")
+        return signer
+
+
+def _stat(stat: os.stat_result) -> FileStat:
+    return (stat.st_dev, stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+
+def _load_keys(path: Path) -> Keys:
+    with open(path) as fin:
+        stat = _stat(os.fstat(fin.fileno()))
+        data = json.loads(fin.read())
+
+    active = data.pop(ACTIVE_MEMBER, None) or os.environ["JWK_KEY_ID"]
+    jwks = JWKSet()
+    jwks.import_keyset(json.dumps(data))
+    signers = {
+        jwk.kid: Signer(jwk) for jwk in jwks["keys"] if jwk.has_private
+    }
+    public = jwks.export(private_keys=False, as_dict=True)
+    return Keys(path, stat, jwks, active, signers, public)
+
+
+class KeyManager:
+    """The keys SETs are signed with, kept up to date with the JWKS file.
+
+    Each load of the file is swapped in whole, so signing only ever reads
+    an attribute: it never waits on a reload. The file is loaded when the
+    keys are first needed, and a background thread then checks it every
+    interval seconds, loading it again when it is replaced or changed. A
+    file that doesn't load, or has no private key to sign with, is logged
+    and the keys loaded before are kept.
+
+    To rotate keys without a restart, add the new key to the file and name
+    it as the one to sign with (see rotate_jwk). The old one is published
+    until it is taken out (see retire_jwk), so receivers can still verify
+    SETs it signed.
+    """
+
+    def __init__(self, interval: Optional[float] = None) -> None:
+        self.interval = interval if interval is not None else float(
+            os.environ.get("JWKS_CHECK_INTERVAL", 5)
+        )
+        self._keys: Optional[Keys] = None
+        # held while loading, so the file is loaded once at a time
+        self._lock = threading.Lock()
+        # the last file that failed to load, so it is only logged once
+        self._failed: Optional[FileStat] = None
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def current(self) -> Keys:
+        """The keys loaded last, loading them if they haven't been yet"""
+        keys = self._keys
+        if keys is None:
+            with self._lock:
+                keys = self._keys
+                if keys is None:
+                    keys = self._load(get_jwks_path())
+        return keys
+
+    def reload(self) -> Keys:
+        """Load the JWKS file again, whether or not it has changed"""
+        with self._lock:
+            return self._load(get_jwks_path())
+
+    def _load(self, path: Path) -> Keys:
+        # must hold the lock
+        keys = _load_keys(path)
+        self._keys = keys
+        self._failed = None
+        jwks_reloads.inc()
+        return keys
+
+    def run_once(self) -> bool:
+        """Load the JWKS file again if it has changed since it was last
+        loaded, returning whether it was
+        """
+        keys = self._keys
+        if keys is None:
+            # not needed yet
+            return False
+        path = get_jwks_path()
+        try:
+            stat = _stat(os.stat(path))
+        except OSError:
+            logging.exception(f"Error checking the JWKS file {path}")
+            return False
+        if path == keys.path and stat == keys.stat:
+            return False
+
+        with self._lock:
+            if stat == self._failed:
+                return False
+            try:
+                new_keys = _load_keys(path)
+                if new_keys.active not in new_keys.signers:
+                    raise KeyError(
+                        f"There is no JWK {new_keys.active} in the JWKS"
+                    )
+            except Exception:
+                self._failed = stat
+                jwks_reload_failures.inc()
+                logging.exception(
+                    f"Error loading the JWKS file {path}, still signing "
+                    f"with {keys.active}"
+                )
+                return False
+            self._keys = new_keys
+            self._failed = None
+        jwks_reloads.inc()
+        if new_keys.active != keys.active:
+            logging.info(f"Signing SETs with {new_keys.active}")
+        return True
+
+    def clear(self) -> None:
+        """Forget the keys, so they are loaded again when next needed"""
+        with self._lock:
+            self._keys = None
+            self._failed = None
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval):
+            try:
+                self.run_once()
+            except Exception:
+                logging.exception("Error watching the JWKS file")
+
+    def start(self) -> None:
+        if self.interval <= 0 or self._thread is not None:
+            return
+        self._thread = threading.Thread(
+            target=self._run, name="jwks", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+
+key_manager = KeyManager()
+
+
+def rotate_jwk(key_id: str) -> None:
+    """Start signing with the JWK key_id, making it if the JWKS file doesn't
+    have it yet. The key signed with until now stays in the file, and so
+    published, until it is retired
+    """
+    jwks = read_jwks()
+    if jwks.get_key(key_id) is None:
+        add_jwk_to_jwks(make_jwk(key_id), jwks)
+    save_jwks(jwks, active=key_id)
+
+
+def retire_jwk(key_id: str) -> None:
+    """Take the JWK key_id out of the JWKS file. It can't be the one being
+    signed with
+    """
+    if key_id == _load_keys(get_jwks_path()).active:
+        raise ValueError(f"JWK {key_id} is still being signed with")
+    jwks = read_jwks()
+    jwk = jwks.get_key(key_id)
+    if jwk is None:
+        raise KeyError(f"There is no JWK {key_id} in the JWKS")
+    jwks["keys"].remove(jwk)
+    save_jwks(jwks)
+
+
+def signing_key() -> Signer:
+    """The signer for the key SETs are signed with now"""
+    return key_manager.current().signer
+
+
+def get_signer(key_id: str) -> Signer:
+    """Get the signer for the JWK with this kid"""
+    signer = key_manager.current().signers.get(key_id)
+    if signer is None:
+        raise KeyError(f"There is no JWK {key_id} in the JWKS")
+    return signer
+
+
+def public_jwks() -> Dict[str, Any]:
+    """The JWKS to publish, without the private keys"""
+    return key_manager.current().public
+
+
+def _payload(security_event_token: SecurityEvent) -> Dict[str, Any]:
+    return security_event_token.dict(exclude_none=True, by_alias=True)
+
+
 # TODO: make annotation for the SET a pydantic model
 def encode_set(security_event_token: SecurityEvent) -> str:
     """This runs on the transmitter. Encodes a SET using EC256"""
-    # get the key id of the JWK we want to use
-    key_id = os.environ["JWK_KEY_ID"]
-
-    # select the right JWK with the key_id
-    jwk = load_jwks().get_key(key_id)
-    private_key = jwk.export_to_pem(private_key=True, password=None)
-
-    return jwt.encode(
-        payload=security_event_token.dict(exclude_none=True, by_alias=True),
-        key=private_key,
-        algorithm=jwk.alg,
-        headers=dict(
-            kid=key_id,
-            typ="secevent+jwt"
-            # https://www.rfc-editor.org/rfc/rfc8417.html#section-2.3
-        ),
-        json_encoder=JSONEncoder
-    )
+    # sign with the JWK we want to use
+    return signing_key().sign(_payload(security_event_token))
+
+
+# the signer in each of the signing pool's worker processes
+_worker_signer: Optional[Signer] = None
+
+
+def _init_worker(jwk_json: str) -> None:
+    global _worker_signer
+    _worker_signer = Signer(JWK.from_json(jwk_json))
+
+
+def _sign_chunk(payloads: List[Dict[str, Any]]) -> List[str]:
+    assert _worker_signer is not None
+    return [_worker_signer.sign(payload) for payload in payloads]
+
+
+class SigningPool:
+    """Worker processes that sign SETs, so that signing a large batch isn't
+    held to one core by the GIL.
+
+    Each worker is handed the JWK when it starts and keeps a signer for it.
+    The pool is started the first time a large enough batch comes along,
+    and started again with the new key if the keys are reloaded.
+    Batches smaller than min_batch are signed in process, where handing
+    them to the workers would cost more than it saves.
+    """
+
+    def __init__(self, processes: Optional[int] = None,
+                 min_batch: Optional[int] = None) -> None:
+        self.processes = processes or int(
+            os.environ.get("SIGNING_PROCESSES", 0)
+        ) or os.cpu_count() or 1
+        self.min_batch = min_batch or int(
+            os.environ.get("SIGNING_MIN_BATCH", 256)
+        )
+        self._lock = threading.Lock()
+        self._executor: Optional[ProcessPoolExecutor] = None
+        # the signer the running workers were started with
+        self._signer: Optional[Signer] = None
+
+    def encode(self, SETs: Sequence[SecurityEvent]) -> List[str]:
+        """Sign the SETs, in order"""
+        if not SETs:
+            return []
+        signer = signing_key()
+        payloads = [_payload(SET) for SET in SETs]
+        if self.processes <= 1 or len(payloads) < self.min_batch:
+            return [signer.sign(payload) for payload in payloads]
+
+        # a chunk per worker, so each one goes through the pipe in one go
+        size = -(-len(payloads) // self.processes)
+        chunks = [payloads[i:i + size] for i in range(0, len(payloads), size)]
+        try:
+            executor = self._executor_for(signer)
+            return [
+                jws
+                for signed in executor.map(_sign_chunk, chunks)
+                for jws in signed
+            ]
+        except Exception:
+            logging.exception("Error signing in the signing pool")
+            self.shutdown()
+            return [signer.sign(payload) for payload in payloads]
+
+    def _executor_for(self, signer: Signer) -> ProcessPoolExecutor:
+        with self._lock:
+            if self._executor is not None and self._signer is signer:
+                return self._executor
+            if self._executor is not None:
+                self._executor.shutdown(wait=False)
+
+            # spawn rather than fork, as forking a process that is running
+            # threads can leave locks held for good in the child
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.processes,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_init_worker,
+                initargs=(signer.jwk.export(private_key=True),)
+            )
+            self._signer = signer
+            return self._executor
+
+    def shutdown(self) -> None:
+        with self._lock:
+            executor, self._executor = self._executor, None
+            self._signer = None
+        if executor is not None:
+            executor.shutdown(wait=False)
+
+
+signing_pool = SigningPool()
+
+
+def encode_sets(SETs: Sequence[SecurityEvent]) -> List[str]:
+    """Encode many SETs at once, spreading large batches over the signing
+    pool's processes. Returns the JWSs in the same order
+    """
+    return signing_pool.encode(SETs)
 
 
 # TODO: make annotation for the SET a pydantic model
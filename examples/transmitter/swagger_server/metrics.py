@@ -0,0 +1,351 @@
+# Copyright (c) 2021 Cisco Systems, Inc. and its affiliates
+# All rights reserved.
+# Use of this source code is governed by a BSD 3-Clause License
+# that can be found in the LICENSE file.
+
+"""
+In-process metrics for things an operator will want to keep an eye on. Each
+worker process keeps its own, and serves them in the Prometheus text format
+for a scraper to pick up (see MetricsServer).
+"""
+
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import logging
+import math
+import os
+import threading
+from typing import (
+    Callable, Dict, Generic, List, Optional, Sequence, Tuple, Type, TypeVar,
+    Union, cast
+)
+
+# for how long things take, in seconds
+LATENCY_BUCKETS = (
+    0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10
+)
+# for how long things wait, in seconds
+AGE_BUCKETS = (1, 5, 15, 60, 300, 900, 3600, 21600, 86400)
+
+
+class Counter:
+    """A thread-safe count that only goes up"""
+
+    def __init__(self, name: str, description: str) -> None:
+        self.name = name
+        self.description = description
+        self._value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount: int = 1) -> None:
+        with self._lock:
+            self._value += amount
+
+    @property
+    def value(self) -> int:
+        return self._value
+
+
+class Gauge:
+    """A value that can go up and down, e.g. how far behind something is"""
+
+    def __init__(self, name: str, description: str) -> None:
+        self.name = name
+        self.description = description
+        self.value: float = 0
+        self._lock = threading.Lock()
+
+    def set(self, value: float) -> None:
+        self.value = value
+
+    def inc(self, amount: float = 1) -> None:
+        with self._lock:
+            self.value += amount
+
+    def dec(self, amount: float = 1) -> None:
+        self.inc(-amount)
+
+
+class Histogram:
+    """How many observed values, e.g. latencies, fell at or under each of
+    the bucket bounds, along with their count and sum
+    """
+
+    def __init__(self, name: str, description: str,
+                 buckets: Sequence[float] = LATENCY_BUCKETS) -> None:
+        self.name = name
+        self.description = description
+        self.buckets = tuple(sorted(buckets))
+        # one more for the values over the last bound
+        self._counts = [0] * (len(self.buckets) + 1)
+        self._sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float) -> None:
+        i = bisect_left(self.buckets, value)
+        with self._lock:
+            self._counts[i] += 1
+            self._sum += value
+
+    @property
+    def count(self) -> int:
+        return sum(self._counts)
+
+    @property
+    def sum(self) -> float:
+        return self._sum
+
+    def cumulative(self) -> Tuple[List[int], float]:
+        """The count at or under each bound, +Inf last, and the sum"""
+        with self._lock:
+            counts, total = list(self._counts), self._sum
+        for i in range(1, len(counts)):
+            counts[i] += counts[i - 1]
+        return counts, total
+
+
+M = TypeVar("M", Counter, Gauge, Histogram)
+
+
+class Family(Generic[M]):
+    """A metric per combination of label values, e.g. per receiver, made
+    the first time it is asked for
+    """
+
+    def __init__(self, cls: Type[M], name: str, description: str,
+                 labels: Sequence[str], **kwargs) -> None:
+        self.cls = cls
+        self.name = name
+        self.description = description
+        self.label_names = tuple(labels)
+        self._kwargs = kwargs
+        self._children: Dict[Tuple[str, ...], M] = {}
+        self._lock = threading.Lock()
+
+    def labels(self, *values: str) -> M:
+        child = self._children.get(values)
+        if child is not None:
+            return child
+        if len(values) != len(self.label_names):
+            raise ValueError(f"{self.name} takes labels {self.label_names}")
+        with self._lock:
+            if values not in self._children:
+                self._children[values] = self.cls(
+                    self.name, self.description, **self._kwargs
+                )
+            return self._children[values]
+
+    def children(self) -> List[Tuple[Tuple[str, ...], M]]:
+        with self._lock:
+            return list(self._children.items())
+
+
+class Collected:
+    """A gauge per label value that is too costly to keep up to date as
+    things happen, e.g. how deep every queue is, so it is read when the
+    metrics are scraped instead
+    """
+
+    def __init__(self, name: str, description: str, label: str,
+                 collect: Callable[[], Dict[str, float]],
+                 cls: type = Gauge) -> None:
+        self.name = name
+        self.description = description
+        self.label_names = (label,)
+        self.collect = collect
+        # Counter for values that only go up, e.g. counts kept elsewhere
+        self.cls = cls
+
+
+Metric = Union[Counter, Gauge, Histogram, Family, Collected]
+
+_metrics: Dict[str, Metric] = {}
+_metrics_lock = threading.Lock()
+
+
+def _get(cls: type, name: str, description: str,
+         make: Optional[Callable[[], Metric]] = None) -> Metric:
+    with _metrics_lock:
+        if name not in _metrics:
+            _metrics[name] = make() if make else cls(name, description)
+        metric = _metrics[name]
+    if not isinstance(metric, cls):
+        raise TypeError(f"{name} is already a {type(metric).__name__}")
+    return metric
+
+
+def counter(name: str, description: str) -> Counter:
+    """Get the counter with this name, making it if need be"""
+    return cast(Counter, _get(Counter, name, description))
+
+
+def gauge(name: str, description: str) -> Gauge:
+    """Get the gauge with this name, making it if need be"""
+    return cast(Gauge, _get(Gauge, name, description))
+
+
+def histogram(name: str, description: str,
+              buckets: Sequence[float] = LATENCY_BUCKETS) -> Histogram:
+    """Get the histogram with this name, making it if need be"""
+    return cast(Histogram, _get(
+        Histogram, name, description,
+        lambda: Histogram(name, description, buckets)
+    ))
+
+
+def family(cls: Type[M], name: str, description: str,
+           labels: Sequence[str], **kwargs) -> Family[M]:
+    """Get the family of cls metrics with this name, labelled with labels,
+    making it if need be. kwargs are passed on to each metric, e.g. buckets
+    """
+    return cast(Family[M], _get(
+        Family, name, description,
+        lambda: Family(cls, name, description, labels, **kwargs)
+    ))
+
+
+def collected(name: str, description: str, label: str,
+              collect: Callable[[], Dict[str, float]],
+              cls: type = Gauge) -> Collected:
+    """Register a gauge (or, with cls=Counter, a counter) whose values
+    collect reads, labelled by the keys of what it returns, at scrape time
+    """
+    return cast(Collected, _get(
+        Collected, name, description,
+        lambda: Collected(name, description, label, collect, cls)
+    ))
+
+
+def snapshot() -> Dict[str, float]:
+    """The current value of every counter and gauge"""
+    with _metrics_lock:
+        return {
+            name: m.value for name, m in _metrics.items()
+            if isinstance(m, (Counter, Gauge))
+        }
+
+
+def _format_value(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    if isinstance(value, int) or value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str]) -> str:
+    if not names:
+        return ""
+    pairs = ",".join(
+        '{}="{}"'.format(name, str(value).replace("\\", "\\\\")
+                         .replace("\n", "\\n").replace('"', '\\"'))
+        for name, value in zip(names, values)
+    )
+    return "{" + pairs + "}"
+
+
+def _type_of(metric: Metric) -> str:
+    cls = metric.cls if isinstance(metric, (Family, Collected)) \
+        else type(metric)
+    return {Counter: "counter", Histogram: "histogram"}.get(cls, "gauge")
+
+
+def _samples(metric: Union[Counter, Gauge, Histogram], names: Sequence[str],
+             values: Sequence[str]) -> List[str]:
+    if not isinstance(metric, Histogram):
+        return [f"{metric.name}{_format_labels(names, values)} "
+                f"{_format_value(metric.value)}"]
+
+    counts, total = metric.cumulative()
+    lines = []
+    bounds = (*metric.buckets, math.inf)
+    for bound, count in zip(bounds, counts):
+        labels = _format_labels((*names, "le"),
+                                (*values, _format_value(bound)))
+        lines.append(f"{metric.name}_bucket{labels} {count}")
+    labels = _format_labels(names, values)
+    lines.append(f"{metric.name}_sum{labels} {_format_value(total)}")
+    lines.append(f"{metric.name}_count{labels} {counts[-1]}")
+    return lines
+
+
+def exposition() -> str:
+    """Every metric, in the Prometheus text exposition format"""
+    with _metrics_lock:
+        metrics = sorted(_metrics.items())
+
+    lines: List[str] = []
+    for name, metric in metrics:
+        lines.append(f"# HELP {name} {metric.description}")
+        lines.append(f"# TYPE {name} {_type_of(metric)}")
+        if isinstance(metric, Family):
+            for values, child in metric.children():
+                lines.extend(_samples(child, metric.label_names, values))
+        elif isinstance(metric, Collected):
+            try:
+                collected = metric.collect()
+            except Exception:
+                logging.exception(f"Error collecting {name}")
+                continue
+            for value, sample in sorted(collected.items()):
+                lines.append(
+                    f"{name}{_format_labels(metric.label_names, (value,))} "
+                    f"{_format_value(sample)}"
+                )
+        else:
+            lines.extend(_samples(metric, (), ()))
+    return "\n".join(lines) + "\n"
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def do_GET(self) -> None:
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = exposition().encode()
+        self.send_response(200)
+        self.send_header("Content-Type",
+                         "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format: str, *args) -> None:
+        # scrapes every few seconds would drown out the rest of the log
+        pass
+
+
+class MetricsServer:
+    """Serves /metrics over plain HTTP on its own port, away from the API.
+
+    It only listens on localhost by default, as the metrics name streams
+    and receivers.
+    """
+
+    def __init__(self, host: Optional[str] = None,
+                 port: Optional[int] = None) -> None:
+        self.host = host or os.environ.get("METRICS_HOST", "127.0.0.1")
+        self.port = port if port is not None else int(
+            os.environ.get("METRICS_PORT", 9464)
+        )
+        self._server: Optional[ThreadingHTTPServer] = None
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self) -> None:
+        if self.port <= 0 or self._server is not None:
+            return
+        self._server = ThreadingHTTPServer((self.host, self.port), _Handler)
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(
+            target=self._server.serve_forever, name="metrics", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self) -> None:
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
@@ -127,6 +127,13 @@ class RegisterResponse(BaseModel):
     )
 
 
+class TriggerEventResponse(BaseModel):
+    event_id: str = Field(
+        ...,
+        description='The id of the event. This is the jti of the SETs sent out for it.',
+    )
+
+
 class EventType(Enum):
     """
     Supports all [RISC](https://openid.net/specs/openid-risc-profile-specification-1_0-01.html) and [CAEP](https://openid.net/specs/openid-caep-specification-1_0-ID1.html) event types.
@@ -164,6 +171,10 @@ class PollParameters(BaseModel):
         None,
         description='List of event JTIs that the receiver is acknowledging. The Transmitter can stop keeping track of these.',
     )
+    cursor: Optional[str] = Field(
+        None,
+        description='Not part of the spec. An OPTIONAL opaque cursor, as returned in the "cursor" member of a previous\npoll response when "moreAvailable" is true. If present, SETs queued before the ones already returned\nare skipped, so that large queues can be paged through without acknowledging every SET first.',
+    )
 
 
 class RegisterParameters(BaseModel):
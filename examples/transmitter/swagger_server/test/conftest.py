@@ -5,7 +5,7 @@
 
 import logging
 import os
-from typing import Iterator
+from typing import Iterator, List
 import uuid
 
 import connexion
@@ -13,21 +13,68 @@ from flask.testing import FlaskClient
 from flask import Flask
 import py
 import pytest
+from _pytest.config import Config
 from _pytest.monkeypatch import MonkeyPatch
+from _pytest.nodes import Item
 
 from swagger_server import db
-from swagger_server.business_logic.stream import Stream
+from swagger_server.business_logic.delivery import (
+    breakers, limiters, push_engine
+)
+from swagger_server.business_logic.stream import (
+    Stream, stream_cache, unknown_stream_cache
+)
 from swagger_server.encoder import JSONEncoder
 from swagger_server.errors import register_error_handlers
 from swagger_server import jwt_encode
 
 
+def pytest_configure(config: Config) -> None:
+    config.addinivalue_line(
+        "markers", "benchmark: slow benchmark, only run with RUN_BENCHMARKS=1"
+    )
+
+
+def pytest_collection_modifyitems(config: Config,
+                                  items: List[Item]) -> None:
+    if os.environ.get("RUN_BENCHMARKS"):
+        return
+
+    skip_benchmark = pytest.mark.skip(reason="needs RUN_BENCHMARKS=1")
+    for item in items:
+        if "benchmark" in item.keywords:
+            item.add_marker(skip_benchmark)
+
+
 @pytest.fixture
-def temp_db(monkeypatch, tmpdir) -> None:
+def temp_db(monkeypatch, tmpdir) -> Iterator[None]:
     db_id = uuid.uuid1().hex
     db_path = tmpdir.join(f"{db_id}.db")
     monkeypatch.setenv("DB_PATH", str(db_path))
     db.create()
+    yield
+    db.close()
+
+
+@pytest.fixture(autouse=True)
+def drain_pushes() -> Iterator[None]:
+    """Don't let pushes started by one test run on into the next one's
+    database, nor receivers one test took down or slowed down look that way
+    to the next
+    """
+    yield
+    assert push_engine.drain(timeout=10)
+    breakers.clear()
+    limiters.clear()
+
+
+@pytest.fixture(autouse=True)
+def clear_stream_cache() -> None:
+    """Each test gets its own database, so don't let cached streams
+    leak between them
+    """
+    stream_cache.clear()
+    unknown_stream_cache.clear()
 
 
 @pytest.fixture
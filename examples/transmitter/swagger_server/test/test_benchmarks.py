@@ -0,0 +1,369 @@
+# Copyright (c) 2021 Cisco Systems, Inc. and its affiliates
+# All rights reserved.
+# Use of this source code is governed by a BSD 3-Clause License
+# that can be found in the LICENSE file.
+
+"""
+Benchmarks for the hot paths of the transmitter. These are slow, so they only
+run when asked for:
+
+    RUN_BENCHMARKS=1 python3 -m pytest swagger_server/test/test_benchmarks.py -s
+"""
+
+import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import ipaddress
+import json
+import ssl
+import threading
+import time
+from typing import Iterator, List, Optional
+from unittest.mock import Mock, patch
+import uuid
+
+from cryptography import x509
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import ec
+from cryptography.x509.oid import NameOID
+import pytest
+
+from swagger_server import business_logic, db
+from swagger_server.business_logic.generate_event import (
+    generate_security_event
+)
+from swagger_server.business_logic import delivery
+from swagger_server.business_logic.delivery import DeliveryEngine, PushJob
+from swagger_server.business_logic.outbox import Dispatcher
+from swagger_server.business_logic.replay import (
+    Replayer, lease_until as replay_lease_until
+)
+from swagger_server.business_logic.sessions import SessionPool
+from swagger_server.business_logic.stream import Stream
+from swagger_server.db.sqlite import SQLiteBackend
+from swagger_server.models import (
+    EventType, PushDeliveryMethod, Status, Subject
+)
+
+
+pytestmark = pytest.mark.benchmark
+
+
+def seed_streams(n_streams: int,
+                 email: Optional[str] = None) -> List[str]:
+    """Bulk insert poll streams without going through Stream.save,
+    optionally following a subject
+    """
+    stream = Stream(uuid.uuid4().hex, "https://popular-app.com", save=False)
+    rows = []
+    for _ in range(n_streams):
+        client_id = uuid.uuid4().hex
+        stream_data = dict(
+            client_id=client_id,
+            config=stream.config.dict(),
+            status=Status.enabled.value
+        )
+        rows.append((client_id, json.dumps(stream_data), Status.enabled.value))
+
+    backend = db.get_backend()
+    if not isinstance(backend, SQLiteBackend):
+        for client_id, stream_data, status in rows:
+            backend.save_stream(client_id, stream_data, Status(status))
+            if email:
+                backend.add_subject(client_id, email)
+        return [row[0] for row in rows]
+
+    with backend.connection() as conn:
+        with conn:
+            conn.executemany(
+                """
+                INSERT INTO streams (client_id, stream_data, status)
+                VALUES (?, ?, ?)
+                """,
+                rows
+            )
+            if email:
+                conn.executemany(
+                    "INSERT INTO subjects VALUES (?, ?, ?)",
+                    [(row[0], email, Status.enabled.value) for row in rows]
+                )
+
+    return [row[0] for row in rows]
+
+
+def report(name: str, n: int, seconds: float) -> None:
+    print(f"\n{name}: {n} in {seconds:.3f}s ({n / seconds:,.0f}/s)")
+
+
+def test_broadcast__one_subscriber(temp_db: None) -> None:
+    """A broadcast should only cost as much as the streams that follow the
+    subject, no matter how many streams are registered"""
+    n_streams = 100_000
+    email = "foo@bar.com"
+    seed_streams(n_streams)
+
+    follower = Stream(uuid.uuid4().hex, "https://popular-app.com")
+    follower.add_subject(email)
+
+    subject = Subject.parse_obj({"format": "email", "email": email})
+    SET = generate_security_event(EventType.session_revoked, subject)
+
+    start = time.perf_counter()
+    Stream.broadcast_SET(SET)
+    routed = time.perf_counter() - start
+    report("routed broadcast", 1, routed)
+
+    # the old approach loaded every stream and checked the subject
+    # one by one; time a sample of it to compare against
+    sample = db.get_stream_ids()[:1000]
+    start = time.perf_counter()
+    for client_id in sample:
+        _stream = Stream.load(client_id)
+        try:
+            _stream.get_subject_status(email)
+        except Exception:
+            pass
+    per_stream = (time.perf_counter() - start) / len(sample)
+    report("per-stream scan (extrapolated)", n_streams, per_stream * n_streams)
+
+    assert follower.count_SETs() == 1
+    assert routed < per_stream * n_streams
+
+
+def test_broadcast__many_poll_subscribers(temp_db: None) -> None:
+    """A broadcast to many polling streams should be written in a single
+    transaction rather than one per stream"""
+    n_streams = 5_000
+    email = "foo@bar.com"
+    client_ids = seed_streams(n_streams, email)
+
+    subject = Subject.parse_obj({"format": "email", "email": email})
+    SET = generate_security_event(EventType.session_revoked, subject)
+
+    start = time.perf_counter()
+    Stream.broadcast_SET(SET)
+    report("broadcast to poll streams", n_streams, time.perf_counter() - start)
+
+    assert all(db.count_SETs(client_id) == 1 for client_id in client_ids)
+
+
+def test_trigger_event__outbox(temp_db: None) -> None:
+    """Triggering an event should cost the same however many streams follow
+    the subject, the fan-out being left to the dispatcher"""
+    n_streams = 1_000
+    n_events = 20
+    email = "foo@bar.com"
+    subject = Subject.parse_obj({"format": "email", "email": email})
+
+    def trigger_events() -> float:
+        start = time.perf_counter()
+        for _ in range(n_events):
+            business_logic.trigger_event(EventType.session_revoked, subject)
+        return time.perf_counter() - start
+
+    unfollowed = trigger_events()
+    report("triggered, no followers", n_events, unfollowed)
+    Dispatcher(batch_size=n_events).run_once()
+
+    client_ids = seed_streams(n_streams, email)
+    followed = trigger_events()
+    report(f"triggered, {n_streams} followers", n_events, followed)
+
+    start = time.perf_counter()
+    dispatched = Dispatcher(batch_size=n_events).run_once()
+    report("dispatched", dispatched, time.perf_counter() - start)
+
+    assert dispatched == n_events
+    assert db.count_SETs(client_ids[0]) == n_events
+    assert followed < unfollowed * 3
+
+
+@pytest.mark.parametrize("n_shards", [1, 4])
+def test_concurrent_writes__shards(temp_db: None, monkeypatch,
+                                   n_shards: int) -> None:
+    """Writes for streams on different shards shouldn't wait on each
+    other's write lock"""
+    monkeypatch.setenv("DB_BACKEND", "sqlite")
+    monkeypatch.setenv("DB_SHARDS", str(n_shards))
+    db.create()
+
+    n_threads = 8
+    n_writes = 200
+    client_ids = [uuid.uuid4().hex for _ in range(n_threads)]
+    subject = Subject.parse_obj({"format": "email", "email": "foo@bar.com"})
+
+    def write(client_id: str) -> None:
+        for _ in range(n_writes):
+            SET = generate_security_event(EventType.session_revoked, subject)
+            db.add_set(client_id, SET)
+
+    threads = [
+        threading.Thread(target=write, args=(client_id,))
+        for client_id in client_ids
+    ]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    report(f"writes across {n_shards} shard(s)", n_threads * n_writes,
+           time.perf_counter() - start)
+
+    assert all(db.count_SETs(client_id) == n_writes
+               for client_id in client_ids)
+
+
+def make_cert(tmpdir) -> str:
+    """A self-signed certificate and key for 127.0.0.1, in one PEM file"""
+    key = ec.generate_private_key(ec.SECP256R1())
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, "127.0.0.1")])
+    now = datetime.datetime.utcnow()
+    cert = (
+        x509.CertificateBuilder()
+        .subject_name(name)
+        .issuer_name(name)
+        .public_key(key.public_key())
+        .serial_number(x509.random_serial_number())
+        .not_valid_before(now - datetime.timedelta(days=1))
+        .not_valid_after(now + datetime.timedelta(days=1))
+        .add_extension(
+            x509.SubjectAlternativeName(
+                [x509.IPAddress(ipaddress.ip_address("127.0.0.1"))]
+            ),
+            critical=False
+        )
+        .add_extension(
+            x509.BasicConstraints(ca=True, path_length=None), critical=True
+        )
+        .sign(key, hashes.SHA256())
+    )
+    path = str(tmpdir.join("receiver.pem"))
+    with open(path, "wb") as fout:
+        fout.write(key.private_bytes(
+            serialization.Encoding.PEM,
+            serialization.PrivateFormat.PKCS8,
+            serialization.NoEncryption()
+        ))
+        fout.write(cert.public_bytes(serialization.Encoding.PEM))
+    return path
+
+
+class ReceiverHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self) -> None:
+        self.rfile.read(int(self.headers["Content-Length"]))
+        self.send_response(202)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, *args) -> None:
+        pass
+
+
+class TLSReceiver(ThreadingHTTPServer):
+    """A stand-in push receiver that counts TLS handshakes"""
+    daemon_threads = True
+
+    def __init__(self, cert_path: str) -> None:
+        super().__init__(("127.0.0.1", 0), ReceiverHandler)
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.load_cert_chain(cert_path)
+        self.socket = context.wrap_socket(self.socket, server_side=True)
+        self.handshakes = 0
+
+    def get_request(self):
+        request = super().get_request()
+        self.handshakes += 1
+        return request
+
+    @property
+    def url(self) -> str:
+        return f"https://127.0.0.1:{self.server_address[1]}/push"
+
+
+@pytest.fixture
+def tls_receiver(tmpdir, monkeypatch) -> Iterator[TLSReceiver]:
+    cert_path = make_cert(tmpdir)
+    monkeypatch.setenv("REQUESTS_CA_BUNDLE", cert_path)
+    receiver = TLSReceiver(cert_path)
+    thread = threading.Thread(target=receiver.serve_forever, daemon=True)
+    thread.start()
+    yield receiver
+    receiver.shutdown()
+    receiver.server_close()
+
+
+@pytest.mark.parametrize("keepalive", [False, True])
+def test_push__keepalive(temp_db: None, with_jwks: None, monkeypatch,
+                         tls_receiver: TLSReceiver, keepalive: bool) -> None:
+    """Pushes to the same receiver should reuse connections rather than
+    paying for a TLS handshake every time"""
+    n_pushes = 500
+    monkeypatch.setattr(
+        delivery, "session_pool", SessionPool(idle_timeout=60 if keepalive else 0)
+    )
+    engine = DeliveryEngine(per_endpoint=4)
+
+    subject = Subject.parse_obj({"format": "email", "email": "foo@bar.com"})
+    SET = generate_security_event(EventType.session_revoked, subject)
+    jws = "header.payload.signature"
+
+    start = time.perf_counter()
+    for i in range(n_pushes):
+        engine.submit(
+            PushJob(f"stream-{i}", tls_receiver.url, None, SET, jws)
+        )
+    assert engine.drain(timeout=60)
+    report(f"pushes, keep-alive {'on' if keepalive else 'off'}", n_pushes,
+           time.perf_counter() - start)
+    print(f"TLS handshakes: {tls_receiver.handshakes}")
+
+    if keepalive:
+        assert tls_receiver.handshakes <= engine.per_endpoint
+    else:
+        assert tls_receiver.handshakes == n_pushes
+
+
+@pytest.mark.parametrize("concurrency", [1, 16])
+def test_replay__backlog(temp_db: None, monkeypatch,
+                         concurrency: int) -> None:
+    """Replaying a paused push stream's backlog should push many subjects
+    at once, so that it isn't bound by one receiver round trip per SET"""
+    n_SETs = 100_000
+    n_subjects = 1_000
+    latency = 0.001
+    stream = Stream(uuid.uuid4().hex, "https://popular-app.com")
+    stream.config.delivery = PushDeliveryMethod(
+        endpoint_url="https://receiver.com/push"
+    )
+    stream.save()
+
+    subject = Subject.parse_obj({"format": "email", "email": "foo@bar.com"})
+    SET = generate_security_event(EventType.session_revoked, subject)
+    for start in range(0, n_SETs, 10_000):
+        db.add_sets([
+            db.PendingSET(
+                stream.client_id, SET.copy(update={"jti": uuid.uuid4().hex}),
+                jws="header.payload.signature",
+                subject=f"user-{i % n_subjects}@bar.com", held=True
+            )
+            for i in range(start, start + 10_000)
+        ])
+
+    accepted = Mock()
+
+    def post(*args, **kwargs) -> Mock:
+        time.sleep(latency)
+        return accepted
+
+    replayer = Replayer(concurrency=concurrency)
+    released_at = replay_lease_until()
+    db.release_SETs(stream.client_id, None, released_at)
+    with patch('requests.Session.post', new=post):
+        start = time.perf_counter()
+        replayed = replayer.run(stream, released_at)
+        report(f"replayed, {concurrency} at a time", replayed,
+               time.perf_counter() - start)
+
+    assert replayed == n_SETs
+    assert stream.count_SETs() == 0
@@ -0,0 +1,224 @@
+# Copyright (c) 2021 Cisco Systems, Inc. and its affiliates
+# All rights reserved.
+# Use of this source code is governed by a BSD 3-Clause License
+# that can be found in the LICENSE file.
+
+from typing import Iterator
+from unittest.mock import Mock, patch
+import uuid
+
+import pytest
+import requests
+
+from swagger_server.business_logic import breaker, delivery
+from swagger_server.business_logic.breaker import (
+    BreakerRegistry, BreakerState, CircuitBreaker
+)
+from swagger_server.business_logic.stream import Stream
+from swagger_server.events import Events, SecurityEvent, VerificationEvent
+from swagger_server.models import PushDeliveryMethod
+from swagger_server import metrics
+
+
+class FakeClock:
+    def __init__(self) -> None:
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def make_breaker(clock: FakeClock) -> CircuitBreaker:
+    return CircuitBreaker("https://receiver.com", window=60, min_pushes=4,
+                          error_rate=0.5, slow_push=5, open_for=30,
+                          clock=clock)
+
+
+def trip(breaker: CircuitBreaker) -> None:
+    for _ in range(4):
+        assert breaker.allow()
+        breaker.record(False, 0.1)
+
+
+class TestCircuitBreaker:
+    def test_opens_on_errors(self) -> None:
+        clock = FakeClock()
+        cb = make_breaker(clock)
+
+        for ok in (True, True, False):
+            cb.record(ok, 0.1)
+        # not enough pushes to go on yet
+        assert cb.state == BreakerState.closed
+        cb.record(False, 0.1)
+
+        assert cb.state == BreakerState.open
+        assert not cb.available()
+        assert not cb.allow()
+
+    def test_opens_on_slow_pushes(self) -> None:
+        clock = FakeClock()
+        cb = make_breaker(clock)
+
+        for latency in (0.1, 0.1, 6, 6):
+            cb.record(True, latency)
+
+        assert cb.state == BreakerState.open
+        assert cb.health()["slow"] == 2
+
+    def test_window_rolls(self) -> None:
+        """Ensures failures from long ago don't count"""
+        clock = FakeClock()
+        cb = make_breaker(clock)
+        for _ in range(3):
+            cb.record(False, 0.1)
+
+        clock.now += 61
+        cb.record(True, 0.1)
+        cb.record(False, 0.1)
+
+        assert cb.state == BreakerState.closed
+        assert cb.health()["pushes"] == 2
+
+    def test_half_open_probe_closes(self) -> None:
+        clock = FakeClock()
+        cb = make_breaker(clock)
+        trip(cb)
+
+        clock.now += 30
+        assert cb.state == BreakerState.half_open
+        assert cb.available()
+        # only one probe at a time
+        assert cb.allow()
+        assert not cb.allow()
+
+        cb.record(True, 0.1)
+        assert cb.state == BreakerState.closed
+        assert cb.allow()
+
+    def test_half_open_probe_reopens(self) -> None:
+        clock = FakeClock()
+        cb = make_breaker(clock)
+        trip(cb)
+
+        clock.now += 30
+        assert cb.allow()
+        cb.record(False, 0.1)
+
+        assert cb.state == BreakerState.open
+        clock.now += 29
+        assert not cb.allow()
+        clock.now += 1
+        assert cb.allow()
+
+    def test_lost_probe(self) -> None:
+        """Ensures a probe that never reports back doesn't wedge the
+        breaker half-open"""
+        clock = FakeClock()
+        cb = make_breaker(clock)
+        trip(cb)
+        clock.now += 30
+        assert cb.allow()
+
+        clock.now += 30
+        assert cb.allow()
+
+    def test_metrics(self) -> None:
+        trips = breaker.breaker_trips.value
+        is_open = breaker.breakers_open.value
+        clock = FakeClock()
+        cb = make_breaker(clock)
+
+        trip(cb)
+        assert breaker.breaker_trips.value == trips + 1
+        assert breaker.breakers_open.value == is_open + 1
+
+        clock.now += 30
+        assert cb.allow()
+        cb.record(True, 0.1)
+        assert breaker.breakers_open.value == is_open
+
+
+def test_registry_per_origin() -> None:
+    registry = BreakerRegistry()
+
+    first = registry.get("https://receiver.com/stream-1")
+    assert registry.get("https://receiver.com/stream-2") is first
+    assert registry.get("https://other.com/push") is not first
+
+    assert set(registry.health()) == {
+        "https://receiver.com", "https://other.com"
+    }
+    assert registry.health()["https://other.com"]["state"] == "closed"
+
+
+def test_registry_metrics() -> None:
+    """Ensures each receiver's breaker state is scraped with the other
+    metrics"""
+    clock = FakeClock()
+    registry = BreakerRegistry(lambda endpoint: CircuitBreaker(
+        endpoint, window=60, min_pushes=4, error_rate=0.5, slow_push=5,
+        open_for=30, clock=clock
+    ))
+    trip(registry.get("https://down.com/push"))
+    registry.get("https://up.com/push").record(True, 0.5)
+
+    with patch.object(delivery, "breakers", registry):
+        text = metrics.exposition()
+
+    assert "# TYPE push_breaker_state gauge\n" in text
+    assert 'push_breaker_state{endpoint="https://down.com"} 2\n' in text
+    assert 'push_breaker_state{endpoint="https://up.com"} 0\n' in text
+    assert ('push_breaker_error_rate{endpoint="https://down.com"} 1\n'
+            in text)
+    assert ('push_breaker_mean_latency_seconds{endpoint="https://up.com"} '
+            '0.5\n') in text
+
+
+def test_receiver_is_down() -> None:
+    def http_error(status: int) -> requests.HTTPError:
+        return requests.HTTPError(response=Mock(status_code=status))
+
+    assert delivery.receiver_is_down(requests.ConnectionError())
+    assert delivery.receiver_is_down(requests.Timeout())
+    assert delivery.receiver_is_down(http_error(503))
+    assert delivery.receiver_is_down(http_error(429))
+    assert not delivery.receiver_is_down(http_error(400))
+
+
+@pytest.fixture
+def push_stream(temp_db: None, with_jwks: None) -> Iterator[Stream]:
+    stream = Stream(uuid.uuid4().hex, "https://test-case.popular-app.com")
+    stream.config.delivery = PushDeliveryMethod(
+        endpoint_url="https://down.receiver.com/push"
+    )
+    stream.save()
+    yield stream
+    stream.delete()
+
+
+def test_open_breaker_leaves_SETs_queued(push_stream: Stream,
+                                         monkeypatch) -> None:
+    """Ensures SETs for a receiver that is down are queued without trying
+    to push them"""
+    monkeypatch.setenv("PUSH_BREAKER_MIN_PUSHES", "2")
+    short_circuits = breaker.short_circuits.value
+
+    with patch('requests.Session.post',
+               side_effect=requests.ConnectionError()) as post_mock:
+        for _ in range(2):
+            push_stream.process_SET(SecurityEvent(
+                events=Events(verification=VerificationEvent())
+            ))
+            assert delivery.push_engine.drain(timeout=10)
+        assert post_mock.call_count == 2
+
+        push_stream.process_SET(SecurityEvent(
+            events=Events(verification=VerificationEvent())
+        ))
+        assert delivery.push_engine.drain(timeout=10)
+
+    assert post_mock.call_count == 2
+    assert push_stream.count_SETs() == 3
+    assert breaker.short_circuits.value == short_circuits + 1
+    assert delivery.breakers.health()["https://down.receiver.com"]["state"] \
+        == "open"
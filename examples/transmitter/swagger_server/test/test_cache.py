@@ -0,0 +1,80 @@
+# Copyright (c) 2021 Cisco Systems, Inc. and its affiliates
+# All rights reserved.
+# Use of this source code is governed by a BSD 3-Clause License
+# that can be found in the LICENSE file.
+
+from swagger_server.cache import TTLCache
+
+
+class FakeClock:
+    def __init__(self) -> None:
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def test_get_and_put() -> None:
+    cache: TTLCache[str, int] = TTLCache(maxsize=2, ttl=10)
+    assert cache.get("a") is None
+
+    cache.put("a", 1)
+
+    assert cache.get("a") == 1
+    assert cache.stats()["hits"] == 1
+    assert cache.stats()["misses"] == 1
+
+
+def test_evicts_least_recently_used() -> None:
+    cache: TTLCache[str, int] = TTLCache(maxsize=2, ttl=10)
+    cache.put("a", 1)
+    cache.put("b", 2)
+    cache.get("a")
+
+    cache.put("c", 3)
+
+    assert cache.get("b") is None
+    assert cache.get("a") == 1
+    assert cache.get("c") == 3
+    assert cache.stats()["evictions"] == 1
+
+
+def test_expires() -> None:
+    clock = FakeClock()
+    cache: TTLCache[str, int] = TTLCache(maxsize=2, ttl=10, clock=clock)
+    cache.put("a", 1)
+
+    clock.now = 9.9
+    assert cache.get("a") == 1
+
+    clock.now = 10
+    assert cache.get("a") is None
+    assert cache.stats()["expirations"] == 1
+    assert cache.stats()["size"] == 0
+
+
+def test_invalidate() -> None:
+    cache: TTLCache[str, int] = TTLCache(maxsize=2, ttl=10)
+    cache.put("a", 1)
+
+    cache.invalidate("a")
+
+    assert cache.get("a") is None
+
+
+def test_stale_put_is_dropped() -> None:
+    """A value read before an invalidation must not be cached after it"""
+    cache: TTLCache[str, int] = TTLCache(maxsize=2, ttl=10)
+    epoch = cache.epoch()
+    cache.invalidate("a")
+
+    cache.put("a", 1, epoch)
+
+    assert cache.get("a") is None
+
+
+def test_disabled() -> None:
+    cache: TTLCache[str, int] = TTLCache(maxsize=0, ttl=10)
+    cache.put("a", 1)
+
+    assert cache.get("a") is None
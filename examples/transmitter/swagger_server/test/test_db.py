@@ -0,0 +1,1004 @@
+# Copyright (c) 2021 Cisco Systems, Inc. and its affiliates
+# All rights reserved.
+# Use of this source code is governed by a BSD 3-Clause License
+# that can be found in the LICENSE file.
+
+import json
+import os
+from pathlib import Path
+import threading
+import time
+from typing import List, Optional, Tuple
+import uuid
+
+import pytest
+
+from swagger_server import db
+from swagger_server.db import sqlite
+from swagger_server.db.sharded import ShardedSQLiteBackend
+from swagger_server.errors import SubjectNotInStream
+from swagger_server.events import Events, SecurityEvent, VerificationEvent
+from swagger_server.models import Status
+
+
+FOO = "foo@bar.com"
+
+
+def make_SET(**kwargs) -> SecurityEvent:
+    return SecurityEvent(
+        events=Events(verification=VerificationEvent()), **kwargs
+    )
+
+
+@pytest.fixture
+def sqlite_db(temp_db: None, monkeypatch) -> None:
+    """For tests of the SQLite engine's internals"""
+    monkeypatch.setenv("DB_BACKEND", "sqlite")
+    monkeypatch.delenv("DB_SHARDS", raising=False)
+    db.create()
+
+
+def sqlite_backend() -> sqlite.SQLiteBackend:
+    backend = db.get_backend()
+    assert isinstance(backend, sqlite.SQLiteBackend)
+    return backend
+
+
+@pytest.fixture(params=["sqlite", "sharded", "memory"])
+def backend(request, temp_db: None, monkeypatch) -> str:
+    """Run the conformance tests against every storage engine"""
+    if request.param == "sharded":
+        monkeypatch.setenv("DB_BACKEND", "sqlite")
+        monkeypatch.setenv("DB_SHARDS", "3")
+    else:
+        monkeypatch.setenv("DB_BACKEND", request.param)
+        monkeypatch.delenv("DB_SHARDS", raising=False)
+    db.create()
+    return request.param
+
+
+class TestConnectionPool:
+    def test_reuses_connections(self, sqlite_db: None) -> None:
+        """Ensures a connection is returned to the pool and handed out
+        again instead of opening a new one"""
+        with sqlite_backend().connection() as first:
+            pass
+        with sqlite_backend().connection() as second:
+            pass
+
+        assert first is second
+
+    def test_nested_checkouts_get_distinct_connections(
+            self, sqlite_db: None) -> None:
+        """Ensures a connection is never shared while checked out"""
+        with sqlite_backend().connection() as outer:
+            with sqlite_backend().connection() as inner:
+                assert outer is not inner
+
+    def test_uses_wal(self, sqlite_db: None) -> None:
+        """Ensures connections are using write-ahead logging"""
+        with sqlite_backend().connection() as conn:
+            mode = conn.execute("PRAGMA journal_mode").fetchone()[0]
+
+        assert mode == "wal"
+
+    def test_pragmas_from_environment(self, sqlite_db: None,
+                                      monkeypatch) -> None:
+        """Ensures the tunable pragmas are read from the environment"""
+        monkeypatch.setenv("DB_SYNCHRONOUS", "full")
+        monkeypatch.setenv("DB_CACHE_SIZE", "-1024")
+        db.create()
+
+        with sqlite_backend().connection() as conn:
+            synchronous = conn.execute("PRAGMA synchronous").fetchone()[0]
+            cache_size = conn.execute("PRAGMA cache_size").fetchone()[0]
+
+        # FULL == 2
+        assert synchronous == 2
+        assert cache_size == -1024
+
+    def test_invalid_synchronous(self, sqlite_db: None, monkeypatch) -> None:
+        """Ensures a typo in DB_SYNCHRONOUS is not silently ignored"""
+        monkeypatch.setenv("DB_SYNCHRONOUS", "sometimes")
+
+        with pytest.raises(ValueError):
+            db.create()
+
+    def test_rolls_back_unfinished_transactions(self, sqlite_db: None) -> None:
+        """Ensures a connection goes back to the pool without an open
+        transaction, even if the caller errors"""
+        client_id = uuid.uuid4().hex
+        with pytest.raises(RuntimeError):
+            with sqlite_backend().connection() as conn:
+                conn.execute(
+                    "INSERT INTO streams (client_id) VALUES (?)", (client_id,)
+                )
+                raise RuntimeError()
+
+        assert not db.stream_exists(client_id)
+
+    def test_threads(self, sqlite_db: None) -> None:
+        """Ensures pooled connections can be used from many threads"""
+        client_id = uuid.uuid4().hex
+        db.save_stream(client_id, "{}", Status.enabled)
+
+        def add_SETs() -> None:
+            for _ in range(10):
+                db.add_set(client_id, make_SET())
+
+        threads = [threading.Thread(target=add_SETs) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert db.count_SETs(client_id) == 40
+
+    def test_drop_recreates_database(self, sqlite_db: None) -> None:
+        """Ensures dropping the database wipes it and starts afresh"""
+        client_id = uuid.uuid4().hex
+        db.save_stream(client_id, "{}", Status.enabled)
+
+        db.create(drop=True)
+
+        assert not db.stream_exists(client_id)
+        assert os.path.exists(os.environ["DB_PATH"])
+
+
+class TestMigrations:
+    def test_new_database_is_current(self, sqlite_db: None) -> None:
+        """Ensures a freshly created database has every migration applied"""
+        with sqlite_backend().connection() as conn:
+            version = conn.execute("PRAGMA user_version").fetchone()[0]
+
+        assert version == len(sqlite.MIGRATIONS)
+
+    def test_upgrades_existing_database(self, sqlite_db: None) -> None:
+        """Ensures a database created before stream statuses were stored in
+        their own column is upgraded in place"""
+        db.create(drop=True)
+        client_id = uuid.uuid4().hex
+        with sqlite_backend().connection() as conn:
+            with conn:
+                conn.execute("DROP TABLE streams")
+                conn.execute(sqlite.CREATE_STREAMS_SQL)
+                conn.execute(
+                    "INSERT INTO streams VALUES (?, ?)",
+                    (client_id, json.dumps({"status": "paused"}))
+                )
+            conn.execute("PRAGMA user_version=1")
+
+        db.create()
+
+        with sqlite_backend().connection() as conn:
+            row = conn.execute(
+                "SELECT status FROM streams WHERE client_id=?", (client_id,)
+            ).fetchone()
+
+        assert row["status"] == "paused"
+
+    def test_upgrades_SETs_to_sequence_numbers(self, sqlite_db: None) -> None:
+        """Ensures SETs queued before sequence numbers existed keep their
+        order"""
+        db.create(drop=True)
+        client_id = uuid.uuid4().hex
+        SETs = [make_SET(iat=iat) for iat in (3, 1, 2)]
+        with sqlite_backend().connection() as conn:
+            with conn:
+                conn.execute("DROP TABLE SETs")
+                conn.execute(sqlite.CREATE_SETS_SQL)
+                conn.executemany(
+                    "INSERT INTO SETs VALUES (?, ?, ?, ?)",
+                    [(client_id, SET.jti, SET.iat, SET.json())
+                     for SET in SETs]
+                )
+            conn.execute("PRAGMA user_version=2")
+
+        db.create()
+
+        queued = db.get_SETs(client_id)
+        assert [q.SET.iat for q in queued] == [1, 2, 3]
+
+
+class TestShards:
+    @pytest.fixture
+    def sharded_db(self, temp_db: None,
+                   monkeypatch) -> ShardedSQLiteBackend:
+        monkeypatch.setenv("DB_BACKEND", "sqlite")
+        monkeypatch.setenv("DB_SHARDS", "4")
+        db.create()
+        backend = db.get_backend()
+        assert isinstance(backend, ShardedSQLiteBackend)
+        return backend
+
+    def test_files(self, sharded_db: ShardedSQLiteBackend) -> None:
+        """Ensures each shard gets its own database file next to DB_PATH"""
+        db_path = Path(os.environ["DB_PATH"])
+
+        for i in range(4):
+            assert db_path.with_name(f"{db_path.stem}.{i}.db").exists()
+
+    def test_spreads_streams(self,
+                             sharded_db: ShardedSQLiteBackend) -> None:
+        """Ensures streams, and their subjects and SETs, are spread over the
+        shards"""
+        client_ids = [f"stream-{i}" for i in range(40)]
+        for client_id in client_ids:
+            db.save_stream(client_id, "{}", Status.enabled)
+            db.add_subject(client_id, "foo@bar.com")
+        db.add_sets([db.PendingSET(client_id, make_SET())
+                     for client_id in client_ids])
+
+        for shard in sharded_db.shards:
+            ids = shard.get_stream_ids()
+            assert ids
+            for client_id in ids:
+                assert sharded_db.shard_for(client_id) is shard
+                assert shard.count_SETs(client_id) == 1
+                assert shard.get_subject_status(client_id, "foo@bar.com") \
+                    == Status.enabled
+
+        assert sorted(db.get_stream_ids()) == sorted(client_ids)
+        assert len(db.get_subject_subscriptions("foo@bar.com")) == 40
+
+    def test_routing_is_stable(self,
+                               sharded_db: ShardedSQLiteBackend) -> None:
+        """Ensures a stream is found in the same shard by every process, i.e.
+        the shard doesn't depend on Python's randomized hash()"""
+        # crc32("0") == 0xf4dbdf21
+        assert sharded_db.shard_index("0") == 0xf4dbdf21 % 4
+
+
+class TestGetSubjectSubscriptions:
+    @pytest.mark.parametrize("stream_status,subject_status,expected", [
+        (Status.enabled, Status.enabled, True),
+        (Status.enabled, Status.paused, True),
+        (Status.paused, Status.enabled, True),
+        (Status.enabled, Status.disabled, False),
+        (Status.disabled, Status.enabled, False),
+    ])
+    def test_leaves_out_disabled(self, backend: str, stream_status: Status,
+                                 subject_status: Status,
+                                 expected: bool) -> None:
+        email = "foo@bar.com"
+        client_id = uuid.uuid4().hex
+        db.save_stream(
+            client_id, json.dumps({"client_id": client_id}), stream_status
+        )
+        db.add_subject(client_id, email)
+        db.set_subject_status(client_id, email, subject_status)
+
+        subscriptions = db.get_subject_subscriptions(email)
+
+        assert subscriptions == (
+            [({"client_id": client_id}, subject_status)] if expected else []
+        )
+
+    def test_only_following_streams(self, backend: str) -> None:
+        """Ensures streams that don't follow the subject are not returned"""
+        client_ids = [uuid.uuid4().hex for _ in range(3)]
+        for client_id in client_ids:
+            db.save_stream(
+                client_id, json.dumps({"client_id": client_id}), Status.enabled
+            )
+        db.add_subject(client_ids[1], "foo@bar.com")
+        db.add_subject(client_ids[2], "baz@bar.com")
+
+        subscriptions = db.get_subject_subscriptions("foo@bar.com")
+
+        assert subscriptions == [
+            ({"client_id": client_ids[1]}, Status.enabled)
+        ]
+
+
+class TestSubjects:
+    def test_status(self, backend: str) -> None:
+        """Ensures a subject starts out enabled and its status can be
+        changed"""
+        client_id = uuid.uuid4().hex
+        db.add_subject(client_id, "foo@bar.com")
+        assert db.get_subject_status(client_id, "foo@bar.com") == \
+            Status.enabled
+
+        db.set_subject_status(client_id, "foo@bar.com", Status.paused)
+
+        assert db.get_subject_status(client_id, "foo@bar.com") == \
+            Status.paused
+
+    def test_not_in_stream(self, backend: str) -> None:
+        """Ensures a subject that isn't in the stream can't be read or
+        updated"""
+        client_id = uuid.uuid4().hex
+        db.add_subject(client_id, "foo@bar.com")
+        db.remove_subject(client_id, "foo@bar.com")
+
+        with pytest.raises(SubjectNotInStream):
+            db.get_subject_status(client_id, "foo@bar.com")
+        with pytest.raises(SubjectNotInStream):
+            db.set_subject_status(client_id, "foo@bar.com", Status.paused)
+        assert db.get_subject_subscriptions("foo@bar.com") == []
+
+
+class TestAddSETs:
+    def test_adds_to_many_streams(self, backend: str) -> None:
+        """Ensures SETs for many streams are all added"""
+        client_ids = [uuid.uuid4().hex for _ in range(3)]
+        SET = make_SET()
+
+        db.add_sets([db.PendingSET(client_id, SET) for client_id in client_ids])
+
+        for client_id in client_ids:
+            assert [q.SET.jti for q in db.get_SETs(client_id)] == [SET.jti]
+
+    def test_all_or_nothing(self, backend: str) -> None:
+        """Ensures a failure part way through doesn't leave some of the SETs
+        behind"""
+        client_id = uuid.uuid4().hex
+        SET = make_SET()
+
+        with pytest.raises(db.DuplicateSET):
+            db.add_sets([db.PendingSET(client_id, make_SET()),
+                         db.PendingSET(client_id, SET),
+                         db.PendingSET(client_id, SET)])
+
+        assert db.count_SETs(client_id) == 0
+
+    def test_skip_duplicates(self, backend: str) -> None:
+        """Ensures SETs a stream already has can be left out rather than
+        failing the lot"""
+        client_ids = [uuid.uuid4().hex for _ in range(3)]
+        SET = make_SET()
+        db.add_sets([db.PendingSET(client_ids[0], SET)])
+
+        result = db.add_sets(
+            [db.PendingSET(client_id, SET) for client_id in client_ids],
+            skip_duplicates=True
+        )
+
+        assert [d.client_id for d in result.duplicates] == [client_ids[0]]
+        for client_id in client_ids:
+            assert db.count_SETs(client_id) == 1
+
+    def test_empty(self, backend: str) -> None:
+        """Ensures adding nothing is a no-op"""
+        db.add_sets([])
+
+
+class TestRetention:
+    def test_drop_oldest(self, backend: str) -> None:
+        """Ensures a full queue drops its oldest SETs to make room"""
+        client_id = uuid.uuid4().hex
+        SETs = [make_SET() for _ in range(5)]
+        db.add_sets([db.PendingSET(client_id, SET) for SET in SETs[:3]])
+
+        result = db.add_sets([
+            db.PendingSET(client_id, SET, max_depth=3) for SET in SETs[3:]
+        ])
+
+        assert result.dropped == 2
+        assert result.rejected == ()
+        assert [q.jti for q in db.get_SETs(client_id)] == \
+            [SET.jti for SET in SETs[2:]]
+
+    def test_reject(self, backend: str) -> None:
+        """Ensures a full queue turns away new SETs, while other streams
+        still get theirs"""
+        full, empty = uuid.uuid4().hex, uuid.uuid4().hex
+        SETs = [make_SET() for _ in range(3)]
+        reject = db.QueueFullPolicy.reject
+
+        result = db.add_sets(
+            [db.PendingSET(full, SET, max_depth=2, on_full=reject)
+             for SET in SETs] +
+            [db.PendingSET(empty, SETs[0], max_depth=2, on_full=reject)]
+        )
+
+        assert result.dropped == 0
+        assert [r.SET.jti for r in result.rejected] == [SETs[2].jti]
+        assert [q.jti for q in db.get_SETs(full)] == \
+            [SET.jti for SET in SETs[:2]]
+        assert db.count_SETs(empty) == 1
+
+    def test_expire(self, backend: str) -> None:
+        """Ensures expired SETs are deleted in batches, and no others"""
+        client_id = uuid.uuid4().hex
+        expiring = [make_SET() for _ in range(5)]
+        keeping = [make_SET(), make_SET()]
+        db.add_sets(
+            [db.PendingSET(client_id, SET, expires_at=100)
+             for SET in expiring] +
+            [db.PendingSET(client_id, keeping[0], expires_at=200),
+             db.PendingSET(client_id, keeping[1])]
+        )
+
+        assert db.expire_SETs(now=150, limit=3) == 3
+        assert db.expire_SETs(now=150, limit=3) == 2
+        assert db.expire_SETs(now=150, limit=3) == 0
+        assert [q.jti for q in db.get_SETs(client_id)] == \
+            [SET.jti for SET in keeping]
+
+        db.compact()
+
+    def test_acked_SETs_dont_expire(self, backend: str) -> None:
+        """Ensures SETs that are already gone aren't counted as expired"""
+        client_id = uuid.uuid4().hex
+        SET = make_SET()
+        db.add_sets([db.PendingSET(client_id, SET, expires_at=100)])
+        db.delete_SETs(client_id, [SET.jti])
+
+        assert db.expire_SETs(now=150, limit=10) == 0
+
+    def test_incremental_vacuum(self, sqlite_db: None) -> None:
+        """Ensures new databases can give back free pages a bit at a time"""
+        with sqlite_backend().connection() as conn:
+            auto_vacuum = conn.execute("PRAGMA auto_vacuum").fetchone()[0]
+
+        # INCREMENTAL == 2
+        assert auto_vacuum == 2
+
+
+class TestRetries:
+    def test_claims_due_SETs_in_order(self, backend: str) -> None:
+        """Ensures only SETs that are due are claimed, most overdue first,
+        and no more than the limit"""
+        client_id = uuid.uuid4().hex
+        SETs = [make_SET() for _ in range(4)]
+        db.add_sets([
+            db.PendingSET(client_id, SETs[0], next_attempt_at=120),
+            db.PendingSET(client_id, SETs[1], next_attempt_at=100),
+            db.PendingSET(client_id, SETs[2], next_attempt_at=110),
+            db.PendingSET(client_id, SETs[3], next_attempt_at=200),
+            db.PendingSET(client_id, make_SET()),
+        ])
+
+        due = db.claim_due_SETs(now=150, limit=2, lease_until=300)
+
+        assert [d.jti for d in due] == [SETs[1].jti, SETs[2].jti]
+        assert all(d.attempts == 0 for d in due)
+        assert [d.jti for d in
+                db.claim_due_SETs(now=150, limit=10, lease_until=300)] == \
+            [SETs[0].jti]
+
+    def test_claims_by_latest_schedule(self, backend: str) -> None:
+        """Ensures a rescheduled SET is claimed once, by its new time, that
+        SETs due at the same time go in the order they were queued, and that
+        those waiting on an earlier SET don't count toward the limit"""
+        client_id = uuid.uuid4().hex
+        rescheduled, first, second, other = (make_SET() for _ in range(4))
+        db.add_sets([
+            db.PendingSET(client_id, rescheduled, next_attempt_at=90),
+            db.PendingSET(client_id, first, next_attempt_at=100,
+                          subject=FOO),
+            db.PendingSET(client_id, second, next_attempt_at=100,
+                          subject=FOO),
+            db.PendingSET(client_id, other, next_attempt_at=100),
+        ])
+        db.reschedule_SET(client_id, rescheduled.jti, 1, 130)
+
+        due = db.claim_due_SETs(now=150, limit=2, lease_until=300)
+        assert [d.jti for d in due] == [first.jti, other.jti]
+
+        due = db.claim_due_SETs(now=150, limit=10, lease_until=300)
+        assert [(d.jti, d.next_attempt_at) for d in due] == \
+            [(rescheduled.jti, 130)]
+
+    def test_claims_from_every_stream(self, backend: str) -> None:
+        client_ids = [uuid.uuid4().hex for _ in range(6)]
+        db.add_sets([db.PendingSET(client_id, make_SET(), next_attempt_at=100)
+                     for client_id in client_ids])
+
+        due = db.claim_due_SETs(now=150, limit=4, lease_until=300)
+        due += db.claim_due_SETs(now=150, limit=4, lease_until=300)
+
+        assert sorted(d.client_id for d in due) == sorted(client_ids)
+
+    def test_leases_claimed_SETs(self, backend: str) -> None:
+        """Ensures a claimed SET isn't claimed again until its lease is up"""
+        client_id = uuid.uuid4().hex
+        SET = make_SET()
+        db.add_sets([db.PendingSET(client_id, SET, next_attempt_at=100)])
+
+        assert len(db.claim_due_SETs(now=100, limit=10, lease_until=160)) == 1
+        assert db.claim_due_SETs(now=150, limit=10, lease_until=210) == []
+
+        [due] = db.claim_due_SETs(now=160, limit=10, lease_until=220)
+        assert due.SET.jti == SET.jti
+        assert due.next_attempt_at == 160
+
+    def test_reschedule(self, backend: str) -> None:
+        client_id = uuid.uuid4().hex
+        SET = make_SET()
+        db.add_sets([db.PendingSET(client_id, SET, jws="jws",
+                                   next_attempt_at=100)])
+
+        db.reschedule_SET(client_id, SET.jti, attempts=3, next_attempt_at=500)
+
+        assert db.claim_due_SETs(now=499, limit=10, lease_until=600) == []
+        [due] = db.claim_due_SETs(now=500, limit=10, lease_until=600)
+        assert (due.client_id, due.attempts, due.jws) == (client_id, 3, "jws")
+
+    def test_unschedule(self, backend: str) -> None:
+        """Ensures a SET that won't be retried stays queued for polling"""
+        client_id = uuid.uuid4().hex
+        SET = make_SET()
+        db.add_sets([db.PendingSET(client_id, SET, next_attempt_at=100)])
+
+        db.reschedule_SET(client_id, SET.jti, attempts=5, next_attempt_at=None)
+
+        assert db.claim_due_SETs(now=10 ** 10, limit=10, lease_until=0) == []
+        assert db.count_SETs(client_id) == 1
+
+    def test_waits_for_earlier_SET_about_subject(self,
+                                                 backend: str) -> None:
+        """Ensures a SET isn't claimed while an earlier one about the same
+        subject is still to be pushed or held, so retries keep their order"""
+        client_id = uuid.uuid4().hex
+        first, second, baz, held, later = (make_SET() for _ in range(5))
+        db.add_sets([
+            db.PendingSET(client_id, first, next_attempt_at=100,
+                          subject=FOO),
+            db.PendingSET(client_id, second, next_attempt_at=100,
+                          subject=FOO),
+            db.PendingSET(client_id, baz, next_attempt_at=100,
+                          subject="baz@bar.com"),
+            db.PendingSET(client_id, held, subject="held@bar.com",
+                          held=True),
+            db.PendingSET(client_id, later, next_attempt_at=100,
+                          subject="held@bar.com"),
+        ])
+
+        due = db.claim_due_SETs(now=150, limit=10, lease_until=1000)
+        assert {d.jti for d in due} == {first.jti, baz.jti}
+
+        # the first failed, and is to be retried after the second is due
+        db.reschedule_SET(client_id, first.jti, 1, 500)
+        assert db.claim_due_SETs(now=400, limit=10, lease_until=600) == []
+
+        db.delete_SETs(client_id, [first.jti])
+        [due] = db.claim_due_SETs(now=400, limit=10, lease_until=600)
+        assert due.jti == second.jti
+
+    def test_defer_behind_earlier_SET(self, backend: str) -> None:
+        """Ensures a SET about to be pushed is left to the retry scheduler
+        while an earlier one about the same subject is still to be pushed or
+        held"""
+        client_ids = [uuid.uuid4().hex for _ in range(2)]
+        first, second, baz, held, later = (make_SET() for _ in range(5))
+        db.add_sets([
+            db.PendingSET(client_ids[0], first, next_attempt_at=500,
+                          subject=FOO),
+            db.PendingSET(client_ids[0], second, next_attempt_at=1000,
+                          subject=FOO),
+            db.PendingSET(client_ids[0], baz, next_attempt_at=1000,
+                          subject="baz@bar.com"),
+            db.PendingSET(client_ids[1], held, subject=FOO, held=True),
+            db.PendingSET(client_ids[1], later, next_attempt_at=1000,
+                          subject=FOO),
+        ])
+
+        deferred = db.defer_SETs([
+            (client_ids[0], second.jti), (client_ids[0], baz.jti),
+            (client_ids[1], later.jti),
+        ], 100)
+
+        assert sorted(deferred) == sorted([
+            (client_ids[0], second.jti), (client_ids[1], later.jti)
+        ])
+        db.delete_SETs(client_ids[0], [first.jti])
+        [due] = db.claim_due_SETs(now=100, limit=10, lease_until=600)
+        assert due.jti == second.jti
+
+    def test_acked_SETs_arent_claimed(self, backend: str) -> None:
+        client_id = uuid.uuid4().hex
+        SET = make_SET()
+        db.add_sets([db.PendingSET(client_id, SET, next_attempt_at=100)])
+        db.delete_SETs(client_id, [SET.jti])
+
+        assert db.claim_due_SETs(now=150, limit=10, lease_until=300) == []
+
+
+class TestHeldSETs:
+    def queue(self, client_id: str, subject: str,
+              held: bool = True) -> SecurityEvent:
+        SET = make_SET()
+        db.add_sets([db.PendingSET(client_id, SET, subject=subject,
+                                   held=held)])
+        return SET
+
+    def test_not_polled(self, backend: str) -> None:
+        """Ensures held SETs are kept, but not handed out"""
+        client_id = uuid.uuid4().hex
+        held = self.queue(client_id, "foo@bar.com")
+        sent = self.queue(client_id, "foo@bar.com", held=False)
+
+        assert [q.jti for q in db.get_SETs(client_id)] == [sent.jti]
+        assert db.count_SETs(client_id) == 2
+        assert db.claim_due_SETs(now=10 ** 10, limit=10, lease_until=0) == []
+
+        assert db.release_SETs(client_id) == 1
+        assert [q.jti for q in db.get_SETs(client_id)] == \
+            [held.jti, sent.jti]
+
+    def test_release_subject(self, backend: str) -> None:
+        client_id = uuid.uuid4().hex
+        foo = self.queue(client_id, "foo@bar.com")
+        baz = self.queue(client_id, "baz@bar.com")
+
+        assert db.release_SETs(client_id, "foo@bar.com") == 1
+        assert [q.jti for q in db.get_SETs(client_id)] == [foo.jti]
+        assert db.release_SETs(client_id, "foo@bar.com") == 0
+        assert db.release_SETs(client_id, "baz@bar.com") == 1
+        assert [q.jti for q in db.get_SETs(client_id)] == [foo.jti, baz.jti]
+
+    def test_release_keeps_paused_subjects(self, backend: str) -> None:
+        """Ensures enabling a stream doesn't release SETs about subjects
+        that are paused themselves"""
+        client_id = uuid.uuid4().hex
+        db.save_stream(client_id, json.dumps({}), Status.enabled)
+        for email in ("foo@bar.com", "baz@bar.com"):
+            db.add_subject(client_id, email)
+        db.set_subject_status(client_id, "baz@bar.com", Status.paused)
+        foo = self.queue(client_id, "foo@bar.com")
+        self.queue(client_id, "baz@bar.com")
+        other = self.queue(client_id, None)
+
+        assert db.release_SETs(client_id) == 2
+        assert [q.jti for q in db.get_SETs(client_id)] == [foo.jti, other.jti]
+
+    def test_replay_in_order(self, backend: str) -> None:
+        """Ensures a release can be claimed a batch at a time, in queue
+        order, without taking other SETs that are due"""
+        client_id = uuid.uuid4().hex
+        SETs = [self.queue(client_id, email)
+                for email in ("foo@bar.com", "baz@bar.com", "foo@bar.com")]
+        db.add_sets([db.PendingSET(client_id, make_SET(),
+                                   next_attempt_at=100)])
+
+        assert db.release_SETs(client_id, None, next_attempt_at=500) == 3
+
+        first = db.claim_released_SETs(client_id, 500, 2, lease_until=600)
+        second = db.claim_released_SETs(client_id, 500, 2, lease_until=600)
+        assert [d.jti for d in first + second] == [SET.jti for SET in SETs]
+        assert [d.subject for d in first + second] == \
+            ["foo@bar.com", "baz@bar.com", "foo@bar.com"]
+        assert db.claim_released_SETs(client_id, 500, 2, 600) == []
+        # the released SETs are leased like any other claimed SET, and the
+        # second about foo waits for the first
+        later = 10 ** 10
+        assert len(db.claim_due_SETs(now=599, limit=10,
+                                     lease_until=later)) == 1
+        assert {d.jti for d in db.claim_due_SETs(
+            now=600, limit=10, lease_until=later
+        )} == {SET.jti for SET in SETs[:2]}
+
+    def test_hold_SET(self, backend: str) -> None:
+        """Ensures a SET due to be pushed is only held while its stream is
+        paused, and is then released like any other held SET"""
+        client_id = uuid.uuid4().hex
+        SET = make_SET()
+        db.save_stream(client_id, "{}", Status.enabled)
+        db.add_sets([db.PendingSET(client_id, SET, next_attempt_at=100,
+                                   subject=FOO)])
+
+        assert not db.hold_SET(client_id, SET.jti)
+        db.save_stream(client_id, "{}", Status.paused)
+        assert db.hold_SET(client_id, SET.jti)
+
+        assert db.claim_due_SETs(now=10 ** 10, limit=10, lease_until=0) == []
+        assert db.release_SETs(client_id, None, next_attempt_at=500) == 1
+        [due] = db.claim_released_SETs(client_id, 500, 10, lease_until=600)
+        assert due.jti == SET.jti
+
+    def test_drop(self, backend: str) -> None:
+        client_id = uuid.uuid4().hex
+        self.queue(client_id, "foo@bar.com")
+        baz = self.queue(client_id, "baz@bar.com")
+        sent = self.queue(client_id, "foo@bar.com", held=False)
+
+        assert db.drop_held_SETs(client_id, "foo@bar.com") == 1
+        assert db.count_SETs(client_id) == 2
+        assert db.drop_held_SETs(client_id, "foo@bar.com") == 0
+        assert db.drop_held_SETs(client_id) == 1
+        assert [q.jti for q in db.get_SETs(client_id)] == [sent.jti]
+
+        assert db.release_SETs(client_id) == 0
+        assert baz.jti not in {q.jti for q in db.get_SETs(client_id)}
+
+
+class TestAckSETs:
+    def test_returns_issued_at(self, backend: str) -> None:
+        """Ensures acking deletes the SETs and says when the ones that were
+        still queued were issued"""
+        client_id = uuid.uuid4().hex
+        SETs = [make_SET(iat=1000 + i) for i in range(3)]
+        db.add_sets([db.PendingSET(client_id, SET) for SET in SETs])
+
+        issued_at = db.ack_SETs(client_id, [SETs[2].jti, SETs[0].jti])
+        assert sorted(issued_at) == [1000, 1002]
+        assert [q.jti for q in db.get_SETs(client_id)] == [SETs[1].jti]
+
+        assert db.ack_SETs(client_id, [SETs[0].jti, "unknown"]) == []
+        assert db.ack_SETs(client_id, []) == []
+
+    def test_queue_depths(self, backend: str) -> None:
+        client_ids = [uuid.uuid4().hex for _ in range(3)]
+        for i, client_id in enumerate(client_ids):
+            db.add_sets([db.PendingSET(client_id, make_SET())
+                         for _ in range(i)])
+
+        depths = db.queue_depths()
+        assert client_ids[0] not in depths
+        assert depths[client_ids[1]] == 1
+        assert depths[client_ids[2]] == 2
+
+        db.delete_SETs(client_ids[2])
+        assert client_ids[2] not in db.queue_depths()
+
+
+class TestSupersession:
+    def pending(self, client_id: str, event_type: str,
+                supersedes: Tuple[str, ...] = (), subject: str = FOO,
+                held: bool = False,
+                next_attempt_at: Optional[int] = None,
+                subject_key: Optional[str] = None) -> db.PendingSET:
+        return db.PendingSET(client_id, make_SET(), subject=subject,
+                             held=held, event_type=event_type,
+                             supersedes=supersedes,
+                             next_attempt_at=next_attempt_at,
+                             subject_key=subject_key or subject)
+
+    def jtis(self, client_id: str) -> List[str]:
+        return [q.jti for q in db.get_SETs(client_id)]
+
+    def test_supersedes_same_subject(self, backend: str) -> None:
+        """Ensures only earlier SETs about the same subject, of the types
+        the new SET supersedes, are deleted"""
+        client_id = uuid.uuid4().hex
+        kept = [
+            self.pending(client_id, "enabled", subject="baz@bar.com"),
+            self.pending(client_id, "compromise"),
+        ]
+        obsolete = [
+            self.pending(client_id, "disabled"),
+            self.pending(client_id, "enabled"),
+        ]
+        untyped = db.PendingSET(client_id, make_SET(), subject=FOO)
+        db.add_sets([kept[0], obsolete[0], kept[1], obsolete[1], untyped])
+
+        latest = self.pending(client_id, "enabled", ("disabled", "enabled"))
+        result = db.add_sets([latest])
+
+        assert result.superseded == 2
+        assert self.jtis(client_id) == [
+            kept[0].SET.jti, kept[1].SET.jti, untyped.SET.jti,
+            latest.SET.jti
+        ]
+
+    def test_only_same_whole_subject(self, backend: str) -> None:
+        """Ensures a SET about one session of a user doesn't supersede a SET
+        about another"""
+        client_id = uuid.uuid4().hex
+        s1 = self.pending(client_id, "revoked", subject_key=FOO + "/s1")
+        s2 = self.pending(client_id, "revoked", ("revoked",),
+                          subject_key=FOO + "/s2")
+        db.add_sets([s1])
+
+        assert db.add_sets([s2]).superseded == 0
+        assert db.add_sets([self.pending(
+            client_id, "revoked", ("revoked",), subject_key=FOO + "/s1"
+        )]).superseded == 1
+        assert db.count_SETs(client_id) == 2
+
+    def test_only_in_same_stream(self, backend: str) -> None:
+        client_ids = [uuid.uuid4().hex for _ in range(2)]
+        db.add_sets([self.pending(client_ids[0], "claims")])
+
+        db.add_sets([self.pending(client_ids[1], "claims", ("claims",))])
+
+        assert db.count_SETs(client_ids[0]) == 1
+
+    def test_held_only_supersedes_held(self, backend: str) -> None:
+        """Ensures a SET that is held back doesn't take the place of one the
+        receiver could have now"""
+        client_id = uuid.uuid4().hex
+        sent = self.pending(client_id, "claims")
+        db.add_sets([sent])
+
+        held = self.pending(client_id, "claims", ("claims",), held=True)
+        assert db.add_sets([held]).superseded == 0
+
+        # but a SET that isn't held supersedes both
+        db.add_sets([self.pending(client_id, "claims", ("claims",))])
+        assert db.count_SETs(client_id) == 1
+
+    def test_superseded_SETs_are_gone(self, backend: str) -> None:
+        """Ensures nothing is left of a superseded SET to be claimed,
+        released or superseded again"""
+        client_id = uuid.uuid4().hex
+        db.add_sets([self.pending(client_id, "claims", held=True)])
+        db.add_sets([self.pending(client_id, "claims", ("claims",),
+                                  held=True)])
+
+        assert db.release_SETs(client_id) == 1
+        assert db.add_sets([self.pending(
+            client_id, "claims", ("claims",)
+        )]).superseded == 1
+        assert db.count_SETs(client_id) == 1
+
+    def test_leaves_SETs_being_pushed(self, backend: str) -> None:
+        """Ensures a SET that may be being pushed isn't superseded, so the
+        receiver doesn't get it after the SET that took its place"""
+        client_id = uuid.uuid4().hex
+        now = int(time.time())
+        lapsed = self.pending(client_id, "claims", next_attempt_at=now - 60)
+        pushing = self.pending(client_id, "claims", next_attempt_at=now + 60)
+        db.add_sets([lapsed, pushing])
+
+        latest = self.pending(client_id, "claims", ("claims",),
+                              next_attempt_at=now + 60)
+        assert db.add_sets([latest]).superseded == 1
+
+        assert self.jtis(client_id) == [pushing.SET.jti, latest.SET.jti]
+
+    def test_coalesces_while_retry_in_flight(self, backend: str) -> None:
+        """Ensures a SET the retry scheduler has claimed is left alone until
+        its push is done, while SETs behind it are still coalesced"""
+        client_id = uuid.uuid4().hex
+        now = int(time.time())
+        head = self.pending(client_id, "claims", next_attempt_at=now - 60)
+        queued = self.pending(client_id, "claims")
+        db.add_sets([head, queued])
+        [due] = db.claim_due_SETs(now, 10, now + 60)
+        assert due.SET.jti == head.SET.jti
+
+        latest = self.pending(client_id, "claims", ("claims",))
+        assert db.add_sets([latest]).superseded == 1
+
+        assert self.jtis(client_id) == [head.SET.jti, latest.SET.jti]
+        db.ack_SETs(client_id, [head.SET.jti])
+        assert self.jtis(client_id) == [latest.SET.jti]
+
+
+class TestOutbox:
+    def test_claims_oldest_first(self, backend: str) -> None:
+        SETs = [make_SET() for _ in range(3)]
+        for now, SET in zip((110, 100, 200), SETs):
+            db.add_outbox_event(SET, now)
+
+        claimed = db.claim_outbox_events(now=150, limit=10, lease_until=300)
+
+        assert [e.event_id for e in claimed] == [SETs[1].jti, SETs[0].jti]
+        assert claimed[0].SET == SETs[1]
+        assert all(e.attempts == 1 for e in claimed)
+
+    def test_leases_claimed_events(self, backend: str) -> None:
+        """Ensures an event isn't claimed again until its lease is up, and
+        then counts the attempt"""
+        SET = make_SET()
+        db.add_outbox_event(SET, 100)
+
+        assert len(db.claim_outbox_events(100, 10, lease_until=160)) == 1
+        assert db.claim_outbox_events(150, 10, lease_until=210) == []
+
+        [event] = db.claim_outbox_events(160, 10, lease_until=220)
+        assert event.event_id == SET.jti
+        assert event.attempts == 2
+
+    def test_delete(self, backend: str) -> None:
+        SET = make_SET()
+        db.add_outbox_event(SET, 100)
+
+        db.delete_outbox_event(SET.jti)
+
+        assert db.claim_outbox_events(10**10, 10, 10**10) == []
+
+    def test_reschedule(self, backend: str) -> None:
+        SET = make_SET()
+        db.add_outbox_event(SET, 100)
+        db.claim_outbox_events(100, 10, lease_until=160)
+
+        db.reschedule_outbox_event(SET.jti, 110)
+
+        assert db.claim_outbox_events(109, 10, lease_until=170) == []
+        [event] = db.claim_outbox_events(110, 10, lease_until=170)
+        assert event.attempts == 2
+
+    def test_failed(self, backend: str) -> None:
+        """Ensures an event that is given up on is kept, but no longer
+        claimed"""
+        SETs = [make_SET() for _ in range(3)]
+        for SET in SETs:
+            db.add_outbox_event(SET, 100)
+        db.claim_outbox_events(100, 10, lease_until=160)
+
+        db.reschedule_outbox_event(SETs[1].jti, None)
+        db.reschedule_outbox_event(SETs[0].jti, None)
+
+        [event] = db.claim_outbox_events(10**10, 10, 10**10)
+        assert event.event_id == SETs[2].jti
+        failed = db.get_failed_outbox_events()
+        assert [e.event_id for e in failed] == [SETs[1].jti, SETs[0].jti]
+        assert failed[0].SET == SETs[1]
+        assert failed[0].attempts == 1
+
+
+class TestGetSETs:
+    def test_queue_order(self, backend: str) -> None:
+        """Ensures SETs come back in the order they were queued, even when
+        they were issued in the same second"""
+        client_id = uuid.uuid4().hex
+        SETs = [make_SET(iat=1000) for _ in range(20)]
+        for SET in SETs:
+            db.add_set(client_id, SET)
+
+        queued = db.get_SETs(client_id)
+
+        assert [q.SET.jti for q in queued] == [SET.jti for SET in SETs]
+        assert [q.seq for q in queued] == sorted(q.seq for q in queued)
+
+    def test_pages(self, backend: str) -> None:
+        """Ensures the queue can be paged through by sequence number"""
+        client_id = uuid.uuid4().hex
+        SETs = [make_SET() for _ in range(5)]
+        db.add_sets([db.PendingSET(client_id, SET) for SET in SETs])
+
+        first = db.get_SETs(client_id, 2)
+        second = db.get_SETs(client_id, 2, after=first[-1].seq)
+        third = db.get_SETs(client_id, 2, after=second[-1].seq)
+
+        assert [q.SET.jti for q in first + second + third] == \
+            [SET.jti for SET in SETs]
+
+    def test_sequence_not_reused(self, backend: str) -> None:
+        """Ensures a sequence number is never handed out twice, even once the
+        queue has been emptied"""
+        client_id = uuid.uuid4().hex
+        db.add_set(client_id, make_SET())
+        [old] = db.get_SETs(client_id)
+        db.delete_SETs(client_id)
+
+        db.add_set(client_id, make_SET())
+        [new] = db.get_SETs(client_id)
+
+        assert new.seq > old.seq
+
+    def test_acked_SETs_are_gone(self, backend: str) -> None:
+        """Ensures SETs deleted from anywhere in the queue are never handed
+        out again"""
+        client_id = uuid.uuid4().hex
+        SETs = [make_SET() for _ in range(4)]
+        db.add_sets([db.PendingSET(client_id, SET) for SET in SETs])
+
+        db.delete_SETs(client_id, [SETs[0].jti, SETs[2].jti])
+
+        assert [q.jti for q in db.get_SETs(client_id)] == \
+            [SETs[1].jti, SETs[3].jti]
+        assert db.count_SETs(client_id) == 2
+
+    def test_stored_jws(self, backend: str) -> None:
+        """Ensures a signed SET is stored and returned without needing to be
+        parsed"""
+        client_id = uuid.uuid4().hex
+        SET = make_SET()
+        db.add_set(client_id, SET, jws="header.payload.signature")
+        db.add_set(client_id, make_SET())
+
+        signed, unsigned = db.get_SETs(client_id)
+
+        assert signed.jti == SET.jti
+        assert signed.jws == "header.payload.signature"
+        assert signed.SET == SET
+        assert unsigned.jws is None
+
+    def test_uses_index(self, sqlite_db: None) -> None:
+        """Ensures fetching a page doesn't scan or sort the table"""
+        with sqlite_backend().connection() as conn:
+            plan = conn.execute(
+                "EXPLAIN QUERY PLAN SELECT seq, jti, event, jws FROM SETs "
+                "WHERE client_id=? AND seq>? ORDER BY seq LIMIT ?",
+                ("foo", 0, 10)
+            ).fetchall()
+
+        details = " ".join(row["detail"] for row in plan)
+        assert "SETs_by_client_seq" in details
+        assert "TEMP B-TREE" not in details
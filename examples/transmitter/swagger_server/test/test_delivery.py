@@ -0,0 +1,274 @@
+# Copyright (c) 2021 Cisco Systems, Inc. and its affiliates
+# All rights reserved.
+# Use of this source code is governed by a BSD 3-Clause License
+# that can be found in the LICENSE file.
+
+from collections import defaultdict
+import random
+import threading
+import time
+from typing import Dict, List, Optional
+from unittest.mock import Mock, patch
+import uuid
+
+import requests
+
+from swagger_server.business_logic import delivery, retention
+from swagger_server.business_logic.delivery import (
+    DeliveryEngine, PushJob, Timeout
+)
+from swagger_server.business_logic.generate_event import (
+    generate_security_event
+)
+from swagger_server.business_logic.stream import Stream
+from swagger_server.events import Events, SecurityEvent, VerificationEvent
+from swagger_server.models import EventType, PushDeliveryMethod, Subject
+
+
+def make_job(endpoint_url: str = "https://receiver.com/push",
+             client_id: Optional[str] = None,
+             subject: Optional[str] = None) -> PushJob:
+    SET = SecurityEvent(events=Events(verification=VerificationEvent()))
+    return PushJob(client_id or uuid.uuid4().hex, endpoint_url, None, SET,
+                   subject=subject)
+
+
+class BlockingDeliver:
+    """Stands in for a push, holding each one until released"""
+
+    def __init__(self) -> None:
+        self.release = threading.Event()
+        self.lock = threading.Lock()
+        self.running: Dict[str, int] = defaultdict(int)
+        self.most_running: Dict[str, int] = defaultdict(int)
+        self.delivered: List[PushJob] = []
+
+    def __call__(self, job: PushJob, timeout: Timeout) -> bool:
+        with self.lock:
+            self.running[job.endpoint] += 1
+            self.most_running[job.endpoint] = max(
+                self.most_running[job.endpoint], self.running[job.endpoint]
+            )
+        self.release.wait(timeout=10)
+        with self.lock:
+            self.running[job.endpoint] -= 1
+            self.delivered.append(job)
+        return True
+
+
+class TestDeliveryEngine:
+    def test_per_endpoint_limit(self) -> None:
+        """Ensures no more than per_endpoint pushes to one receiver run at
+        once, and that the rest still get pushed"""
+        deliver = BlockingDeliver()
+        engine = DeliveryEngine(workers=8, per_endpoint=2, deliver=deliver)
+
+        for _ in range(6):
+            assert engine.submit(make_job())
+        deliver.release.set()
+
+        assert engine.drain(timeout=10)
+        assert deliver.most_running["https://receiver.com"] == 2
+        assert len(deliver.delivered) == 6
+
+    def test_slow_endpoint_doesnt_block_others(self) -> None:
+        """Ensures jobs waiting on a busy receiver don't take up workers"""
+        slow = BlockingDeliver()
+        fast_done = threading.Event()
+
+        def deliver(job: PushJob, timeout: Timeout) -> bool:
+            if job.endpoint == "https://fast.com":
+                fast_done.set()
+                return True
+            return slow(job, timeout)
+
+        engine = DeliveryEngine(workers=2, per_endpoint=1, deliver=deliver)
+        for _ in range(5):
+            engine.submit(make_job("https://slow.com/push"))
+        engine.submit(make_job("https://fast.com/push"))
+
+        assert fast_done.wait(timeout=10)
+        slow.release.set()
+        assert engine.drain(timeout=10)
+
+    def test_drain_timeout(self) -> None:
+        deliver = BlockingDeliver()
+        engine = DeliveryEngine(deliver=deliver)
+        engine.submit(make_job())
+
+        assert not engine.drain(timeout=0.01)
+
+        deliver.release.set()
+        assert engine.drain(timeout=10)
+
+    def test_max_pending(self) -> None:
+        """Ensures jobs are turned away, leaving their SETs queued, rather
+        than piling up in memory"""
+        deliver = BlockingDeliver()
+        engine = DeliveryEngine(max_pending=2, deliver=deliver)
+
+        assert engine.submit(make_job())
+        assert engine.submit(make_job())
+        assert not engine.submit(make_job())
+
+        deliver.release.set()
+        assert engine.drain(timeout=10)
+
+    def test_shutdown(self) -> None:
+        """Ensures shutting down lets jobs under way finish, and turns away
+        new ones"""
+        deliver = BlockingDeliver()
+        engine = DeliveryEngine(deliver=deliver)
+        engine.submit(make_job())
+        threading.Timer(0.05, deliver.release.set).start()
+
+        engine.shutdown(timeout=10)
+
+        assert len(deliver.delivered) == 1
+        assert not engine.submit(make_job())
+
+
+class TestDeliver:
+    def test_timeouts(self, temp_db: None, with_jwks: None) -> None:
+        """Ensures a push can't hang on an unresponsive receiver"""
+        with patch('requests.Session.post') as post_mock:
+            delivery.deliver(make_job(), (1.5, 7.0))
+
+        assert post_mock.call_args.kwargs['timeout'] == (1.5, 7.0)
+
+    def test_acks_on_success(self, temp_db: None, with_jwks: None,
+                            new_stream: Stream) -> None:
+        SET = new_stream.queue_SET(
+            SecurityEvent(events=Events(verification=VerificationEvent()))
+        ).SET
+        job = PushJob(new_stream.client_id, "https://a.com/push", None, SET)
+
+        with patch('requests.Session.post'):
+            assert delivery.deliver(job, (1, 1))
+
+        assert new_stream.count_SETs() == 0
+
+    def test_keeps_on_failure(self, temp_db: None, with_jwks: None,
+                              new_stream: Stream) -> None:
+        SET = new_stream.queue_SET(
+            SecurityEvent(events=Events(verification=VerificationEvent()))
+        ).SET
+        job = PushJob(new_stream.client_id, "https://a.com/push", None, SET)
+
+        with patch('requests.Session.post', side_effect=requests.ConnectionError()):
+            assert not delivery.deliver(job, (1, 1))
+
+        assert new_stream.count_SETs() == 1
+
+    def test_stats_per_endpoint(self, temp_db: None, with_jwks: None,
+                                new_stream: Stream) -> None:
+        """Ensures each push is timed and counted against its receiver,
+        with timeouts told apart from other failures"""
+        endpoint = f"https://{uuid.uuid4().hex}.com"
+        results = delivery.push_results
+        acked = retention.ack_age.labels("push").count
+
+        with patch('requests.Session.post'):
+            assert delivery.deliver(make_job(f"{endpoint}/push"), (1, 1))
+        with patch('requests.Session.post', side_effect=requests.Timeout()):
+            assert not delivery.deliver(make_job(f"{endpoint}/push"), (1, 1))
+        job = make_job(f"{endpoint}/push")._replace(attempts=1)
+        with patch('requests.Session.post',
+                   side_effect=requests.ConnectionError()):
+            assert not delivery.deliver(job, (1, 1))
+
+        assert delivery.push_latency.labels(endpoint).count == 3
+        assert results.labels(endpoint, "success").value == 1
+        assert results.labels(endpoint, "timeout").value == 1
+        assert results.labels(endpoint, "failure").value == 1
+        assert delivery.push_retry_attempts.labels(endpoint).value == 1
+        assert retention.ack_age.labels("push").count == acked + 1
+
+
+def test_broadcast_doesnt_wait_for_pushes(temp_db: None,
+                                         with_jwks: None) -> None:
+    """Ensures a broadcast returns once the SETs are queued, before any
+    receiver has answered"""
+    email = "foo@bar.com"
+    streams = []
+    for i in range(3):
+        stream = Stream(uuid.uuid4().hex, "https://popular-app.com")
+        stream.config.delivery = PushDeliveryMethod(
+            endpoint_url=f"https://receiver-{i}.com/push"
+        )
+        stream.save()
+        stream.add_subject(email)
+        streams.append(stream)
+
+    subject = Subject.parse_obj({"format": "email", "email": email})
+    SET = generate_security_event(EventType.session_revoked, subject)
+
+    answered = threading.Event()
+
+    def post(*args, **kwargs) -> Mock:
+        answered.wait(timeout=10)
+        return Mock()
+
+    with patch('requests.Session.post', side_effect=post):
+        Stream.broadcast_SET(SET)
+        # every SET is durable before any push has finished
+        assert all(stream.count_SETs() == 1 for stream in streams)
+
+        answered.set()
+        assert delivery.push_engine.drain(timeout=10)
+
+    assert all(stream.count_SETs() == 0 for stream in streams)
+
+    def test_same_subject_in_order(self) -> None:
+        """Ensures SETs about one subject are pushed one at a time, in the
+        order they were submitted, while different subjects go in parallel"""
+        lock = threading.Lock()
+        running: Dict[Optional[str], int] = defaultdict(int)
+        most_running: Dict[Optional[str], int] = defaultdict(int)
+        delivered: Dict[Optional[str], List[str]] = defaultdict(list)
+
+        def deliver(job: PushJob, timeout: Timeout) -> bool:
+            with lock:
+                running[job.subject] += 1
+                running[None] += 1
+                most_running[job.subject] = max(most_running[job.subject],
+                                                running[job.subject])
+                most_running[None] = max(most_running[None], running[None])
+            time.sleep(random.uniform(0, 0.005))
+            with lock:
+                running[job.subject] -= 1
+                running[None] -= 1
+                delivered[job.subject].append(job.SET.jti)
+            return True
+
+        engine = DeliveryEngine(workers=8, per_endpoint=8, deliver=deliver)
+        submitted: Dict[Optional[str], List[str]] = defaultdict(list)
+        for i in range(60):
+            job = make_job(client_id="stream", subject=f"user-{i % 4}@bar.com")
+            submitted[job.subject].append(job.SET.jti)
+            assert engine.submit(job)
+
+        assert engine.drain(timeout=10)
+        assert delivered.pop(None, []) == []
+        assert delivered == submitted
+        assert all(most_running[subject] == 1 for subject in submitted)
+        assert most_running[None] > 1
+
+    def test_failure_holds_back_subject(self) -> None:
+        """Ensures a subject's later SETs aren't pushed ahead of one that
+        failed, and are left queued instead"""
+        delivered: List[PushJob] = []
+
+        def deliver(job: PushJob, timeout: Timeout) -> bool:
+            if job.subject == "foo@bar.com":
+                return False
+            delivered.append(job)
+            return True
+
+        engine = DeliveryEngine(workers=1, max_pending=10, deliver=deliver)
+        for subject in ("foo@bar.com", "baz@bar.com") * 3:
+            assert engine.submit(make_job(client_id="stream", subject=subject))
+
+        assert engine.drain(timeout=10)
+        assert [job.subject for job in delivered] == ["baz@bar.com"] * 3
+        assert engine.spare_capacity == 10
@@ -3,10 +3,17 @@
 # Use of this source code is governed by a BSD 3-Clause License
 # that can be found in the LICENSE file.
 
+import json
+import os
 from pathlib import Path
+import time
+from typing import Iterator, List
+from unittest.mock import patch
 import uuid
 
 from jwcrypto.jwk import JWK, JWKSet
+import jwt
+from jwt.utils import base64url_decode
 import pytest
 
 from swagger_server.events import (
@@ -15,14 +22,6 @@ from swagger_server.events import (
 import swagger_server.jwt_encode as jwt_encode
 
 
-@pytest.fixture(autouse=True)
-def clear_cache() -> None:
-    """The function we use to load keys uses LRU Caching to avoid hitting
-    the disk too often. We need to clear it before running any unit tests.
-    """
-    jwt_encode.load_jwks.cache_clear()
-
-
 class TestMakeJWK:
     @pytest.mark.parametrize(
         "claim",
@@ -177,6 +176,233 @@ class TestEncodeSet:
         JWT = jwt_encode.encode_set(SET)
         assert isinstance(JWT, str)
 
+    def test_same_as_pyjwt(self, with_jwks: None) -> None:
+        """Ensures the cached signer makes the same header and payload
+        jwt.encode would, and a signature that verifies"""
+        SET = SecurityEvent(
+            iss="http://foo.com",
+            aud="http://bar.com",
+            events=Events(verification=VerificationEvent())
+        )
+        jwk = jwt_encode.load_jwks().get_key(os.environ["JWK_KEY_ID"])
+        expected = jwt.encode(
+            payload=SET.dict(exclude_none=True, by_alias=True),
+            key=jwk.export_to_pem(private_key=True, password=None),
+            algorithm=jwk.alg,
+            headers=dict(kid=jwk.kid, typ="secevent+jwt"),
+            json_encoder=jwt_encode.JSONEncoder
+        )
+
+        JWT = jwt_encode.encode_set(SET)
+
+        # compared decoded, as PyJWT versions differ in the order they write
+        # the header in
+        assert jwt.get_unverified_header(JWT) == \
+            jwt.get_unverified_header(expected)
+        assert json.loads(base64url_decode(JWT.split(".")[1])) == \
+            json.loads(base64url_decode(expected.split(".")[1]))
+        assert jwt.decode(
+            JWT, jwk.export_to_pem(), algorithms=["ES256"],
+            audience="http://bar.com"
+        )["jti"] == SET.jti
+
+
+class TestGetSigner:
+    def test_cached(self, with_jwks: None) -> None:
+        key_id = os.environ["JWK_KEY_ID"]
+        assert jwt_encode.get_signer(key_id) is \
+            jwt_encode.get_signer(key_id)
+
+    def test_new_jwks(self, with_jwks: None) -> None:
+        """Ensures saving a new JWKS replaces the signers made from the old
+        one"""
+        key_id = os.environ["JWK_KEY_ID"]
+        old = jwt_encode.get_signer(key_id)
+
+        jwt_encode.save_jwks(jwt_encode.make_jwks([key_id]))
+        new = jwt_encode.get_signer(key_id)
+
+        assert new is not old
+        jwks = jwt_encode.load_jwks().export(private_keys=False, as_dict=True)
+        JWT = jwt_encode.encode_set(SecurityEvent(
+            events=Events(verification=VerificationEvent())
+        ))
+        jwt_encode.decode_set(JWT, jwks, None, None)
+
+    def test_unknown_key(self, with_jwks: None) -> None:
+        with pytest.raises(KeyError):
+            jwt_encode.get_signer("not-a-key")
+
+
+def sign() -> str:
+    return jwt_encode.encode_set(SecurityEvent(
+        events=Events(verification=VerificationEvent())
+    ))
+
+
+def write_jwks(text: str) -> None:
+    """Replace the JWKS file the way another process would, behind this
+    one's back"""
+    path = jwt_encode.get_jwks_path()
+    temp_path = path.with_name("new-jwks.json")
+    temp_path.write_text(text)
+    os.replace(temp_path, path)
+
+
+class TestKeyManager:
+    def test_unchanged(self, with_jwks: None) -> None:
+        keys = jwt_encode.key_manager.current()
+        assert not jwt_encode.key_manager.run_once()
+        assert jwt_encode.key_manager.current() is keys
+
+    def test_reloads_changed_file(self, with_jwks: None) -> None:
+        """Ensures a JWKS file replaced by another process is signed with
+        once it has been noticed"""
+        key_id = os.environ["JWK_KEY_ID"]
+        old = jwt_encode.signing_key()
+        write_jwks(jwt_encode.make_jwks([key_id]).export(private_keys=True))
+
+        assert jwt_encode.signing_key() is old
+        assert jwt_encode.key_manager.run_once()
+
+        assert jwt_encode.signing_key() is not old
+        jwt_encode.decode_set(sign(), jwt_encode.public_jwks(), None, None)
+
+    @pytest.mark.parametrize("text", [
+        "{not json",
+        jwt_encode.make_jwks(["someone-else"]).export(private_keys=True),
+        jwt_encode.make_jwks(["mock_key"]).export(private_keys=False),
+    ])
+    def test_keeps_keys_on_bad_file(self, with_jwks: None,
+                                    text: str) -> None:
+        """Ensures a JWKS file that can't be signed with doesn't stop
+        signing, and is only reported once"""
+        old = jwt_encode.signing_key()
+        failures = jwt_encode.jwks_reload_failures.value
+        write_jwks(text)
+
+        assert not jwt_encode.key_manager.run_once()
+        assert not jwt_encode.key_manager.run_once()
+
+        assert jwt_encode.jwks_reload_failures.value == failures + 1
+        assert jwt_encode.signing_key() is old
+
+    def test_rotate_and_retire(self, with_jwks: None) -> None:
+        """Ensures a rotated out key is still published until it is retired,
+        so SETs it signed can still be verified"""
+        old_key_id = os.environ["JWK_KEY_ID"]
+        old_JWT = sign()
+
+        jwt_encode.rotate_jwk("new_key")
+
+        assert jwt_encode.signing_key().kid == "new_key"
+        assert jwt.get_unverified_header(sign())["kid"] == "new_key"
+        jwks = jwt_encode.public_jwks()
+        assert set(jwks) == {"keys"}
+        assert {jwk["kid"] for jwk in jwks["keys"]} == {old_key_id, "new_key"}
+        jwt_encode.decode_set(old_JWT, jwks, None, None)
+
+        with pytest.raises(ValueError):
+            jwt_encode.retire_jwk("new_key")
+        jwt_encode.retire_jwk(old_key_id)
+
+        assert [
+            jwk["kid"] for jwk in jwt_encode.public_jwks()["keys"]
+        ] == ["new_key"]
+        assert jwt_encode.signing_key().kid == "new_key"
+
+
+def make_SETs(n: int) -> List[SecurityEvent]:
+    return [
+        SecurityEvent(aud="http://bar.com",
+                      events=Events(verification=VerificationEvent()))
+        for _ in range(n)
+    ]
+
+
+def assert_signed(JWTs: List[str], SETs: List[SecurityEvent]) -> None:
+    jwks = jwt_encode.load_jwks().export(private_keys=False, as_dict=True)
+    assert [
+        jwt_encode.decode_set(JWT, jwks, None, "http://bar.com")["jti"]
+        for JWT in JWTs
+    ] == [SET.jti for SET in SETs]
+
+
+@pytest.fixture
+def pool() -> Iterator[jwt_encode.SigningPool]:
+    pool = jwt_encode.SigningPool(processes=2, min_batch=4)
+    yield pool
+    pool.shutdown()
+
+
+class TestEncodeSets:
+    def test_small_batch_in_process(self, with_jwks: None,
+                                    pool: jwt_encode.SigningPool) -> None:
+        SETs = make_SETs(3)
+
+        with patch.object(pool, "_executor_for") as executor_mock:
+            JWTs = pool.encode(SETs)
+
+        executor_mock.assert_not_called()
+        assert_signed(JWTs, SETs)
+
+    def test_large_batch_in_pool(self, with_jwks: None,
+                                 pool: jwt_encode.SigningPool) -> None:
+        """Ensures the workers sign with the same key, and the JWSs come
+        back in the order of the SETs"""
+        SETs = make_SETs(9)
+
+        assert_signed(pool.encode(SETs), SETs)
+        assert pool._executor is not None
+
+    def test_pool_follows_new_jwks(self, with_jwks: None,
+                                   pool: jwt_encode.SigningPool) -> None:
+        pool.encode(make_SETs(4))
+        key_id = os.environ["JWK_KEY_ID"]
+        jwt_encode.save_jwks(jwt_encode.make_jwks([key_id]))
+
+        SETs = make_SETs(4)
+        assert_signed(pool.encode(SETs), SETs)
+
+    def test_falls_back_in_process(self, with_jwks: None,
+                                   pool: jwt_encode.SigningPool) -> None:
+        SETs = make_SETs(4)
+
+        with patch.object(pool, "_executor_for", side_effect=OSError()):
+            assert_signed(pool.encode(SETs), SETs)
+
+    def test_empty(self, with_jwks: None) -> None:
+        assert jwt_encode.encode_sets([]) == []
+
+
+@pytest.mark.benchmark
+def test_signs_per_second(with_jwks: None) -> None:
+    """How many SETs a second one thread can sign, compared with exporting
+    the key to PEM and having PyJWT parse it back for every SET"""
+    SETs = [
+        SecurityEvent(events=Events(verification=VerificationEvent()))
+        for _ in range(2000)
+    ]
+    jwk = jwt_encode.load_jwks().get_key(os.environ["JWK_KEY_ID"])
+
+    def pem_per_SET(SET: SecurityEvent) -> str:
+        return jwt.encode(
+            payload=SET.dict(exclude_none=True, by_alias=True),
+            key=jwk.export_to_pem(private_key=True, password=None),
+            algorithm=jwk.alg,
+            headers=dict(kid=jwk.kid, typ="secevent+jwt"),
+            json_encoder=jwt_encode.JSONEncoder
+        )
+
+    for name, sign in (("PEM per SET", pem_per_SET),
+                       ("cached signer", jwt_encode.encode_set)):
+        start = time.perf_counter()
+        for SET in SETs:
+            sign(SET)
+        seconds = time.perf_counter() - start
+        print(f"\nsigns, {name}: {len(SETs)} in {seconds:.3f}s "
+              f"({len(SETs) / seconds:,.0f}/s)")
+
 
 class TestDecodeSet:
     def test_decodes_encoded_set(self, with_jwks: None) -> None:
@@ -199,3 +425,23 @@ class TestDecodeSet:
             assert actual[key] == getattr(SET, key)
 
         assert actual["events"][VerificationEvent.__uri__] == {}
+
+
+@pytest.mark.benchmark
+def test_batch_signs_per_second(with_jwks: None) -> None:
+    """How many SETs a second encode_sets signs in a batch of 10k, for
+    different sizes of signing pool. This should go up close to linearly
+    with the number of processes, up to the number of cores"""
+    SETs = make_SETs(10000)
+    cores = os.cpu_count() or 1
+
+    for processes in sorted({1, 2, 4, cores}):
+        pool = jwt_encode.SigningPool(processes=processes)
+        # start the workers before timing
+        pool.encode(SETs[:pool.min_batch])
+        start = time.perf_counter()
+        pool.encode(SETs)
+        seconds = time.perf_counter() - start
+        pool.shutdown()
+        print(f"\nsigns, pool of {processes} ({cores} cores): "
+              f"{len(SETs)} in {seconds:.3f}s ({len(SETs) / seconds:,.0f}/s)")
@@ -0,0 +1,121 @@
+# Copyright (c) 2021 Cisco Systems, Inc. and its affiliates
+# All rights reserved.
+# Use of this source code is governed by a BSD 3-Clause License
+# that can be found in the LICENSE file.
+
+import socket
+from typing import Iterator
+import urllib.error
+import urllib.request
+import uuid
+
+import pytest
+
+from swagger_server import metrics
+from swagger_server.metrics import Counter, Histogram, MetricsServer
+
+
+def unique(name: str) -> str:
+    """Metrics live for the whole test run, so each test names its own"""
+    return f"test_{uuid.uuid4().hex[:8]}_{name}"
+
+
+def test_histogram_buckets() -> None:
+    histogram = Histogram("latency", "Latency", buckets=(0.1, 1))
+    for value in (0.05, 0.1, 0.5, 3):
+        histogram.observe(value)
+
+    counts, total = histogram.cumulative()
+    # a value on a bound counts towards that bucket
+    assert counts == [2, 3, 4]
+    assert total == pytest.approx(3.65)
+    assert histogram.count == 4
+
+
+def test_family() -> None:
+    name = unique("pushes_total")
+    family = metrics.family(Counter, name, "Pushes", ("endpoint",))
+
+    family.labels("https://a.com").inc()
+    family.labels("https://a.com").inc()
+    family.labels("https://b.com").inc()
+
+    assert metrics.family(Counter, name, "Pushes", ("endpoint",)) is family
+    assert family.labels("https://a.com").value == 2
+    with pytest.raises(ValueError):
+        family.labels("https://a.com", "extra")
+    with pytest.raises(TypeError):
+        metrics.counter(name, "Pushes")
+
+
+def test_exposition() -> None:
+    counter = metrics.counter(unique("things_total"), "Things")
+    counter.inc(3)
+    histogram = metrics.family(
+        Histogram, unique("push_seconds"), "Push latency", ("endpoint",),
+        buckets=(1,)
+    )
+    histogram.labels('https://"quoted".com').observe(0.5)
+
+    text = metrics.exposition()
+
+    assert f"# TYPE {counter.name} counter\n{counter.name} 3\n" in text
+    labels = 'endpoint="https://\\"quoted\\".com"'
+    assert "\n".join([
+        f"# HELP {histogram.name} Push latency",
+        f"# TYPE {histogram.name} histogram",
+        f'{histogram.name}_bucket{{{labels},le="1"}} 1',
+        f'{histogram.name}_bucket{{{labels},le="+Inf"}} 1',
+        f"{histogram.name}_sum{{{labels}}} 0.5",
+        f"{histogram.name}_count{{{labels}}} 1",
+    ]) in text
+
+
+def test_collected() -> None:
+    """Ensures collected gauges are read at scrape time, and that one that
+    fails doesn't take the others down with it"""
+    depths = {"stream-1": 3}
+    good = metrics.collected(unique("depth"), "Depth", "client_id",
+                             lambda: depths)
+
+    def fail() -> dict:
+        raise RuntimeError("database is down")
+    bad = metrics.collected(unique("broken"), "Broken", "client_id", fail)
+
+    depths["stream-2"] = 0
+    text = metrics.exposition()
+
+    assert f'{good.name}{{client_id="stream-1"}} 3\n' in text
+    assert f'{good.name}{{client_id="stream-2"}} 0\n' in text
+    assert f"# TYPE {bad.name} gauge\n" in text
+
+
+@pytest.fixture
+def server() -> Iterator[MetricsServer]:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    server = MetricsServer(port=port)
+    server.start()
+    yield server
+    server.stop()
+
+
+def test_server(server: MetricsServer) -> None:
+    counter = metrics.counter(unique("scraped_total"), "Scraped")
+    counter.inc()
+    url = f"http://127.0.0.1:{server.port}"
+
+    with urllib.request.urlopen(f"{url}/metrics") as response:
+        assert response.headers["Content-Type"].startswith("text/plain")
+        assert f"{counter.name} 1\n" in response.read().decode()
+
+    with pytest.raises(urllib.error.HTTPError) as err:
+        urllib.request.urlopen(f"{url}/other")
+    assert err.value.code == 404
+
+
+def test_server_off() -> None:
+    server = MetricsServer(port=0)
+    server.start()
+    server.stop()
@@ -10,6 +10,7 @@ from flask.testing import FlaskClient
 import pytest
 
 from swagger_server import db
+from swagger_server.business_logic import outbox
 from swagger_server.models import (
     AddSubjectParameters, EventType, PollDeliveryMethod,
     RegisterParameters, StreamConfiguration,
@@ -112,10 +113,13 @@ def test_trigger_event(client: FlaskClient, subject: Subject,
         '/trigger-event',
         json=body
     )
-    assert_status_code(response, 200)
-    # # check if event is queued
-    num_SETs = db.count_SETs(client_id=register_response_json["token"])
-    assert num_SETs
+    assert_status_code(response, 202)
+    event_id = json.loads(response.data.decode('utf-8'))['event_id']
+
+    # check the event is queued once it has been broadcast
+    assert outbox.dispatcher.run_once() == 1
+    SETs = db.get_SETs(client_id=register_response_json["token"])
+    assert [SET.jti for SET in SETs] == [event_id]
 
 
 if __name__ == '__main__':
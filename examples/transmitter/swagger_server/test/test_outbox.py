@@ -0,0 +1,139 @@
+# Copyright (c) 2021 Cisco Systems, Inc. and its affiliates
+# All rights reserved.
+# Use of this source code is governed by a BSD 3-Clause License
+# that can be found in the LICENSE file.
+
+import time
+from typing import Iterator, List
+from unittest.mock import patch
+import uuid
+
+import pytest
+
+from swagger_server import business_logic, db
+from swagger_server.business_logic import outbox
+from swagger_server.business_logic.outbox import Dispatcher
+from swagger_server.business_logic.stream import Stream
+from swagger_server.errors import EmailSubjectNotFound
+from swagger_server.models import EventType, Subject
+
+
+FOO = Subject.parse_obj({"format": "email", "email": "foo@bar.com"})
+
+
+@pytest.fixture
+def streams(temp_db: None) -> Iterator[List[Stream]]:
+    streams = [
+        Stream(uuid.uuid4().hex, "https://test-case.popular-app.com")
+        for _ in range(3)
+    ]
+    for stream in streams:
+        stream.add_subject("foo@bar.com")
+    yield streams
+    for stream in streams:
+        stream.delete()
+
+
+def queued(streams: List[Stream]) -> List[List[str]]:
+    return [[SET.jti for SET in stream.get_SETs()] for stream in streams]
+
+
+def trigger() -> str:
+    return business_logic.trigger_event(EventType.credential_change, FOO)
+
+
+def test_broadcasts_in_background(streams: List[Stream]) -> None:
+    """Ensures triggering an event only writes it to the outbox, and the
+    dispatcher broadcasts it"""
+    event_id = trigger()
+    assert queued(streams) == [[], [], []]
+
+    assert Dispatcher().run_once() == 1
+
+    assert queued(streams) == [[event_id]] * 3
+    assert db.claim_outbox_events(10**10, 10, 10**10) == []
+
+
+def test_keeps_trigger_order(streams: List[Stream]) -> None:
+    event_ids = [trigger() for _ in range(5)]
+
+    assert Dispatcher(batch_size=2).run_once() == 2
+    assert Dispatcher(batch_size=10).run_once() == 3
+
+    assert queued(streams) == [event_ids] * 3
+
+
+def test_unknown_subject_turned_away(temp_db: None) -> None:
+    """Ensures an event that couldn't be broadcast is turned away when it
+    is triggered, rather than accepted"""
+    subject = Subject.parse_obj({"format": "phone_number",
+                                 "phone_number": "+12065550100"})
+    with pytest.raises(EmailSubjectNotFound):
+        business_logic.trigger_event(EventType.session_revoked, subject)
+
+    assert db.claim_outbox_events(10**10, 10, 10**10) == []
+
+
+def test_failed_broadcast_retried(streams: List[Stream]) -> None:
+    event_id = trigger()
+    dispatcher = Dispatcher()
+    failures = outbox.dispatch_failures.value
+
+    with patch.object(Stream, "broadcast_SET", side_effect=OSError()):
+        assert dispatcher.run_once() == 0
+    assert outbox.dispatch_failures.value == failures + 1
+    # backed off, so not picked up again straight away
+    assert dispatcher.run_once() == 0
+
+    assert dispatcher.run_once(now=int(time.time()) + 5) == 1
+    assert queued(streams) == [[event_id]] * 3
+
+
+def test_backs_off(monkeypatch) -> None:
+    monkeypatch.setenv("OUTBOX_RETRY_BASE_DELAY", "5")
+    monkeypatch.setenv("OUTBOX_RETRY_MAX_DELAY", "60")
+    monkeypatch.setenv("OUTBOX_MAX_ATTEMPTS", "10")
+
+    assert outbox.next_attempt_at(1, 1000) == 1005
+    assert outbox.next_attempt_at(3, 1000) == 1020
+    assert outbox.next_attempt_at(9, 1000) == 1060
+    assert outbox.next_attempt_at(10, 1000) is None
+
+
+def test_poison_event_set_aside(streams: List[Stream], monkeypatch) -> None:
+    """Ensures an event that keeps failing is given up on after
+    OUTBOX_MAX_ATTEMPTS tries, rather than claimed forever"""
+    monkeypatch.setenv("OUTBOX_MAX_ATTEMPTS", "3")
+    event_id = trigger()
+    dispatcher = Dispatcher()
+    failed = outbox.outbox_failed.value
+
+    now = int(time.time())
+    with patch.object(Stream, "broadcast_SET", side_effect=OSError()):
+        for _ in range(3):
+            assert dispatcher.run_once(now=now) == 0
+            now += 3600
+
+    assert outbox.outbox_failed.value == failed + 1
+    assert db.claim_outbox_events(10**10, 10, 10**10) == []
+    [event] = db.get_failed_outbox_events()
+    assert event.event_id == event_id
+    assert event.attempts == 3
+    assert queued(streams) == [[], [], []]
+
+
+def test_redelivery_doesnt_duplicate(streams: List[Stream]) -> None:
+    """Ensures an event broadcast by a dispatcher that went away before
+    taking it out of the outbox is broadcast again without any stream
+    getting it twice"""
+    event_id = trigger()
+    [event] = db.claim_outbox_events(int(time.time()), 10,
+                                     outbox.lease_until())
+    Stream.broadcast_SET(event.SET)
+    # one stream has since been polled and acknowledged it
+    streams[0].ack_SETs([event_id])
+
+    assert Dispatcher().run_once(now=outbox.lease_until()) == 1
+
+    # at least once: the stream that acknowledged it gets it again
+    assert queued(streams) == [[event_id]] * 3
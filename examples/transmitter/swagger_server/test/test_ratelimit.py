@@ -0,0 +1,227 @@
+# Copyright (c) 2021 Cisco Systems, Inc. and its affiliates
+# All rights reserved.
+# Use of this source code is governed by a BSD 3-Clause License
+# that can be found in the LICENSE file.
+
+from email.utils import formatdate
+import time
+from typing import Iterator
+from unittest.mock import Mock, patch
+import uuid
+
+import pytest
+import requests
+
+from swagger_server import db
+from swagger_server.business_logic import delivery, ratelimit
+from swagger_server.business_logic.delivery import PushJob
+from swagger_server.business_logic.ratelimit import (
+    RateLimiter, RateLimiterRegistry
+)
+from swagger_server.business_logic.stream import Stream
+from swagger_server.events import Events, SecurityEvent, VerificationEvent
+from swagger_server.models import PushDeliveryMethod
+from swagger_server import metrics
+
+
+class FakeClock:
+    def __init__(self) -> None:
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def make_limiter(clock: FakeClock, max_rate: float = 0) -> RateLimiter:
+    return RateLimiter("https://receiver.com", max_rate=max_rate,
+                       min_rate=1, increase=10, decrease=0.5, slow_push=2,
+                       max_retry_after=600, max_wait=1, clock=clock)
+
+
+def send(limiter: RateLimiter, pushes: int) -> None:
+    for _ in range(pushes):
+        assert limiter.reserve() == 0
+
+
+class TestRateLimiter:
+    def test_unlimited_while_healthy(self) -> None:
+        clock = FakeClock()
+        limiter = make_limiter(clock)
+
+        for _ in range(100):
+            assert limiter.reserve() == 0
+            limiter.record(True, 0.1)
+
+        assert limiter.rate is None
+
+    def test_cuts_from_sent_rate(self) -> None:
+        """Ensures pushing back halves the rate the receiver was being sent,
+        and that pushes are then spaced out to fit"""
+        clock = FakeClock()
+        limiter = make_limiter(clock)
+        send(limiter, 40)
+
+        limiter.record(False, 0.1)
+
+        assert limiter.rate == 20
+        assert limiter.reserve() == 0
+        assert limiter.reserve() == pytest.approx(0.05)
+        assert limiter.reserve() == pytest.approx(0.1)
+
+    def test_slow_push_cuts(self) -> None:
+        clock = FakeClock()
+        limiter = make_limiter(clock)
+        send(limiter, 8)
+
+        limiter.record(True, 3)
+
+        assert limiter.rate == 4
+
+    def test_cuts_once_a_second(self) -> None:
+        """Ensures the pushes that were under way when the receiver started
+        struggling don't each cut the rate"""
+        clock = FakeClock()
+        limiter = make_limiter(clock)
+        send(limiter, 40)
+
+        for _ in range(4):
+            limiter.record(False, 0.1)
+        assert limiter.rate == 20
+
+        clock.now += 1
+        limiter.record(False, 0.1)
+        assert limiter.rate == 10
+
+    def test_min_rate(self) -> None:
+        clock = FakeClock()
+        limiter = make_limiter(clock)
+
+        for _ in range(5):
+            limiter.record(False, 0.1)
+            clock.now += 1
+
+        assert limiter.rate == 1
+
+    def test_recovers_and_lifts(self) -> None:
+        """Ensures each push that goes well raises the rate, until it is
+        back to where it was cut from and the limit is lifted"""
+        clock = FakeClock()
+        limiter = make_limiter(clock)
+        send(limiter, 40)
+        limiter.record(False, 0.1)
+
+        limiter.record(True, 0.1)
+        assert limiter.rate == pytest.approx(20.5)
+
+        for _ in range(100):
+            limiter.record(True, 0.1)
+        assert limiter.rate is None
+        assert limiter.reserve() == 0
+
+    def test_max_rate(self) -> None:
+        clock = FakeClock()
+        limiter = make_limiter(clock, max_rate=10)
+        assert limiter.rate == 10
+
+        for _ in range(100):
+            limiter.record(True, 0.1)
+        assert limiter.rate == 10
+
+    def test_retry_after_blocks(self) -> None:
+        clock = FakeClock()
+        limiter = make_limiter(clock)
+        throttled = ratelimit.throttled.value
+
+        limiter.record(False, 0.1, wait=30)
+
+        # too long to wait for, so nothing is reserved
+        assert limiter.reserve() == 30
+        assert ratelimit.throttled.value == throttled + 1
+        clock.now += 29.5
+        assert limiter.reserve() == pytest.approx(0.5)
+
+    def test_retry_after_capped(self) -> None:
+        clock = FakeClock()
+        limiter = make_limiter(clock)
+
+        limiter.record(False, 0.1, wait=86400)
+
+        assert limiter.health()["blocked_for"] == 600
+
+
+def test_registry_metrics() -> None:
+    """Ensures how long each receiver asked to be left alone is scraped with
+    the other metrics"""
+    clock = FakeClock()
+    registry = RateLimiterRegistry(lambda endpoint: RateLimiter(
+        endpoint, min_rate=1, max_retry_after=600, clock=clock
+    ))
+    registry.get("https://busy.com/push").record(False, 0.1, wait=30)
+    registry.get("https://idle.com/push")
+
+    with patch.object(delivery, "limiters", registry):
+        text = metrics.exposition()
+
+    assert "# TYPE push_rate_blocked_seconds gauge\n" in text
+    assert 'push_rate_blocked_seconds{endpoint="https://busy.com"} 30\n' \
+        in text
+    assert 'push_rate_blocked_seconds{endpoint="https://idle.com"} 0\n' \
+        in text
+
+
+def test_retry_after() -> None:
+    def response(value: str) -> Mock:
+        return Mock(headers={"Retry-After": value})
+
+    assert ratelimit.retry_after(None) is None
+    assert ratelimit.retry_after(Mock(headers={})) is None
+    assert ratelimit.retry_after(response("120")) == 120
+    assert ratelimit.retry_after(response("soon")) is None
+
+    now = time.time()
+    in_a_minute = formatdate(now + 60, usegmt=True)
+    assert ratelimit.retry_after(response(in_a_minute), now) == \
+        pytest.approx(60, abs=1)
+    past = formatdate(now - 60, usegmt=True)
+    assert ratelimit.retry_after(response(past), now) == 0
+
+
+@pytest.fixture
+def push_stream(temp_db: None, with_jwks: None) -> Iterator[Stream]:
+    stream = Stream(uuid.uuid4().hex, "https://test-case.popular-app.com")
+    stream.config.delivery = PushDeliveryMethod(
+        endpoint_url="https://busy.receiver.com/push"
+    )
+    stream.save()
+    yield stream
+    stream.delete()
+
+
+def queue_job(stream: Stream) -> PushJob:
+    SET = stream.queue_SET(
+        SecurityEvent(events=Events(verification=VerificationEvent()))
+    ).SET
+    return stream.push_job(SET)
+
+
+def test_deliver_honors_retry_after(push_stream: Stream) -> None:
+    """Ensures a receiver that asks to be left alone is, with its SETs left
+    queued until then"""
+    too_many = requests.HTTPError(response=Mock(
+        status_code=429, headers={"Retry-After": "120"}
+    ))
+    first, second = queue_job(push_stream), queue_job(push_stream)
+
+    with patch('requests.Session.post',
+               side_effect=too_many) as post_mock:
+        assert not delivery.deliver(first, (1, 1))
+        assert not delivery.deliver(second, (1, 1))
+
+    post_mock.assert_called_once()
+    later = int(time.time()) + 119
+    assert db.claim_due_SETs(now=later - 2, limit=10, lease_until=0) == []
+    # the second didn't count as a failed attempt
+    due = db.claim_due_SETs(now=later + 2, limit=10, lease_until=0)
+    assert {(d.jti, d.attempts) for d in due} == {
+        (first.SET.jti, 1), (second.SET.jti, 0)
+    }
@@ -0,0 +1,269 @@
+# Copyright (c) 2021 Cisco Systems, Inc. and its affiliates
+# All rights reserved.
+# Use of this source code is governed by a BSD 3-Clause License
+# that can be found in the LICENSE file.
+
+from collections import defaultdict
+import threading
+from typing import Any, Dict, Iterator, List
+from unittest.mock import Mock, patch
+import uuid
+
+import jwt
+import pytest
+
+from swagger_server import db
+from swagger_server.business_logic import delivery, replay
+from swagger_server.business_logic.delivery import PushJob, Timeout
+from swagger_server.business_logic.generate_event import (
+    generate_security_event
+)
+from swagger_server.business_logic.replay import Replayer
+from swagger_server.business_logic.retry import RetryScheduler
+from swagger_server.business_logic.stream import Stream
+from swagger_server.events import Events, SecurityEvent, VerificationEvent
+from swagger_server.models import (
+    EventType, PushDeliveryMethod, Status, Subject
+)
+
+
+FOO = "foo@bar.com"
+BAZ = "baz@bar.com"
+
+
+def broadcast(email: str,
+              event_type: EventType = EventType.credential_change) -> str:
+    """Broadcast a SET about email, returning its jti. By default, of a type
+    that doesn't supersede earlier SETs"""
+    subject = Subject.parse_obj({"format": "email", "email": email})
+    SET = generate_security_event(event_type, subject)
+    Stream.broadcast_SET(SET)
+    return SET.jti
+
+
+def polled(stream: Stream) -> List[str]:
+    return [SET.jti for SET in stream.get_SETs()]
+
+
+@pytest.fixture
+def poll_stream(temp_db: None) -> Iterator[Stream]:
+    stream = Stream(uuid.uuid4().hex, "https://test-case.popular-app.com")
+    for email in (FOO, BAZ):
+        stream.add_subject(email)
+    yield stream
+    stream.delete()
+
+
+@pytest.fixture
+def push_stream(temp_db: None, with_jwks: None,
+                monkeypatch) -> Iterator[Stream]:
+    # replay in the foreground, so the tests can see how it went
+    monkeypatch.setattr(replay.replayer, "start", replay.replayer.run)
+    stream = Stream(uuid.uuid4().hex, "https://test-case.popular-app.com")
+    stream.config.delivery = PushDeliveryMethod(
+        endpoint_url="https://receiver.com/push"
+    )
+    stream.save()
+    for email in (FOO, BAZ):
+        stream.add_subject(email)
+    yield stream
+    stream.delete()
+
+
+class TestPollStreams:
+    def test_paused_stream(self, poll_stream: Stream) -> None:
+        """Ensures SETs are held while a stream is paused, and can be polled
+        in order once it is enabled"""
+        poll_stream.update_status(Status.paused)
+        jtis = [broadcast(FOO), broadcast(BAZ), broadcast(FOO)]
+
+        assert polled(poll_stream) == []
+        assert poll_stream.count_SETs() == 3
+
+        poll_stream.update_status(Status.enabled)
+        assert polled(poll_stream) == jtis
+
+    def test_paused_subject(self, poll_stream: Stream) -> None:
+        poll_stream.set_subject_status(FOO, Status.paused)
+        held = broadcast(FOO)
+        sent = broadcast(BAZ)
+
+        assert polled(poll_stream) == [sent]
+
+        poll_stream.set_subject_status(FOO, Status.enabled)
+        assert polled(poll_stream) == [held, sent]
+
+    def test_paused_subject_in_paused_stream(self,
+                                             poll_stream: Stream) -> None:
+        """Ensures a subject's SETs stay held until both it and the stream
+        are enabled"""
+        poll_stream.update_status(Status.paused)
+        poll_stream.set_subject_status(FOO, Status.paused)
+        foo, baz = broadcast(FOO), broadcast(BAZ)
+
+        poll_stream.set_subject_status(FOO, Status.enabled)
+        assert polled(poll_stream) == []
+        poll_stream.set_subject_status(FOO, Status.paused)
+
+        poll_stream.update_status(Status.enabled)
+        assert polled(poll_stream) == [baz]
+        poll_stream.set_subject_status(FOO, Status.enabled)
+        assert polled(poll_stream) == [foo, baz]
+
+    def test_disabled_drops_held_SETs(self, poll_stream: Stream) -> None:
+        poll_stream.update_status(Status.paused)
+        broadcast(FOO)
+        poll_stream.update_status(Status.disabled)
+        broadcast(FOO)
+
+        poll_stream.update_status(Status.enabled)
+        assert poll_stream.count_SETs() == 0
+
+    def test_disabled_subject_drops_held_SETs(self,
+                                              poll_stream: Stream) -> None:
+        poll_stream.set_subject_status(FOO, Status.paused)
+        broadcast(FOO)
+        poll_stream.set_subject_status(FOO, Status.disabled)
+
+        poll_stream.set_subject_status(FOO, Status.enabled)
+        assert poll_stream.count_SETs() == 0
+
+    def test_coalesces_held_SETs(self, poll_stream: Stream) -> None:
+        """Ensures SETs that later SETs about the same subject make moot
+        aren't kept for the receiver"""
+        poll_stream.update_status(Status.paused)
+        broadcast(FOO, EventType.account_disabled)
+        baz = broadcast(BAZ, EventType.account_disabled)
+        enabled = broadcast(FOO, EventType.account_enabled)
+        broadcast(FOO, EventType.session_revoked)
+        revoked = broadcast(FOO, EventType.session_revoked)
+
+        poll_stream.update_status(Status.enabled)
+        assert polled(poll_stream) == [baz, enabled, revoked]
+
+    def test_verification(self, poll_stream: Stream) -> None:
+        """Ensures SETs that aren't about a subject are held too"""
+        poll_stream.update_status(Status.paused)
+        poll_stream.process_SET(
+            SecurityEvent(events=Events(verification=VerificationEvent()))
+        )
+        assert polled(poll_stream) == []
+
+
+class TestPushStreams:
+    def test_replays_held_SETs(self, push_stream: Stream) -> None:
+        push_stream.update_status(Status.paused)
+        with patch('requests.Session.post') as post_mock:
+            jtis = [broadcast(FOO), broadcast(BAZ)]
+            post_mock.assert_not_called()
+
+            push_stream.update_status(Status.enabled)
+
+        assert post_mock.call_count == 2
+        assert push_stream.count_SETs() == 0
+        assert replay.replayed_SETs.value >= len(jtis)
+
+    def test_paused_subject(self, push_stream: Stream) -> None:
+        push_stream.set_subject_status(FOO, Status.paused)
+        with patch('requests.Session.post', return_value=Mock()):
+            broadcast(FOO)
+            broadcast(BAZ)
+            assert delivery.push_engine.drain(timeout=10)
+            assert push_stream.count_SETs() == 1
+
+            push_stream.set_subject_status(FOO, Status.enabled)
+
+        assert push_stream.count_SETs() == 0
+
+    def test_broadcast_during_replay(self, push_stream: Stream,
+                                     monkeypatch) -> None:
+        """Ensures a SET broadcast while held SETs about its subject are
+        being replayed is pushed after them, not ahead of them"""
+        push_stream.update_status(Status.paused)
+        held = [broadcast(FOO), broadcast(FOO)]
+        releases: List[int] = []
+        monkeypatch.setattr(replay.replayer, "start",
+                            lambda stream, released_at:
+                            releases.append(released_at))
+        push_stream.update_status(Status.enabled)
+        pushed: List[str] = []
+
+        def post(url: str, data: str, **kwargs: Any) -> Mock:
+            pushed.append(jwt.decode(
+                data, options={"verify_signature": False}
+            )["jti"])
+            return Mock()
+
+        with patch('requests.Session.post', side_effect=post):
+            live = broadcast(FOO)
+            assert delivery.push_engine.drain(timeout=10)
+            assert pushed == []
+
+            [released_at] = releases
+            assert replay.replayer.run(push_stream, released_at) == 2
+            RetryScheduler().run_once(now=10 ** 10)
+            assert delivery.push_engine.drain(timeout=10)
+
+        assert pushed == held + [live]
+        assert push_stream.count_SETs() == 0
+
+
+class RecordingDeliver:
+    """Stands in for deliver, accepting each SET it is handed unless it is
+    about the subject that is to fail"""
+
+    def __init__(self, fail: str = "") -> None:
+        self.fail = fail
+        self.lock = threading.Lock()
+        self.delivered: Dict[str, List[str]] = defaultdict(list)
+
+    def __call__(self, job: PushJob, timeout: Timeout) -> bool:
+        email = job.subject
+        if email == self.fail:
+            return False
+        with self.lock:
+            self.delivered[email].append(job.SET.jti)
+        return True
+
+
+class TestReplayer:
+    def hold(self, stream: Stream, emails: List[str]) -> Dict[str, List[str]]:
+        stream.update_status(Status.paused)
+        jtis: Dict[str, List[str]] = defaultdict(list)
+        for email in emails:
+            jtis[email].append(broadcast(email))
+        return jtis
+
+    def test_keeps_per_subject_order(self, push_stream: Stream) -> None:
+        """Ensures each subject's SETs are pushed in the order they were
+        queued, across batches, while subjects are pushed concurrently"""
+        emails = [f"user-{i % 7}@bar.com" for i in range(60)]
+        for email in set(emails):
+            push_stream.add_subject(email)
+        jtis = self.hold(push_stream, emails)
+
+        deliver = RecordingDeliver()
+        replayer = Replayer(concurrency=4, batch_size=8, deliver=deliver)
+        released_at = replay.lease_until()
+        db.release_SETs(push_stream.client_id, None, released_at)
+
+        assert replayer.run(push_stream, released_at) == 60
+        assert deliver.delivered == jtis
+        assert push_stream.count_SETs() == 0
+
+    def test_failure_stalls_subject(self, push_stream: Stream) -> None:
+        """Ensures a subject whose push failed doesn't have its later SETs
+        pushed ahead of it, while other subjects carry on"""
+        jtis = self.hold(push_stream, [FOO, BAZ, FOO, BAZ, FOO])
+
+        deliver = RecordingDeliver(fail=FOO)
+        replayer = Replayer(concurrency=2, batch_size=2, deliver=deliver)
+        released_at = replay.lease_until()
+        db.release_SETs(push_stream.client_id, None, released_at)
+
+        assert replayer.run(push_stream, released_at) == 2
+        assert deliver.delivered == {BAZ: jtis[BAZ]}
+        # FOO's SETs are left for the retry scheduler
+        assert push_stream.count_SETs() == 3
+        assert db.claim_released_SETs(push_stream.client_id, released_at,
+                                      10, 0) == []
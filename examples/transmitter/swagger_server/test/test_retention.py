@@ -0,0 +1,172 @@
+# Copyright (c) 2021 Cisco Systems, Inc. and its affiliates
+# All rights reserved.
+# Use of this source code is governed by a BSD 3-Clause License
+# that can be found in the LICENSE file.
+
+import time
+import uuid
+
+import pytest
+
+from swagger_server import db, metrics
+from swagger_server.business_logic import retention
+from swagger_server.business_logic.generate_event import (
+    generate_security_event
+)
+from swagger_server.business_logic.retention import (
+    Compactor, RetentionPolicy
+)
+from swagger_server.business_logic.stream import Stream
+from swagger_server.errors import QueueFull
+from swagger_server.events import Events, SecurityEvent, VerificationEvent
+from swagger_server.models import EventType, Subject
+
+
+def make_SET() -> SecurityEvent:
+    return SecurityEvent(events=Events(verification=VerificationEvent()))
+
+
+class TestRetentionPolicy:
+    def test_defaults(self) -> None:
+        """Ensures SETs are kept forever unless configured otherwise"""
+        policy = RetentionPolicy.from_env()
+
+        assert policy.max_age is None
+        assert policy.max_depth is None
+        assert policy.on_full == db.QueueFullPolicy.drop_oldest
+        assert policy.expires_at() is None
+
+    def test_from_env(self, monkeypatch) -> None:
+        monkeypatch.setenv("SET_MAX_AGE", "3600")
+        monkeypatch.setenv("SET_MAX_QUEUE_DEPTH", "100")
+        monkeypatch.setenv("SET_QUEUE_FULL_POLICY", "reject")
+
+        policy = RetentionPolicy.from_env()
+
+        assert policy == RetentionPolicy(3600, 100, db.QueueFullPolicy.reject)
+        assert policy.expires_at(now=1000) == 4600
+
+    def test_override(self) -> None:
+        """Ensures a stream's own limits win over the global ones, which
+        fill in the rest"""
+        default = RetentionPolicy(3600, 100, db.QueueFullPolicy.drop_oldest)
+        own = RetentionPolicy(max_depth=10)
+
+        assert default.override(own) == \
+            RetentionPolicy(3600, 10, db.QueueFullPolicy.drop_oldest)
+        assert default.override(None) == default
+
+    def test_round_trip(self) -> None:
+        policy = RetentionPolicy(60, None, db.QueueFullPolicy.reject)
+
+        assert RetentionPolicy.from_data(policy.to_data()) == policy
+
+
+class TestStreamRetention:
+    def test_saved_with_stream(self, temp_db: None,
+                               new_stream: Stream) -> None:
+        """Ensures a stream's own policy survives a reload"""
+        policy = RetentionPolicy(max_depth=5)
+        new_stream.set_retention(policy)
+
+        reloaded = Stream.from_data(db.load_stream(new_stream.client_id))
+
+        assert reloaded.retention == policy
+
+    def test_drop_oldest(self, temp_db: None, new_stream: Stream) -> None:
+        dropped = retention.dropped_SETs.value
+        new_stream.set_retention(RetentionPolicy(max_depth=2))
+        SETs = [make_SET() for _ in range(3)]
+
+        for SET in SETs:
+            new_stream.queue_SET(SET)
+
+        assert [SET.jti for SET in new_stream.get_SETs()] == \
+            [SET.jti for SET in SETs[1:]]
+        assert retention.dropped_SETs.value == dropped + 1
+
+    def test_reject(self, temp_db: None, new_stream: Stream,
+                    monkeypatch) -> None:
+        monkeypatch.setenv("SET_QUEUE_FULL_POLICY", "reject")
+        rejected = retention.rejected_SETs.value
+        new_stream.set_retention(RetentionPolicy(max_depth=1))
+        new_stream.queue_SET(make_SET())
+
+        with pytest.raises(QueueFull):
+            new_stream.queue_SET(make_SET())
+
+        assert new_stream.count_SETs() == 1
+        assert retention.rejected_SETs.value == rejected + 1
+
+    def test_broadcast_skips_full_queues(self, temp_db: None,
+                                         monkeypatch) -> None:
+        """Ensures one full queue doesn't stop a broadcast reaching the
+        other streams"""
+        monkeypatch.setenv("SET_QUEUE_FULL_POLICY", "reject")
+        email = "foo@bar.com"
+        full = Stream(uuid.uuid4().hex, "https://full.popular-app.com")
+        full.set_retention(RetentionPolicy(max_depth=1))
+        full.queue_SET(make_SET())
+        other = Stream(uuid.uuid4().hex, "https://other.popular-app.com")
+        for stream in (full, other):
+            stream.add_subject(email)
+
+        subject = Subject.parse_obj({"format": "email", "email": email})
+        Stream.broadcast_SET(
+            generate_security_event(EventType.session_revoked, subject)
+        )
+
+        assert full.count_SETs() == 1
+        assert other.count_SETs() == 1
+
+    def test_queue_depth_exported(self, temp_db: None) -> None:
+        """Ensures queue depths are scraped without naming the streams,
+        whose client ids are their bearer tokens"""
+        streams = [
+            Stream(uuid.uuid4().hex, "https://test-case.popular-app.com")
+            for _ in range(2)
+        ]
+        for i, stream in enumerate(streams):
+            for _ in range(i + 1):
+                stream.queue_SET(make_SET())
+
+        text = metrics.exposition()
+
+        assert 'set_queue_depth{queues="all"} 3\n' in text
+        assert 'set_queue_depth{queues="deepest"} 2\n' in text
+        for stream in streams:
+            assert stream.client_id not in text
+
+
+class TestCompactor:
+    def test_expires_in_batches(self, temp_db: None, new_stream: Stream,
+                                monkeypatch) -> None:
+        expired = retention.expired_SETs.value
+        monkeypatch.setenv("SET_MAX_AGE", "60")
+        for _ in range(7):
+            new_stream.queue_SET(make_SET())
+        fresh = make_SET()
+        monkeypatch.setenv("SET_MAX_AGE", "3600")
+        new_stream.queue_SET(fresh)
+
+        compactor = Compactor(batch_size=3)
+        assert compactor.run_once(now=int(time.time()) + 120) == 7
+
+        assert [SET.jti for SET in new_stream.get_SETs()] == [fresh.jti]
+        assert retention.expired_SETs.value == expired + 7
+
+    def test_background_thread(self, temp_db: None,
+                               new_stream: Stream) -> None:
+        """Ensures the thread runs until it is stopped"""
+        new_stream.queue_SET(make_SET())
+        db.add_sets([db.PendingSET(new_stream.client_id, make_SET(),
+                                   expires_at=0)])
+
+        compactor = Compactor(interval=0.01)
+        compactor.start()
+        deadline = time.monotonic() + 5
+        while new_stream.count_SETs() > 1 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        compactor.stop()
+
+        assert new_stream.count_SETs() == 1
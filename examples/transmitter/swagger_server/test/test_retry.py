@@ -0,0 +1,244 @@
+# Copyright (c) 2021 Cisco Systems, Inc. and its affiliates
+# All rights reserved.
+# Use of this source code is governed by a BSD 3-Clause License
+# that can be found in the LICENSE file.
+
+from typing import Any, Iterator, List
+from unittest.mock import Mock, patch
+import uuid
+
+import jwt
+import pytest
+import requests
+
+from swagger_server import db
+from swagger_server.business_logic import delivery
+from swagger_server.business_logic import replay
+from swagger_server.business_logic import retry
+from swagger_server.business_logic.retry import RetryScheduler
+from swagger_server.business_logic.stream import Stream
+from swagger_server.business_logic.generate_event import (
+    generate_security_event
+)
+from swagger_server.events import Events, SecurityEvent, VerificationEvent
+from swagger_server.models import (
+    EventType, PushDeliveryMethod, Status, Subject
+)
+
+# long after anything queued by a test is due
+LATER = 10 ** 10
+
+FOO = "foo@bar.com"
+
+
+def make_SET() -> SecurityEvent:
+    return SecurityEvent(events=Events(verification=VerificationEvent()))
+
+
+@pytest.fixture
+def push_stream(temp_db: None, with_jwks: None) -> Iterator[Stream]:
+    stream = Stream(uuid.uuid4().hex, "https://test-case.popular-app.com")
+    stream.config.delivery = PushDeliveryMethod(
+        endpoint_url="https://receiver.com/push"
+    )
+    stream.save()
+    yield stream
+    stream.delete()
+
+
+class TestBackoff:
+    def test_exponential_with_jitter(self, monkeypatch) -> None:
+        monkeypatch.setenv("PUSH_RETRY_BASE_DELAY", "10")
+        monkeypatch.setenv("PUSH_RETRY_MAX_DELAY", "1000")
+
+        for attempts, delay in [(1, 10), (2, 20), (3, 40), (20, 1000)]:
+            retry_ats = {delivery.next_attempt_at(attempts, now=0)
+                         for _ in range(50)}
+            assert all(delay / 2 - 1 <= at <= delay for at in retry_ats)
+            # retries are spread out, not all at once
+            assert len(retry_ats) > 1
+
+    def test_max_attempts(self, monkeypatch) -> None:
+        assert delivery.next_attempt_at(1000, now=0) is not None
+
+        monkeypatch.setenv("PUSH_RETRY_MAX_ATTEMPTS", "3")
+        assert delivery.next_attempt_at(2, now=0) is not None
+        assert delivery.next_attempt_at(3, now=0) is None
+
+
+def test_failed_push_is_rescheduled(push_stream: Stream) -> None:
+    failures = delivery.push_failures.value
+    with patch('requests.Session.post',
+               side_effect=requests.ConnectionError()):
+        push_stream.process_SET(make_SET())
+        assert delivery.push_engine.drain(timeout=10)
+
+    [due] = db.claim_due_SETs(LATER, 10, LATER)
+    assert due.attempts == 1
+    assert push_stream.count_SETs() == 1
+    assert delivery.push_failures.value == failures + 1
+
+
+def test_gives_up(push_stream: Stream, monkeypatch) -> None:
+    """Ensures a SET that has failed too often stays queued, but isn't
+    pushed again"""
+    monkeypatch.setenv("PUSH_RETRY_MAX_ATTEMPTS", "1")
+    with patch('requests.Session.post',
+               side_effect=requests.ConnectionError()):
+        push_stream.process_SET(make_SET())
+        assert delivery.push_engine.drain(timeout=10)
+
+    assert db.claim_due_SETs(LATER, 10, LATER) == []
+    assert push_stream.count_SETs() == 1
+
+
+class TestRetryScheduler:
+    def test_retries_due_SETs(self, push_stream: Stream) -> None:
+        retries = retry.retried_SETs.value
+        with patch('requests.Session.post',
+                   side_effect=requests.ConnectionError()):
+            push_stream.process_SET(make_SET())
+            assert delivery.push_engine.drain(timeout=10)
+
+        scheduler = RetryScheduler()
+        # nothing is due yet
+        assert scheduler.run_once() == 0
+
+        with patch('requests.Session.post', return_value=Mock()) as post_mock:
+            assert scheduler.run_once(now=LATER) == 1
+            assert delivery.push_engine.drain(timeout=10)
+
+        post_mock.assert_called_once()
+        assert push_stream.count_SETs() == 0
+        assert retry.retried_SETs.value == retries + 1
+        assert retry.retry_lag.value > 0
+
+    def test_batch_size(self, push_stream: Stream) -> None:
+        for _ in range(5):
+            push_stream.queue_SET(make_SET())
+
+        scheduler = RetryScheduler(batch_size=2)
+        with patch('requests.Session.post', return_value=Mock()):
+            assert scheduler.run_once(now=LATER) == 2
+            assert delivery.push_engine.drain(timeout=10)
+
+        assert push_stream.count_SETs() == 3
+
+    def test_spare_capacity(self, push_stream: Stream, monkeypatch) -> None:
+        """Ensures SETs aren't claimed when the engine has no room for them,
+        where they would only be turned away"""
+        push_stream.queue_SET(make_SET())
+        monkeypatch.setattr(delivery.push_engine, "max_pending", 0)
+
+        assert RetryScheduler().run_once(now=LATER) == 0
+
+        monkeypatch.undo()
+        assert len(db.claim_due_SETs(LATER, 10, LATER)) == 1
+
+    def test_holds_for_paused_stream(self, push_stream: Stream,
+                                     monkeypatch) -> None:
+        """Ensures a retry that comes due while its stream is paused is
+        held, rather than claimed over and over, and is replayed once the
+        stream is enabled"""
+        monkeypatch.setattr(replay.replayer, "start", replay.replayer.run)
+        with patch('requests.Session.post',
+                   side_effect=requests.ConnectionError()):
+            push_stream.process_SET(make_SET())
+            assert delivery.push_engine.drain(timeout=10)
+        push_stream.update_status(Status.paused)
+
+        with patch('requests.Session.post') as post_mock:
+            assert RetryScheduler().run_once(now=LATER) == 0
+            assert db.claim_due_SETs(LATER * 2, 10, LATER * 2) == []
+            post_mock.assert_not_called()
+
+            push_stream.update_status(Status.enabled)
+            assert delivery.push_engine.drain(timeout=10)
+
+        post_mock.assert_called_once()
+        assert push_stream.count_SETs() == 0
+
+    def test_unschedules_polled_streams(self, temp_db: None,
+                                        new_stream: Stream) -> None:
+        """Ensures SETs of a stream that switched from push to poll are left
+        for the receiver to poll"""
+        db.add_sets([db.PendingSET(new_stream.client_id, make_SET(),
+                                   next_attempt_at=0)])
+
+        assert RetryScheduler().run_once(now=LATER) == 0
+
+        assert db.claim_due_SETs(LATER, 10, LATER) == []
+        assert new_stream.count_SETs() == 1
+
+    def test_keeps_subject_order(self, push_stream: Stream,
+                                 monkeypatch) -> None:
+        """Ensures a SET held back behind an earlier one about the same
+        subject isn't retried ahead of it, however long that one backs off
+        """
+        # backing off for longer than the later SET is leased for
+        monkeypatch.setenv("PUSH_RETRY_BASE_DELAY", "1000")
+        first, second = make_SET(), make_SET()
+        scheduler = RetryScheduler()
+        with patch('requests.Session.post',
+                   side_effect=requests.ConnectionError()):
+            push_stream.process_SET(first, email_address=FOO)
+            push_stream.process_SET(second, email_address=FOO)
+            assert delivery.push_engine.drain(timeout=10)
+            # and the first fails again
+            assert scheduler.run_once(now=LATER) == 1
+            assert delivery.push_engine.drain(timeout=10)
+
+        pushed: List[str] = []
+
+        def post(url: str, data: str, **kwargs: Any) -> Mock:
+            pushed.append(jwt.decode(
+                data, options={"verify_signature": False}
+            )["jti"])
+            return Mock()
+
+        with patch('requests.Session.post', side_effect=post):
+            for _ in range(3):
+                scheduler.run_once(now=LATER)
+                assert delivery.push_engine.drain(timeout=10)
+
+        assert pushed == [first.jti, second.jti]
+        assert push_stream.count_SETs() == 0
+
+    def test_broadcast_waits_for_failed_SET(self, push_stream: Stream,
+                                            monkeypatch) -> None:
+        """Ensures a SET broadcast while an earlier one about the same
+        subject is backing off isn't pushed ahead of it"""
+        monkeypatch.setenv("PUSH_RETRY_BASE_DELAY", "1000")
+        push_stream.add_subject(FOO)
+        subject = Subject.parse_obj({"format": "email", "email": FOO})
+        first, second = [
+            generate_security_event(EventType.credential_change, subject)
+            for _ in range(2)
+        ]
+        pushed: List[str] = []
+
+        def post(url: str, data: str, **kwargs: Any) -> Mock:
+            pushed.append(jwt.decode(
+                data, options={"verify_signature": False}
+            )["jti"])
+            return Mock()
+
+        with patch('requests.Session.post',
+                   side_effect=requests.HTTPError(
+                       response=Mock(status_code=503)
+                   )):
+            Stream.broadcast_SET(first)
+            assert delivery.push_engine.drain(timeout=10)
+
+        with patch('requests.Session.post', side_effect=post):
+            Stream.broadcast_SET(second)
+            assert delivery.push_engine.drain(timeout=10)
+            assert pushed == []
+
+            scheduler = RetryScheduler()
+            for _ in range(3):
+                scheduler.run_once(now=LATER)
+                assert delivery.push_engine.drain(timeout=10)
+
+        assert pushed == [first.jti, second.jti]
+        assert push_stream.count_SETs() == 0
@@ -0,0 +1,73 @@
+# Copyright (c) 2021 Cisco Systems, Inc. and its affiliates
+# All rights reserved.
+# Use of this source code is governed by a BSD 3-Clause License
+# that can be found in the LICENSE file.
+
+from unittest.mock import patch
+
+from swagger_server.business_logic.sessions import SessionPool, origin
+
+
+class FakeClock:
+    def __init__(self) -> None:
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def test_origin() -> None:
+    assert origin("https://Receiver.com:8443/push?x=1") == \
+        "https://receiver.com:8443"
+
+
+def test_shares_session_per_origin() -> None:
+    """Ensures streams pushing to the same receiver host share a session,
+    and so its connections"""
+    pool = SessionPool(pool_size=2)
+
+    first = pool.session("https://receiver.com/stream-1")
+    second = pool.session("https://receiver.com/stream-2")
+    other = pool.session("https://other.com/push")
+
+    assert first is second
+    assert other is not first
+    assert len(pool) == 2
+
+
+def test_pool_size() -> None:
+    pool = SessionPool(pool_size=7)
+
+    adapter = pool.session("https://receiver.com/push").get_adapter(
+        "https://receiver.com/push"
+    )
+
+    assert adapter._pool_maxsize == 7
+
+
+def test_evicts_idle_sessions() -> None:
+    """Ensures receivers that have gone quiet don't keep their sockets"""
+    clock = FakeClock()
+    pool = SessionPool(idle_timeout=60, clock=clock)
+    quiet = pool.session("https://quiet.com/push")
+
+    clock.now += 30
+    busy = pool.session("https://busy.com/push")
+    clock.now += 31
+    with patch.object(quiet, 'close') as close_mock:
+        assert pool.session("https://busy.com/push") is busy
+
+    close_mock.assert_called_once()
+    assert len(pool) == 1
+    assert pool.session("https://quiet.com/push") is not quiet
+
+
+def test_keepalive_off() -> None:
+    """Ensures each push gets its own connection when keep-alive is off"""
+    pool = SessionPool(idle_timeout=0)
+
+    with patch('requests.Session.post') as post_mock:
+        pool.post("https://receiver.com/push", data="jws")
+
+    post_mock.assert_called_once_with("https://receiver.com/push", data="jws")
+    assert len(pool) == 0
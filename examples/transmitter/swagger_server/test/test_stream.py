@@ -0,0 +1,261 @@
+# Copyright (c) 2021 Cisco Systems, Inc. and its affiliates
+# All rights reserved.
+# Use of this source code is governed by a BSD 3-Clause License
+# that can be found in the LICENSE file.
+
+from typing import Tuple
+from unittest.mock import patch
+import uuid
+
+from _pytest.monkeypatch import MonkeyPatch
+
+from flask.testing import FlaskClient
+import pytest
+
+from swagger_server import db, jwt_encode, metrics
+from swagger_server.business_logic import retention
+from swagger_server.business_logic.generate_event import (
+    generate_security_event
+)
+from swagger_server.business_logic.stream import (
+    Stream, stream_cache, unknown_stream_cache
+)
+from swagger_server.errors import StreamDoesNotExist
+from swagger_server.events import (
+    SUPPORTED_EVENTS, Events, SecurityEvent, VerificationEvent
+)
+from swagger_server.models import (
+    EventType, PollDeliveryMethod, Status, StreamConfiguration, Subject
+)
+from swagger_server.test.conftest import assert_status_code
+
+
+class TestStreamCache:
+    def test_load_hits_cache(self, temp_db: None, new_stream: Stream) -> None:
+        """Ensures a stream is only read from the database once"""
+        Stream.load(new_stream.client_id)
+
+        with patch.object(db, 'load_stream') as load_mock:
+            stream = Stream.load(new_stream.client_id)
+
+        load_mock.assert_not_called()
+        assert stream.config == new_stream.config
+
+    def test_returns_copies(self, temp_db: None, new_stream: Stream) -> None:
+        """Ensures changing a loaded stream doesn't change the cached one"""
+        stream = Stream.load(new_stream.client_id)
+        stream.status = Status.paused
+        stream.config.format = "opaque"
+
+        reloaded = Stream.load(new_stream.client_id)
+        assert reloaded.status == Status.enabled
+        assert reloaded.config.format is None
+
+    def test_stats_exported(self, temp_db: None,
+                            new_stream: Stream) -> None:
+        """Ensures each cache's hits and misses are scraped with the other
+        metrics"""
+        Stream.load(new_stream.client_id)
+        Stream.load(new_stream.client_id)
+        with pytest.raises(StreamDoesNotExist):
+            Stream.load(uuid.uuid4().hex)
+
+        text = metrics.exposition()
+
+        assert "# TYPE stream_cache_hits_total counter\n" in text
+        assert (f'stream_cache_hits_total{{cache="stream"}} '
+                f'{stream_cache.hits}\n') in text
+        assert (f'stream_cache_misses_total{{cache="unknown_stream"}} '
+                f'{unknown_stream_cache.misses}\n') in text
+        assert (f'stream_cache_size{{cache="stream"}} '
+                f'{stream_cache.stats()["size"]}\n') in text
+
+    def test_broadcast_reads_streams_afresh(self, temp_db: None,
+                                            new_stream: Stream) -> None:
+        """Ensures a broadcast goes by the streams as they are in the
+        database, not by a cached copy another process has since changed"""
+        email = "foo@bar.com"
+        new_stream.add_subject(email)
+        stale = Stream.load(new_stream.client_id)
+        # paused by another process, which this one's cache doesn't know
+        new_stream.update_status(Status.paused)
+        stream_cache.put(new_stream.client_id, stale, stream_cache.epoch())
+        hits = stream_cache.hits
+
+        Stream.broadcast_SET(generate_security_event(
+            EventType.credential_change,
+            Subject.parse_obj({"format": "email", "email": email})
+        ))
+
+        assert new_stream.get_SETs() == []
+        assert new_stream.count_SETs() == 1
+        assert stream_cache.hits == hits
+
+    def test_save_invalidates(self, temp_db: None,
+                              new_stream: Stream) -> None:
+        """Ensures saving a stream's status drops the cached copy"""
+        stream = Stream.load(new_stream.client_id)
+        stream.status = Status.paused
+        stream.save()
+
+        assert Stream.load(new_stream.client_id).status == Status.paused
+
+    def test_update_config_invalidates(self, temp_db: None,
+                                       new_stream: Stream) -> None:
+        """Ensures updating a stream's config drops the cached copy"""
+        stream = Stream.load(new_stream.client_id)
+        stream.update_config(StreamConfiguration(
+            events_requested=SUPPORTED_EVENTS[:1],
+            delivery=PollDeliveryMethod(endpoint_url=None)
+        ))
+
+        reloaded = Stream.load(new_stream.client_id)
+        assert reloaded.config.events_delivered == SUPPORTED_EVENTS[:1]
+
+    def test_delete_invalidates(self, temp_db: None,
+                                new_stream: Stream) -> None:
+        """Ensures deleting a stream drops the cached copy"""
+        new_stream.update_config(StreamConfiguration(
+            format="opaque",
+            events_requested=[],
+            delivery=PollDeliveryMethod(endpoint_url=None)
+        ))
+        Stream.load(new_stream.client_id)
+
+        new_stream.delete()
+
+        assert Stream.load(new_stream.client_id).config.format is None
+
+    def test_stats(self, temp_db: None, new_stream: Stream) -> None:
+        """Ensures hits and misses are counted"""
+        stream_cache.clear()
+        before = stream_cache.stats()
+
+        Stream.load(new_stream.client_id)
+        Stream.load(new_stream.client_id)
+
+        after = stream_cache.stats()
+        assert after["misses"] - before["misses"] == 1
+        assert after["hits"] - before["hits"] == 1
+
+    def test_unknown_stream_cached(self, temp_db: None) -> None:
+        """Ensures repeatedly loading a stream that doesn't exist only
+        checks the database once"""
+        with patch.object(db, 'load_stream',
+                          side_effect=StreamDoesNotExist()) as load_mock:
+            for _ in range(3):
+                with pytest.raises(StreamDoesNotExist):
+                    Stream.load("IncorrectClientId")
+
+        load_mock.assert_called_once()
+
+    def test_register_invalidates_unknown(self, temp_db: None) -> None:
+        """Ensures creating a stream makes a previously unknown client_id
+        valid straight away"""
+        client_id = uuid.uuid4().hex
+        with pytest.raises(StreamDoesNotExist):
+            Stream.load(client_id)
+
+        Stream(client_id, "https://popular-app.com")
+
+        assert Stream.load(client_id).client_id == client_id
+
+
+def test_authenticated_request_reads_stream_once(client: FlaskClient,
+                                                 new_stream: Stream) -> None:
+    """Ensures authenticating and handling a request loads the stream from
+    the database at most once"""
+    stream_cache.clear()
+
+    with patch.object(db, 'load_stream', wraps=db.load_stream) as load_mock:
+        response = client.get(
+            '/stream',
+            headers={'Authorization': f'Bearer {new_stream.client_id}'}
+        )
+
+    assert_status_code(response, 200)
+    load_mock.assert_called_once()
+
+
+def test_ack_records_age(temp_db: None, new_stream: Stream) -> None:
+    """Ensures acknowledging polled SETs records how long they waited"""
+    ack_age = retention.ack_age.labels("poll")
+    acked, waited = ack_age.count, ack_age.sum
+    SET = new_stream.queue_SET(SecurityEvent(
+        events=Events(verification=VerificationEvent())
+    )).SET
+
+    with patch("time.time", return_value=SET.iat + 30):
+        new_stream.ack_SETs([SET.jti, "unknown"])
+
+    assert new_stream.count_SETs() == 0
+    assert ack_age.count == acked + 1
+    assert ack_age.sum == pytest.approx(waited + 30)
+
+
+def test_broadcast_signs_once_per_audience(temp_db: None, with_jwks: None,
+                                           monkeypatch: MonkeyPatch) -> None:
+    """Ensures streams with the same audience share one signed SET, with the
+    same jti, while streams with another audience get their own"""
+    monkeypatch.setenv("SIGN_ON_ENQUEUE", "true")
+    email = "foo@bar.com"
+    audiences = ["https://a.popular-app.com"] * 3 + \
+        ["https://b.popular-app.com"] * 2
+    streams = [Stream(uuid.uuid4().hex, aud) for aud in audiences]
+    for stream in streams:
+        stream.add_subject(email)
+
+    SET = generate_security_event(
+        EventType.credential_change,
+        Subject.parse_obj({"format": "email", "email": email})
+    )
+    with patch.object(jwt_encode.Signer, 'sign',
+                      autospec=True,
+                      side_effect=jwt_encode.Signer.sign) as sign_mock:
+        Stream.broadcast_SET(SET)
+    assert sign_mock.call_count == 2
+
+    jwks = jwt_encode.load_jwks()
+    jwss = {}
+    for stream in streams:
+        queued, = db.get_SETs(stream.client_id)
+        assert queued.jti == SET.jti
+        jwss.setdefault(stream.config.aud, set()).add(queued.jws)
+        decoded = jwt_encode.decode_set(queued.jws, jwks=jwks,
+                                        iss=stream.config.iss,
+                                        aud=stream.config.aud)
+        assert decoded["jti"] == SET.jti
+        stream.delete()
+    assert [len(jws) for jws in jwss.values()] == [1, 1]
+
+
+@pytest.mark.parametrize("event_type,member,values", [
+    (EventType.session_revoked, "session", ("s1", "s2")),
+    (EventType.token_claims_change, "application", ("app1", "app2")),
+])
+def test_supersedes_only_same_whole_subject(temp_db: None,
+                                            new_stream: Stream,
+                                            event_type: EventType,
+                                            member: str,
+                                            values: Tuple[str, ...]) -> None:
+    """Ensures a SET about one session or application of a user doesn't
+    take the place of a SET about another, only of one about the very
+    same"""
+    email = "alice@x.com"
+    new_stream.add_subject(email)
+
+    def broadcast(value: str) -> str:
+        subject = Subject.parse_obj({
+            "user": {"format": "email", "email": email},
+            member: {"format": "opaque", "id": value},
+        })
+        SET = generate_security_event(event_type, subject)
+        Stream.broadcast_SET(SET)
+        return SET.jti
+
+    first = broadcast(values[0])
+    other = broadcast(values[1])
+    assert [SET.jti for SET in new_stream.get_SETs()] == [first, other]
+
+    again = broadcast(values[0])
+    assert [SET.jti for SET in new_stream.get_SETs()] == [other, again]
@@ -14,9 +14,11 @@ import requests
 
 from swagger_server.business_logic.const import VERIFICATION_EVENT_TYPE, POLL_ENDPOINT
 from swagger_server.events import SUPPORTED_EVENTS, SecurityEvent, Events, VerificationEvent
+from swagger_server.business_logic.delivery import push_engine
 from swagger_server.business_logic.stream import Stream
 from swagger_server.errors import StreamDoesNotExist, SubjectNotInStream
 import swagger_server.db as db
+from swagger_server import business_logic, documents
 from swagger_server.models import AddSubjectParameters
 from swagger_server.models import Email
 from swagger_server.models import PhoneNumber
@@ -434,7 +436,8 @@ def test_verification_request__polling(client: FlaskClient, new_stream: Stream,
 
 
 def test_verification_request__pushing__no_response(client: FlaskClient,
-                                                    new_stream: Stream) -> None:
+                                                    new_stream: Stream,
+                                                    with_jwks: None) -> None:
     """Test case for verification_request
 
     Request that a verification event be sent over an Event Stream with
@@ -447,23 +450,27 @@ def test_verification_request__pushing__no_response(client: FlaskClient,
 
     body = VerificationParameters(state=None)
 
-    with patch('requests.post', side_effect=requests.Timeout()) as post_mock:
+    with patch('requests.Session.post', side_effect=requests.Timeout()) as post_mock:
         response = client.post(
             '/verification',
             json=body.dict(exclude_none=True),
             headers={'Authorization': f'Bearer {new_stream.client_id}'}
         )
+        push_engine.drain()
 
     assert_status_code(response, 204)
 
     post_mock.assert_called_once()
+    # the SET stays queued to be pushed again later
+    assert new_stream.count_SETs() == 1
 
 
 @pytest.mark.parametrize(
     "auth_header", [ None, "test-auth-header" ]
 )
 def test_verification_request__pushing(client: FlaskClient, new_stream: Stream,
-                                       auth_header: Optional[str]) -> None:
+                                       auth_header: Optional[str],
+                                       with_jwks: None) -> None:
     """Test case for verification_request
 
     Request that a verification event be sent over an Event Stream with Push delivery method
@@ -478,16 +485,18 @@ def test_verification_request__pushing(client: FlaskClient, new_stream: Stream,
     state = "test state"
     body = VerificationParameters(state=state)
 
-    with patch('requests.post') as post_mock:
+    with patch('requests.Session.post') as post_mock:
         response = client.post(
             '/verification',
             json=body.dict(exclude_none=True),
             headers={'Authorization': f'Bearer {new_stream.client_id}'}
         )
+        push_engine.drain()
 
     assert_status_code(response, 204)
 
     post_mock.assert_called_once()
+    assert new_stream.count_SETs() == 0
 
     args = post_mock.call_args
 
@@ -549,6 +558,34 @@ def test_well_known_ssf_configuration_issuer_get(client: FlaskClient) -> None:
     assert config.issuer.split("/")[-1] == "issuer_example", "Incorrect issuer: {}".format(config.issuer)
 
 
+def test_well_known_ssf_configuration_get__not_modified(client: FlaskClient) -> None:
+    """Test case for well_known_ssf_configuration_get
+
+    The configuration is serialized once for each issuer, and a receiver
+    that already has it gets a 304
+    """
+    documents.configuration_document.cache_clear()
+    with patch.object(business_logic, '_well_known_ssf_configuration_get',
+                      wraps=business_logic._well_known_ssf_configuration_get) as config_mock:
+        response = client.get('/.well-known/sse-configuration')
+        assert_status_code(response, 200)
+        etag, _ = response.get_etag()
+        assert response.cache_control.max_age == 3600
+
+        response = client.get('/.well-known/sse-configuration',
+                              headers={'If-None-Match': f'"{etag}"'})
+        assert_status_code(response, 304)
+        assert response.data == b''
+
+        response = client.get('/.well-known/sse-configuration/tenant-a',
+                              headers={'If-None-Match': f'"{etag}"'})
+        assert_status_code(response, 200)
+        assert response.json["issuer"].endswith("tenant-a")
+        client.get('/.well-known/sse-configuration/tenant-a')
+
+    assert config_mock.call_count == 2
+
+
 if __name__ == '__main__':
     import pytest
     pytest.main()
@@ -6,13 +6,16 @@
 # coding: utf-8
 from __future__ import absolute_import
 
+from unittest.mock import patch
+
+from _pytest.monkeypatch import MonkeyPatch
 from flask import json
 from flask.testing import FlaskClient
 
 from swagger_server.events import Events, VerificationEvent, SecurityEvent
-from swagger_server.errors import StreamDoesNotExist
+from swagger_server.errors import InvalidPollCursor, StreamDoesNotExist
 from swagger_server.business_logic.stream import Stream
-from swagger_server import jwt_encode
+from swagger_server import documents, jwt_encode
 from swagger_server.models import PollParameters
 from swagger_server.test.conftest import assert_status_code
 
@@ -86,7 +89,75 @@ def test_poll_events__one_event(client: FlaskClient, new_stream: Stream, with_jw
     assert decoded_set["events"][VerificationEvent.__uri__] == {}
 
 
-def test_poll_events__more_available(client: FlaskClient, new_stream: Stream) -> None:
+def test_poll_events__signed_on_enqueue(client: FlaskClient,
+                                        new_stream: Stream, with_jwks: None,
+                                        monkeypatch: MonkeyPatch) -> None:
+    """Test case for poll_events
+
+    SETs signed when they were queued are returned without signing them again
+    """
+    monkeypatch.setenv("SIGN_ON_ENQUEUE", "true")
+    jwks = client.get('/jwks.json').json
+
+    issuer = 'https://issuer'
+    audience = 'https://audience'
+    SET = SecurityEvent(
+        iss=issuer,
+        aud=audience,
+        events=Events(verification=VerificationEvent())
+    )
+    new_stream.queue_SET(SET)
+
+    body = PollParameters(returnImmediately=True)
+    with patch.object(jwt_encode.Signer, 'sign') as sign_mock:
+        response = client.post(
+            '/poll',
+            json=body.dict(exclude_none=True),
+            headers={'Authorization': f'Bearer {new_stream.client_id}'}
+        )
+    assert_status_code(response, 200)
+    sign_mock.assert_not_called()
+
+    encoded_set = json.loads(response.data.decode('utf-8'))['sets'][SET.jti]
+    decoded_set = jwt_encode.decode_set(
+        encoded_set, jwks=jwks, iss=issuer, aud=audience
+    )
+    assert decoded_set["jti"] == SET.jti
+
+
+def test_poll_events__signs_in_one_batch(client: FlaskClient,
+                                         new_stream: Stream, with_jwks: None,
+                                         monkeypatch: MonkeyPatch) -> None:
+    """Test case for poll_events
+
+    SETs that weren't signed when they were queued are signed together
+    """
+    monkeypatch.delenv("SIGN_ON_ENQUEUE", raising=False)
+    SETs = [
+        SecurityEvent(events=Events(verification=VerificationEvent()))
+        for _ in range(3)
+    ]
+    for SET in SETs:
+        new_stream.queue_SET(SET)
+
+    body = PollParameters(returnImmediately=True)
+    with patch.object(jwt_encode, 'encode_sets',
+                      wraps=jwt_encode.encode_sets) as encode_mock:
+        response = client.post(
+            '/poll',
+            json=body.dict(exclude_none=True),
+            headers={'Authorization': f'Bearer {new_stream.client_id}'}
+        )
+    assert_status_code(response, 200)
+
+    encode_mock.assert_called_once()
+    assert [SET.jti for SET in encode_mock.call_args.args[0]] == \
+        [SET.jti for SET in SETs]
+    assert set(response.json['sets']) == {SET.jti for SET in SETs}
+
+
+def test_poll_events__more_available(client: FlaskClient, new_stream: Stream,
+                                     with_jwks: None) -> None:
     """Test case for add_subject
 
     Request to add a subject to an Event Stream
@@ -127,6 +198,66 @@ def test_poll_events__more_available(client: FlaskClient, new_stream: Stream) ->
     assert len(response_json['sets']) == 1
 
 
+def test_poll_events__cursor(client: FlaskClient, new_stream: Stream,
+                             with_jwks: None) -> None:
+    """Test case for poll_events
+
+    Page through the queue with the cursor, without acknowledging anything
+    """
+    jtis = [f"jti-{i}" for i in range(5)]
+    for jti in jtis:
+        new_stream.queue_SET(SecurityEvent(
+            jti=jti,
+            iat=1000,
+            events=Events(verification=VerificationEvent())
+        ))
+
+    polled = []
+    cursor = None
+    more_available = True
+    while more_available:
+        body = PollParameters(
+            maxEvents=2,
+            returnImmediately=True,
+            cursor=cursor
+        )
+        response = client.post(
+            '/poll',
+            json=body.dict(exclude_none=True),
+            headers={'Authorization': f'Bearer {new_stream.client_id}'}
+        )
+        assert_status_code(response, 200)
+
+        response_json = json.loads(response.data.decode('utf-8'))
+        polled.extend(response_json['sets'])
+        more_available = response_json['moreAvailable']
+        cursor = response_json.get('cursor')
+        assert (cursor is not None) == more_available
+
+    assert polled == jtis
+    assert new_stream.count_SETs() == len(jtis)
+
+
+def test_poll_events__invalid_cursor(client: FlaskClient,
+                                     new_stream: Stream) -> None:
+    """Test case for poll_events
+
+    A cursor we didn't hand out is rejected
+    """
+    body = PollParameters(
+        maxEvents=1,
+        returnImmediately=True,
+        cursor="not-a-cursor"
+    )
+    response = client.post(
+        '/poll',
+        json=body.dict(exclude_none=True),
+        headers={'Authorization': f'Bearer {new_stream.client_id}'}
+    )
+    assert_status_code(response, 400)
+    assert InvalidPollCursor().message in str(response.data)
+
+
 def test_poll_events__acks(client: FlaskClient, new_stream: Stream) -> None:
     """Test case for add_subject
 
@@ -188,6 +319,35 @@ def test_jwks_json(client: FlaskClient, with_jwks: None) -> None:
     assert_status_code(response, 200)
 
 
+def test_jwks_json__not_modified(client: FlaskClient,
+                                 with_jwks: None) -> None:
+    """Test case for jwks_json
+
+    The JWKS is serialized once for each load of the keys, and a receiver
+    that already has it gets a 304
+    """
+    with patch.object(documents, 'make_document',
+                      wraps=documents.make_document) as make_mock:
+        response = client.get('/jwks.json')
+        assert_status_code(response, 200)
+        etag, _ = response.get_etag()
+        assert response.cache_control.max_age == 300
+        assert response.json == jwt_encode.public_jwks()
+
+        response = client.get('/jwks.json',
+                              headers={'If-None-Match': f'"{etag}"'})
+        assert_status_code(response, 304)
+        assert response.data == b''
+    make_mock.assert_called_once()
+
+    jwt_encode.rotate_jwk("new_key")
+    response = client.get('/jwks.json',
+                          headers={'If-None-Match': f'"{etag}"'})
+    assert_status_code(response, 200)
+    assert response.get_etag()[0] != etag
+    assert "new_key" in {jwk["kid"] for jwk in response.json["keys"]}
+
+
 if __name__ == '__main__':
     import pytest
     pytest.main()
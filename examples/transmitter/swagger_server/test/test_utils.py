@@ -5,7 +5,9 @@
 
 import pytest
 
-from swagger_server.utils import get_simple_subject, SimpleSubjectType
+from swagger_server.utils import (
+    decode_cursor, encode_cursor, get_simple_subject, SimpleSubjectType
+)
 from swagger_server.models import Subject, SimpleSubject, ComplexSubject, Aliases, Email, DID, Account, IssSub, Opaque, PhoneNumber, JwtID
 
 
@@ -70,3 +72,15 @@ def test_get_simple_subject(
         subject: Subject
     ) -> None:
     assert get_simple_subject(subject, class_to_search) == expected_result
+
+
+@pytest.mark.parametrize("seq", [0, 1, 2 ** 62])
+def test_cursor_round_trip(seq: int) -> None:
+    assert decode_cursor(encode_cursor(seq)) == seq
+
+
+@pytest.mark.parametrize("cursor", [
+    "", "not-a-cursor", "c2VxOg==", "c2VxOi0x", "Zm9vOjE=",
+])
+def test_decode_invalid_cursor(cursor: str) -> None:
+    assert decode_cursor(cursor) is None
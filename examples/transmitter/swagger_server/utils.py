@@ -3,6 +3,9 @@
 # Use of this source code is governed by a BSD 3-Clause License
 # that can be found in the LICENSE file.
 
+import base64
+import binascii
+import os
 from typing import Optional, TypeVar, Type
 
 from swagger_server.models import (
@@ -49,3 +52,27 @@ def get_simple_subject(subject: Subject,
         )
     else:
         return None
+
+
+def env_flag(name: str, default: bool = False) -> bool:
+    """Read a true/false setting from the environment"""
+    value = os.environ.get(name)
+    if value is None:
+        return default
+    return value.strip().lower() in ("1", "true", "yes", "on")
+
+
+def encode_cursor(seq: int) -> str:
+    """Make an opaque poll cursor pointing after a SET's sequence number"""
+    return base64.urlsafe_b64encode(f"seq:{seq}".encode()).decode()
+
+
+def decode_cursor(cursor: str) -> Optional[int]:
+    """Get the sequence number back out of a poll cursor, or None if the
+    cursor is not one we made
+    """
+    try:
+        prefix, seq = base64.urlsafe_b64decode(cursor).decode().split(":")
+        return int(seq) if prefix == "seq" and int(seq) >= 0 else None
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        return None